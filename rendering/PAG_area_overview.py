@@ -6,6 +6,12 @@ import brainrender
 from brainrender import Scene, Animation
 from vedo import settings as vsettings
 from brainrender.video import VideoMaker
+from mesh_cache import CachedScene
+
+# # PROFILING // record the wall time, memory, actors/triangles and cache hits/misses of each stage (atlas loading, meshes, actors, render, screenshot) //
+# # A Chrome trace is written to ~/.brainglobe/PAG_brainrender/profiles and a summary is printed when the script ends
+# from profiling import enable_profiling
+# enable_profiling()
 
 
 # // ATLASES //
@@ -56,7 +62,8 @@ save_folder = r"D:\Dropbox (UCL)\Project_transcriptomics\analysis\PAG_scRNAseq_b
 
 # // CREATE SCENE //
 # Create a scene with no title. You can also use scene.add_text to add other text elsewhere in the scene
-scene = Scene(root = True, atlas_name = 'allen_mouse_10um', inset = False, title = 'PAG_areas_overview', screenshots_folder = save_folder, plotter = None)
+# CachedScene works like Scene, but brain region meshes are read from a local cache at the chosen quality ("high", "medium", "low" or "preview")
+scene = CachedScene(root = True, atlas_name = 'allen_mouse_10um', inset = False, title = 'PAG_areas_overview', screenshots_folder = save_folder, plotter = None, quality = "high")
 
 
 # // ADD BRAIN REGIONS //
@@ -122,6 +129,14 @@ superior_colliculus = scene.add_brain_region("SCm", alpha = 0.4, color = "olived
 #     azimuth = 1, elevation = 1, roll = 0, # rotation in degrees per frame on the relative axis
 #     )
 
+# # OPTION B // render the frames in parallel across worker processes, from the scene spec of this script (see specs/PAG_area_overview.json)
+# from parallel_video import make_video
+# make_video("specs/PAG_area_overview.json", save_folder, "PAG_video_areas_overview",
+#     duration = 3, fps = 30,
+#     azimuth = 1, elevation = 1, roll = 0,
+#     workers = 8, # number of worker processes (defaults to the number of cores)
+#     )
+
 
 # # // MAKE ANIMATION //
 # # https://github.com/brainglobe/brainrender/blob/19c63b97a34336898871d66fb24484e8a55d4fa7/examples/animation.py
@@ -147,6 +162,18 @@ superior_colliculus = scene.add_brain_region("SCm", alpha = 0.4, color = "olived
 #     azimuth = 1, elevation = 1, roll = 0, # rotation in degrees per frame on the relative axis
 #     )
 
+# # OPTION B // render the frames in parallel across worker processes, from the scene spec of this script (see specs/PAG_area_overview.json)
+# from parallel_video import make_animation
+# make_animation("specs/PAG_area_overview.json", save_folder, "PAG_video_areas_overview",
+#     keyframes = [
+#         dict(time = 0, camera = "top", zoom = 1.3),
+#         dict(time = 1, camera = "sagittal", zoom = 3),
+#         dict(time = 2, camera = "frontal", zoom = 0.8),
+#         dict(time = 3, camera = "frontal", zoom = 1),
+#         ],
+#     duration = 3, fps = 30, workers = 8,
+#     )
+
 # // RENDER INTERACTIVELY //
 # Render interactively. You can press "s" to take a screenshot
 scene.render(interactive = True, camera = "sagittal", zoom = 1)
@@ -0,0 +1,77 @@
+"""
+    Render a folder of scene specs (see scene_specs.py) offscreen, in parallel across a pool of worker processes.
+    Each worker keeps the brain region meshes it has already loaded in memory, so scenes sharing regions and atlases are built faster.
+
+    Usage:
+        python PAG_batch_render.py specs --workers 8
+"""
+
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+
+
+# // WORKERS //
+def init_worker():
+    """
+    Set up a worker process: render offscreen and keep meshes in memory between specs
+    """
+    import brainrender
+    import mesh_cache
+
+    brainrender.settings.OFFSCREEN = True
+    brainrender.settings.INTERACTIVE = False
+    mesh_cache.KEEP_IN_MEMORY = True
+
+
+def render_one(spec_file):
+    """
+    Render a single spec in a worker. Returns the spec file, the screenshot path (or the error) and the time taken.
+
+    :param spec_file: str, path to a .json spec
+    """
+    from scene_specs import render_spec
+
+    start = time.perf_counter()
+    try:
+        result = render_spec(spec_file)
+    except Exception as e:
+        result = e
+    return spec_file, result, time.perf_counter() - start
+
+
+def render_specs(spec_files, workers = None):
+    """
+    Render a list of specs across a pool of worker processes. Returns {spec file: screenshot path or error}
+
+    :param spec_files: list of str, paths to .json specs
+    :param workers: int, number of worker processes (defaults to the number of cores)
+    """
+    workers = workers or cpu_count()
+    results = {}
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker) as pool:
+        futures = [pool.submit(render_one, str(f)) for f in spec_files]
+        for future in as_completed(futures):
+            spec_file, result, duration = future.result()
+            results[spec_file] = result
+            status = "FAILED" if isinstance(result, Exception) else "saved"
+            print(f"[{len(results)}/{len(spec_files)}] {spec_file}: {status} {result} ({duration:.1f}s)")
+    return results
+
+
+# // RUN //
+if __name__ == "__main__":
+    from scene_specs import find_specs
+
+    parser = argparse.ArgumentParser(description = "Render a folder of scene specs offscreen")
+    parser.add_argument("specs", help = "folder containing .json scene specs (or a single .json spec)")
+    parser.add_argument("--workers", type = int, default = None, help = "number of worker processes (defaults to the number of cores)")
+    args = parser.parse_args()
+
+    spec_files = [args.specs] if args.specs.endswith(".json") else find_specs(args.specs)
+    start = time.perf_counter()
+    results = render_specs(spec_files, workers = args.workers)
+
+    n_failed = sum(isinstance(r, Exception) for r in results.values())
+    print(f"Rendered {len(results) - n_failed}/{len(results)} specs in {time.perf_counter() - start:.1f}s")
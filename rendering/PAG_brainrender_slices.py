@@ -2,6 +2,7 @@
     Render a PAG + SC scene and generate a virtual slice.
     Would be useful to plot the aspirated cells and visualize them in a slice using the CCF coordinates after registration with SHARP-TRACK.
     Would also be possible to then slice the PAG at 25-50um thick sections to check how well do the subdivisions from manual registration (done by eye upon comparing with the Paxinos Atlas) match the ones from brainglobe's `structure_from_coords()` function.
+    The last cell does this with virtual_sections.py: a series of sections is sampled from the annotation volume, with contours and cells on each section.
 """
 
 # %%
@@ -67,3 +68,22 @@ for p, n in zip((slice_start, slice_end), (1, -1)):
 # // RENDER INTERACTIVELY //
 scene.render(interactive = True, camera = "frontal", zoom = 1)
 # %%
+# Series of virtual sections through the PAG, cut from the annotation volume instead of slicing meshes
+# Contours of the atlas subdivisions and the registered cells within each 25um slab are drawn on every section
+from atlas_volumes import get_atlas
+from atlas_roi import get_roi
+from coordinate_spaces import Coordinates
+from metadata_cache import load_metadata
+from virtual_sections import section_stack, plot_sections
+import os
+
+kim_roi = get_roi(get_atlas("kim_mouse_10um"), with_reference = True) # cropped around the PAG and its neighbours
+sections = section_stack(kim_roi, normal = "AP", thickness = 25, regions = ["PAG"], with_reference = True) # coronal sections, normal = (AP, DV, ML) for oblique ones
+
+pag_data = load_metadata("D:\\Dropbox (UCL - SWC)\\Project_transcriptomics\\analysis\\PAG_scRNAseq_brainrender\\PAG_scRNAseq_metadata_211018.csv",
+    columns = ["cell.id", "PAG.area", "CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"])
+cells_um = Coordinates.from_table(pag_data, ["CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"], space = "sharptrack").to("microns")
+
+fig = plot_sections(sections, regions = ["dmpag", "dlpag", "lpag", "vlpag"], cells = cells_um, ncols = 10)
+fig.savefig(os.path.join(save_folder, "PAG_sections_kim_25um.png"), dpi = 300)
+# %%
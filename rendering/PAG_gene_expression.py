@@ -8,6 +8,8 @@ from vedo import settings as vsettings
 from brainrender.video import VideoMaker
 from brainrender.atlas_specific import GeneExpressionAPI
 
+from expression_store import ExpressionStore
+
 
 # // DEFAULT SETTINGS //
 # You can see all the default settings here: https://github.com/brainglobe/brainrender/blob/19c63b97a34336898871d66fb24484e8a55d4fa7/brainrender/settings.py
@@ -40,21 +42,34 @@ save_folder = r"D:\Dropbox (UCL)\Project_transcriptomics\analysis\PAG_scRNAseq_b
 
 # // DOWNLOAD GENE DATA //
 # To download a gene's data you need two things: (1) the id of the gene in the allen database and (2) the id(s) of the ISH experiments for that gene. You can get both with GeneExpressionAPI
-geapi = GeneExpressionAPI() # used to download the data from the allen API
+# Grids are kept in a local store, so each experiment is only downloaded once (set local_folder to use a folder of `<gene>/<experiment id>.npy` grids offline)
+store = ExpressionStore()
 
 # Choose a gene name to download
 gene = "Cacna2d1"
 
 # Get experiment IDs
-expids = geapi.get_gene_experiments(gene)  # [75042246, 72119649, 74000600, 69236915]
+expids = store.experiments(gene)  # [75042246, 72119649, 74000600, 69236915]
+
+# Download the data for one of the experiments above (memory-mapped from the store)
+data = store.grid(gene, expids[0])
+
+# # OPTION B // fetch a list of genes at once: only the missing experiments are downloaded, with several downloads running concurrently
+# genes = ["Cacna2d1", "Tac1", "Penk", "Pdyn", "Vglut2"]
+# gene_expids = store.fetch(genes, workers = 8) # {gene: [experiment IDs]}
+
 
-# Download the data for one of the experiments above
-data = geapi.get_gene_data(gene, expids[0])
+# # // EXPRESSION PER REGION //
+# # Table of expression (mean, max and quantiles) in the PAG and its neighbours, for every experiment of a list of genes (computed across worker processes)
+# from expression_stats import expression_stats
+# stats = expression_stats(genes, atlas_name = "allen_mouse_25um", regions = ["PAG", "DR", "SCm", "MRN"], quantiles = [50, 90], workers = 8)
+# stats.pivot_table(index = "gene", columns = "region", values = "mean")
 
 
 # // CREATE GENE ACTOR //
 # Now you can take the volumetric data and turn it into an actor that can be added to your brainrender scene. When creating the mesh it's useful to set a threshold to eliminate voxels with low gene expression energy. This can be done in two ways: (1) use [min_value] to define a threshold value, or (2) use [min_quantile] to define a percentile (range 0-100) so that only voxels with value above the percentile are rendered. It is also possible to pass any matplotlib (or custom) colormap to cmap to specify how the voxels will be colored
-gene_actor = geapi.griddata_to_volume(data, min_quantile = 85, min_value = None, cmap = "inferno")
+# The quantiles of each grid are precomputed in the store
+gene_actor = store.volume(gene, expids[0], min_quantile = 85, min_value = None, cmap = "inferno")
 
 
 # // CREATE SCENE //
@@ -10,6 +10,11 @@ from brainrender.colors import makePalette
 from morphapi.api.mouselight import MouseLightAPI
 from brainrender.video import VideoMaker
 
+# # PROFILING // record the wall time, memory, actors/triangles and cache hits/misses of each stage (atlas loading, meshes, actors, render, screenshot) //
+# # A Chrome trace is written to ~/.brainglobe/PAG_brainrender/profiles and a summary is printed when the script ends
+# from profiling import enable_profiling
+# enable_profiling()
+
 
 # // DEFAULT SETTINGS //
 # Change some of the default settings
@@ -41,8 +46,13 @@ mlapi = MouseLightAPI()
 # Fetch metadata for neurons with some in the secondary motor cortex
 neurons_metadata = mlapi.fetch_neurons_metadata(filterby = "soma", filter_regions = ["PAG"]) # There is only 1 neuron so far
 
-# Then we can download the files and save them as a .json file
-neurons =  mlapi.download_neurons(neurons_metadata[:50]) # restrict to 50 neurons max, may take a while the first time
+# Then we can download the files to the local neuron store (concurrently, only the neurons not already in the store)
+from neuron_store import NeuronStore
+store = NeuronStore()
+neuron_ids = store.fetch(neurons_metadata[:50], workers = 8) # restrict to 50 neurons max, an interrupted download resumes where it stopped
+
+# # OPTION B // download with morphapi (one neuron after the other), for scene.add_neurons
+# neurons =  mlapi.download_neurons(neurons_metadata[:50]) # restrict to 50 neurons max, may take a while the first time
 
 
 # // CREATE SCENE //
@@ -61,9 +71,21 @@ pag = scene.add_brain_regions(["PAG"],
 #     display_axon = True, display_dendrites = True, neurite_radius = 8, use_cache = False)
 
 # OPTION B // specify a color for each neuronal component
-scene.add_neurons(neurons,
+# Meshes are built the first time and read from the neuron store afterwards
+## meshes are built in this process: building them in parallel (workers = None) needs the script to run under `if __name__ == "__main__":`
+## on Windows and macOS, where worker processes run the script again
+store.add_neurons(scene, neuron_ids,
     color = dict(soma = "blackboard", dendrites = "olivedrab", axon = "lightgreen"),
-    alpha = 0.8, display_axon = True, display_dendrites = True, neurite_radius = 8, soma_radius = 2000, use_cache = False)
+    alpha = 0.8, display_axon = True, display_dendrites = True, neurite_radius = 8, soma_radius = 2000, workers = 1)
+# scene.add_neurons(neurons,
+#     color = dict(soma = "blackboard", dendrites = "olivedrab", axon = "lightgreen"),
+#     alpha = 0.8, display_axon = True, display_dendrites = True, neurite_radius = 8, soma_radius = 2000, use_cache = False)
+
+# # OPTION B2 // same colors, with levels of detail for large sets of neurons: each axon/dendrite is drawn as lines, low or full
+# # resolution tubes depending on its distance to the camera, keeping the number of triangles within a budget
+# from neuron_lod import NeuronLOD
+# NeuronLOD(store, neuron_ids, color = dict(soma = "blackboard", dendrites = "olivedrab", axon = "lightgreen"),
+#     alpha = 0.8, neurite_radius = 8, soma_radius = 2000, triangle_budget = 2000000, workers = 1).add_to(scene)
 
 # # OPTION C // color each neuron of a different color using a colormap - if you have more than one neuron
 # scene.add_neurons(neurons, color = "Reds", alpha = 0.8,
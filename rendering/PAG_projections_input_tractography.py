@@ -41,13 +41,29 @@ save_folder = r"D:\Dropbox (UCL)\Project_transcriptomics\analysis\PAG_scRNAseq_b
 scene = Scene(root = True, atlas_name = 'allen_mouse_10um', inset = False, title = 'PAG_areas_overview', screenshots_folder = save_folder, plotter = None)
 
 
-# // GET CENTER OF MASS AND PROJECTIONS TO IT //
-# Get the center of mass of the region of interest
-p0 = scene.atlas.get_region_CenterOfMass("PAG")
-
-# Get projections to that point
-analyzer = ABA()
-tract = analyzer.get_projection_tracts_to_target(p0 = p0)
+# // GET PROJECTIONS TO THE PAG //
+# The tracts reaching seed points in the PAG (its center of mass and random voxels) are queried once and cached locally
+from tractography_cache import fetch_tracts, region_seeds, TractIndex
+fetch_tracts(region_seeds(scene.atlas, ["PAG"], n_seeds = 5))
+
+# All cached tracts are indexed, then selected locally: tracts passing within 100um of the PAG
+index = TractIndex.from_cache()
+tract = index.tracts(index.near_region(scene.atlas, "PAG", radius = 100))
+
+# # OPTION B // query the tracts to the center of mass of the PAG only, without caching
+# p0 = scene.atlas.get_region_CenterOfMass("PAG")
+# analyzer = ABA()
+# tract = analyzer.get_projection_tracts_to_target(p0 = p0)
+
+# # OPTION C // sweep the targets over the PAG subdivisions of the kim atlas (same space as the Allen CCF)
+# from atlas_volumes import get_atlas
+# kim_atlas_10 = get_atlas("kim_mouse_10um")
+# subdivisions = ["dmpag", "dlpag", "lpag", "vlpag"]
+# fetch_tracts(region_seeds(kim_atlas_10, subdivisions, n_seeds = 5))
+# index = TractIndex.from_cache()
+# for region, tracts_to_region in index.tracts_by_target(kim_atlas_10, subdivisions, radius = 50).items():
+#     from_sc = index.injected_in(scene.atlas, ["SCm", "SCs"])[tracts_to_region]
+#     print(f"{region}: {len(tracts_to_region)} tracts, {from_sc.sum()} injected in the superior colliculus")
 
 
 # // ADD BRAIN REGIONS //
@@ -9,7 +9,9 @@ from vedo import settings as vsettings
 from brainrender.video import VideoMaker
 from brainrender.atlas_specific import get_streamlines_for_region
 from brainrender.actors.streamlines import make_streamlines
-from brainrender.colors import makePalette
+
+from streamline_cache import load_streamlines, streamlines_actor
+from streamline_colors import color_by_gradient
 
 # // DEFAULT SETTINGS //
 # You can see all the default settings here: https://github.com/brainglobe/brainrender/blob/19c63b97a34336898871d66fb24484e8a55d4fa7/brainrender/settings.py
@@ -47,47 +49,35 @@ scene = Scene(root = True, atlas_name = 'allen_mouse_10um', inset = False, title
 
 # // DOWNLOAD STREAMLINES //
 # Download streamlines data for injections in the Periaqueductal Gray
-streams = get_streamlines_for_region("PAG")[:2]
-scene.add(*make_streamlines(*streams, color="salmon", alpha=0.5))
-
-# // ADD BRAIN REGIONS //
-pag = scene.add_brain_region("PAG", alpha = 0.4, color = "darkgoldenrod", silhouette = None, hemisphere = "both")
+## streamlines are downloaded once and read from a local cache afterwards (set local_folder to use a folder of streamline .json files offline)
+streams = load_streamlines("PAG", max_experiments = 2) # remove max_experiments to load the full PAG efferent set
 
+## all streamlines are merged into a single actor (the experiment ID of each line is kept as cell data for coloring and picking)
+streamlines = scene.add(streamlines_actor(streams, color = "salmon", alpha = 0.5))
 
-# # // OPTION A // Color each streamline with a different color //
-# # Create palette to color each streamline with a different color
-# color_palette = makePalette(len(data), "salmon", "darkseagreen")
-# color_palette = makePalette(len(data), "darkblue", "powderblue")
-# color_palette = makePalette(len(data), "deeppink", "lightpink")
+# # OPTION B // one actor per experiment, downloading the streamlines at every run
+# streams = get_streamlines_for_region("PAG")[:2]
+# actors = scene.add(*make_streamlines(*streams, color = "salmon", alpha = 0.5))
 
+# // ADD BRAIN REGIONS //
+pag = scene.add_brain_region("PAG", alpha = 0.4, color = "darkgoldenrod", silhouette = None, hemisphere = "both")
 
-# # Add the efferents by passing either the filepaths or the data
-# ## one actor is 1 streamline (i.e. the traces for 1 injection)
-# scene.add_streamlines(data, color = color_palette, show_injection_site = False, alpha = 0.6)
 
+# // COLOR STREAMLINES //
+# # OPTION A // Color each experiment with a different color //
+# from brainrender.colors import makePalette
+# from streamline_cache import color_by_experiment
+# color_by_experiment(streamlines, dict(zip(streams, makePalette(len(streams), "salmon", "darkseagreen"))))
 
 # // OPTION B // Color streamlines with a color gradient along x position //
-# Add the efferents by passing either the filepaths or the data
-## one actor is 1 streamline (i.e. the traces for 1 injection)
-actors = scene.add_streamlines(data, color = None, show_injection_site = False, alpha = 0.6)
-#if not isinstance(actors, list): actors = [actors] # make sure it's a list or zip will fail
-
-# Now modify the color of each actor to color each actor's vertices based on the X position
-## len(color_combos) needs to be the same as len(actors)
+## each experiment of the merged actor (or each actor, with one actor per experiment) gets the next color pair in turn
 color_combos = [["darkblue", "powderblue"],
-                ["deeppink", "lightpink"],
-                ["darkblue", "powderblue"],
-                ["deeppink", "lightpink"],
-                ["darkblue", "powderblue"],
-                ["deeppink", "lightpink"],
-                ["darkblue", "powderblue"],
-                ["deeppink", "lightpink"],
-                ["darkblue", "powderblue"]] 
-
-for actor, colors in zip(actors, color_combos): # this will take a while
-    scals = actor.points()[:, 0]   # pick x coordinates of vertices
-    cmap = makePalette(len(scals), colors[0], colors[1]) # make colors
-    actor.pointColors(scals, cmap = cmap)
+                ["deeppink", "lightpink"]]
+
+## each color pair is turned once into a small lookup table, and all vertices of an experiment are colored in a single step
+color_by_gradient(streamlines, color_combos, scalars = "x") # or "y", "z", or a function of the vertices' coordinates
+## with shared_range = True the gradient spans the x range of all experiments together instead of each experiment's own range
+# color_by_gradient(streamlines, color_combos, scalars = "x", shared_range = True)
 
 
 # // RENDER INTERACTIVELY //
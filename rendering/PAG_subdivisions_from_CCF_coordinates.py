@@ -16,124 +16,124 @@ show_atlases()
 
 # %%
 # Find the dimensions of an atlas:
-from bg_atlasapi.bg_atlas import BrainGlobeAtlas
-allen_atlas_10 = BrainGlobeAtlas("allen_mouse_10um")
+# The atlases are memory-mapped, so only the voxels around the registered cells are actually loaded in memory
+from atlas_volumes import get_atlas
+allen_atlas_10 = get_atlas("allen_mouse_10um")
 print(allen_atlas_10.reference.shape) # (1320, 800, 1140)
 print(allen_atlas_10.annotation.shape) # (1320, 800, 1140)
 
-kim_atlas_10 = BrainGlobeAtlas("kim_mouse_10um")
+kim_atlas_10 = get_atlas("kim_mouse_10um")
 print(kim_atlas_10.reference.shape) # (1320, 800, 1140)
 print(kim_atlas_10.annotation.shape) # (1320, 800, 1140)
 
-allen_atlas_25 = BrainGlobeAtlas("allen_mouse_25um")
+allen_atlas_25 = get_atlas("allen_mouse_25um")
 print(allen_atlas_25.reference.shape) # (528, 320, 456)
 print(allen_atlas_25.annotation.shape) # (528, 320, 456)
 
-kim_atlas_25 = BrainGlobeAtlas("kim_mouse_25um")
+kim_atlas_25 = get_atlas("kim_mouse_25um")
 print(kim_atlas_25.reference.shape) # (528, 320, 456)
 print(kim_atlas_25.annotation.shape) # (528, 320, 456)
 
 # %%
 # Load metadata
-pag_data = pd.read_csv("D:\\Dropbox (UCL - SWC)\\Project_transcriptomics\\analysis\\PAG_scRNAseq_brainrender\\PAG_scRNAseq_metadata_200617.csv")
+# The CSV is converted once into a typed columnar cache (categoricals, float32 coordinates), later runs only read these columns
+from metadata_cache import load_metadata
+pag_data = load_metadata("D:\\Dropbox (UCL - SWC)\\Project_transcriptomics\\analysis\\PAG_scRNAseq_brainrender\\PAG_scRNAseq_metadata_200617.csv",
+    columns = ["cell.id", "cell.type", "PAG.areamanualregistration", "CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"])
 
 # Inspect the CCF coordinates for each cell
 pag_data[["cell.id", "cell.type", "PAG.areamanualregistration", "CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"]]
 
 # %%
-# initialise variables
-areaID_allen_atlas_10 = []
-areaID_kim_atlas_10 = [] 
-areaID_allen_atlas_25 = []
-areaID_kim_atlas_25 = []
-acronym_allen_atlas_10 = []
-acronym_kim_atlas_10 = [] 
-acronym_allen_atlas_25 = []
-acronym_kim_atlas_25 = []
-
-# Get the structure acronym from a coordinate triplet
-for i in range(len(pag_data["CCF.AllenAP"])):
-    areaID_allen_atlas_10_temp = allen_atlas_10.structure_from_coords(
-        [pag_data["CCF.AllenAP"][i], pag_data["CCF.AllenDV"][i], pag_data["CCF.AllenML"][i]], # triplet of coordinates
-        microns = False, # if true, coordinates are interpreted in microns
-        as_acronym = False, # if true, the region acronym is returned
-        hierarchy_lev = None # if specified, return parent node at the hierarchy level
-        )
-    areaID_allen_atlas_10.append(areaID_allen_atlas_10_temp)
-
-    areaID_kim_atlas_10_temp = kim_atlas_10.structure_from_coords(
-        [pag_data["CCF.AllenAP"][i], pag_data["CCF.AllenDV"][i], pag_data["CCF.AllenML"][i]], # triplet of coordinates
-        microns = False, # if true, coordinates are interpreted in microns
-        as_acronym = False, # if true, the region acronym is returned
-        hierarchy_lev = None # if specified, return parent node at the hierarchy level
-        )
-    areaID_kim_atlas_10.append(areaID_kim_atlas_10_temp)
-
-    areaID_allen_atlas_25_temp = allen_atlas_25.structure_from_coords(
-        [round(pag_data["CCF.AllenAP"][i]/2.5), round(pag_data["CCF.AllenDV"][i]/2.5), round(pag_data["CCF.AllenML"][i]/2.5)], # triplet of coordinates
-        microns = False, # if true, coordinates are interpreted in microns
-        as_acronym = False, # if true, the region acronym is returned
-        hierarchy_lev = None # if specified, return parent node at the hierarchy level
-        )
-    areaID_allen_atlas_25.append(areaID_allen_atlas_25_temp)
-
-    areaID_kim_atlas_25_temp = kim_atlas_25.structure_from_coords(
-        [round(pag_data["CCF.AllenAP"][i]/2.5), round(pag_data["CCF.AllenDV"][i]/2.5), round(pag_data["CCF.AllenML"][i]/2.5)], # triplet of coordinates
-        microns = False, # if true, coordinates are interpreted in microns
-        as_acronym = False, # if true, the region acronym is returned
-        hierarchy_lev = None # if specified, return parent node at the hierarchy level
-        )
-    areaID_kim_atlas_25.append(areaID_kim_atlas_25_temp)
-
-# Get the structure ID from a coordinate triplet
-for i in range(len(pag_data["CCF.AllenAP"])):
-    acronym_allen_atlas_10_temp = allen_atlas_10.structure_from_coords(
-        [pag_data["CCF.AllenAP"][i], pag_data["CCF.AllenDV"][i], pag_data["CCF.AllenML"][i]], # triplet of coordinates
-        microns = False, # if true, coordinates are interpreted in microns
-        as_acronym = True, # if true, the region acronym is returned
-        hierarchy_lev = None # if specified, return parent node at the hierarchy level
-        )
-    acronym_allen_atlas_10.append(acronym_allen_atlas_10_temp)
-
-    acronym_kim_atlas_10_temp = kim_atlas_10.structure_from_coords(
-        [pag_data["CCF.AllenAP"][i], pag_data["CCF.AllenDV"][i], pag_data["CCF.AllenML"][i]], # triplet of coordinates
-        microns = False, # if true, coordinates are interpreted in microns
-        as_acronym = True, # if true, the region acronym is returned
-        hierarchy_lev = None # if specified, return parent node at the hierarchy level
-        )
-    acronym_kim_atlas_10.append(acronym_kim_atlas_10_temp)
-
-    acronym_allen_atlas_25_temp = allen_atlas_25.structure_from_coords(
-        [round(pag_data["CCF.AllenAP"][i]/2.5), round(pag_data["CCF.AllenDV"][i]/2.5), round(pag_data["CCF.AllenML"][i]/2.5)], # triplet of coordinates
-        microns = False, # if true, coordinates are interpreted in microns
-        as_acronym = True, # if true, the region acronym is returned
-        hierarchy_lev = None # if specified, return parent node at the hierarchy level
-        )
-    acronym_allen_atlas_25.append(acronym_allen_atlas_25_temp)
-
-    acronym_kim_atlas_25_temp = kim_atlas_25.structure_from_coords(
-        [round(pag_data["CCF.AllenAP"][i]/2.5), round(pag_data["CCF.AllenDV"][i]/2.5), round(pag_data["CCF.AllenML"][i]/2.5)], # triplet of coordinates
-        microns = False, # if true, coordinates are interpreted in microns
-        as_acronym = True, # if true, the region acronym is returned
-        hierarchy_lev = None # if specified, return parent node at the hierarchy level
-        )
-    acronym_kim_atlas_25.append(acronym_kim_atlas_25_temp)
+# Get the structure ID and acronym of every cell for every atlas at once
+from atlas_lookup import structures_from_coords
+from coordinate_spaces import Coordinates
+
+coordinates = Coordinates.from_table(pag_data, ["CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"], space = "sharptrack") # triplets of coordinates (sharp-track uses a 10um atlas), pag_data is not modified
+coordinates_10 = coordinates.to("sharptrack")
+coordinates_um = coordinates.to("microns") # the same coordinates in microns, which can be looked up at any resolution
+
+area_dataframe_10 = structures_from_coords(
+    dict(allen_atlas_10 = allen_atlas_10, kim_atlas_10 = kim_atlas_10), # atlases to look up
+    coordinates_10, # (N, 3) array of coordinates
+    microns = False, # if true, coordinates are interpreted in microns
+    as_acronym = True, # if true, the region acronym is also returned
+    hierarchy_lev = None # if specified, return parent node at the hierarchy level
+    )
+area_dataframe_25 = structures_from_coords(
+    dict(allen_atlas_25 = allen_atlas_25, kim_atlas_25 = kim_atlas_25), # atlases to look up
+    coordinates_um, # (N, 3) array of coordinates
+    microns = True, # if true, coordinates are interpreted in microns
+    as_acronym = True, # if true, the region acronym is also returned
+    hierarchy_lev = None, # if specified, return parent node at the hierarchy level
+    rounding = "nearest" # "nearest" rounds to the nearest 25um voxel, "floor" takes the voxel containing the coordinate
+    )
+
+# # To avoid loading the 25um atlases, the 25um lookups can also be answered from a downsampled view of the 10um atlases:
+# from atlas_resolution import ResampledAtlas
+# area_dataframe_25 = structures_from_coords(
+#     dict(allen_atlas_25 = ResampledAtlas(allen_atlas_10, 25), kim_atlas_25 = ResampledAtlas(kim_atlas_10, 25)),
+#     coordinates_um, microns = True, as_acronym = True, hierarchy_lev = None, rounding = "nearest")
+
+# # OPTION B // run the lookups against cropped PAG-centred subvolumes instead of the whole-brain annotations //
+# # The crops are saved to disk the first time and reused afterwards. Cells outside the crop are returned as "Outside atlas"
+# from atlas_roi import get_roi
+# pag_regions = ["PAG", "DR", "SCm"] # regions (and their descendants) included in the crop
+# area_dataframe_10 = structures_from_coords(
+#     dict(allen_atlas_10 = get_roi(allen_atlas_10, regions = pag_regions, margin = 20), kim_atlas_10 = get_roi(kim_atlas_10, regions = pag_regions, margin = 20)),
+#     coordinates_10, microns = False, as_acronym = True)
+# area_dataframe_25 = structures_from_coords(
+#     dict(allen_atlas_25 = get_roi(allen_atlas_25, regions = pag_regions, margin = 8), kim_atlas_25 = get_roi(kim_atlas_25, regions = pag_regions, margin = 8)),
+#     coordinates_um, microns = True, as_acronym = True, rounding = "nearest")
+
+# # OPTION C // only look up cells that are new or re-registered since the last run //
+# # Results are stored on disk by cell.id, coordinates hash and atlas version; `changes_10` and `changes_25` list the cells looked up again
+# # and whether their structure changed (the change log is also appended to changes.csv in the store)
+# from incremental_subdivisions import update_subdivisions
+# area_dataframe_10, changes_10 = update_subdivisions(
+#     dict(allen_atlas_10 = allen_atlas_10, kim_atlas_10 = kim_atlas_10), pag_data["cell.id"], coordinates_10, microns = False)
+# area_dataframe_25, changes_25 = update_subdivisions(
+#     dict(allen_atlas_25 = allen_atlas_25, kim_atlas_25 = kim_atlas_25), pag_data["cell.id"], coordinates_um, microns = True, rounding = "nearest")
+
+# %%
+# Distance of each cell to the nearest border between kim PAG subdivisions, and the subdivision on the other side
+# The distance fields are computed once on the PAG ROI and saved to disk; cells close to a border have less reliable subdivisions
+from boundary_distances import get_boundary_distances
+kim_borders_10 = get_boundary_distances(kim_atlas_10, subdivisions = ["dmpag", "dlpag", "lpag", "vlpag"])
+borders_dataframe_10 = kim_borders_10.query(coordinates_10, microns = False).add_suffix("_kim_atlas_10")
+
+# %%
+# Agreement of the kim subdivisions with the manual registration under registration error
+# Each cell is jittered 1000 times and every draw is looked up in each atlas
+## draws are looked up in this process: running them in worker processes (workers = None, atlases given by name) needs the script
+## to run under `if __name__ == "__main__":` on Windows and macOS, where worker processes run the script again
+from atlas_agreement import atlas_agreement, RegistrationError
+agreement = atlas_agreement(
+    dict(kim_atlas_10 = "kim_mouse_10um", kim_atlas_25 = "kim_mouse_25um"), # atlases to look up
+    coordinates_um, # (N, 3) array of coordinates in microns
+    regions = ["dmpag", "dlpag", "lpag", "vlpag"], # labels compared (cells in none of them are labelled "other")
+    manual = pag_data["PAG.areamanualregistration"].values, # manual subdivision of each cell
+    n_draws = 1000, # jittered copies of each cell
+    error = RegistrationError(sigma_um = 50, model = "gaussian"), # registration error along AP, DV and ML
+    index = pag_data["cell.id"],
+    workers = 1 # number of worker processes
+    )
+agreement.summary(ci = 95) # per-subdivision agreement with the manual registration and its 95% confidence interval
+# agreement.confusion("kim_atlas_10") # expected number of cells per manual x atlas subdivision
+# agreement.probabilities("kim_atlas_10") # probability of each subdivision for each cell
 
 # %%
 # Collate results in a dataframe
-area_dataframe = pd.DataFrame(dict(
-    areaID_allen_atlas_10 = areaID_allen_atlas_10,
-    acronym_allen_atlas_10 = acronym_allen_atlas_10,
-    areaID_kim_atlas_10 = areaID_kim_atlas_10,
-    acronym_kim_atlas_10 = acronym_kim_atlas_10,
-    areaID_allen_atlas_25 = areaID_allen_atlas_25,
-    acronym_allen_atlas_25 = acronym_allen_atlas_25,
-    areaID_kim_atlas_25 = areaID_kim_atlas_25,
-    acronym_kim_atlas_25 = acronym_kim_atlas_25
-    ))
+area_dataframe = pd.concat([area_dataframe_10, area_dataframe_25, borders_dataframe_10], axis = 1)
 
 area_dataframe
 
+# %%
+# Count cells per structure at a given hierarchy level (0 is the root) for each atlas
+from atlas_hierarchy import count_by_level
+
+count_by_level(kim_atlas_10, area_dataframe["areaID_kim_atlas_10"].values, hierarchy_lev = 5) # 5 is the level of the PAG in the Allen ontology
+
 # %% 
 import os
 from datetime import date
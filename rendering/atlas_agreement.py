@@ -0,0 +1,318 @@
+"""
+    Monte-Carlo agreement between atlases (and manual registration) under registration error.
+
+    The subdivision of a cell close to a border depends on registration errors of a few tens of microns. Here every
+    cell is jittered K times (e.g. 1000 draws) with a registration-error model, and all draws are looked up in all
+    atlases. For each atlas this gives the probability of each label per cell, the confusion matrix against the manual
+    registration (or another atlas), and the agreement of each subdivision with a confidence interval across draws.
+
+    Draws are looked up in chunks of a fixed number of lookups, so memory does not grow with K or with the number of
+    cells, and chunks are spread across worker processes when atlases are given by name (each worker opens them
+    memory-mapped, see atlas_volumes.py). Only label counts leave the workers. Each chunk has its own random stream
+    spawned from the seed, so results do not depend on the number of workers. Worker processes re-import the main module
+    where processes are spawned (Windows, macOS), so scripts running chunks in parallel must run under
+    `if __name__ == "__main__":`, otherwise pass `workers = 1` to look them up in the calling process.
+
+    Example:
+        from atlas_agreement import atlas_agreement, RegistrationError
+        agreement = atlas_agreement(dict(allen_atlas_10 = "allen_mouse_10um", kim_atlas_10 = "kim_mouse_10um"), coordinates_um,
+            regions = ["dmpag", "dlpag", "lpag", "vlpag"], manual = pag_data["PAG.areamanualregistration"].values,
+            n_draws = 1000, error = RegistrationError(sigma_um = 50))
+        agreement.summary() # agreement of each subdivision with the manual registration, with 95% confidence intervals
+        agreement.probabilities("kim_atlas_10") # probability of each subdivision for each cell
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+from multiprocessing import cpu_count
+
+import numpy as np
+import pandas as pd
+
+from atlas_hierarchy import get_hierarchy_table, region_labels
+from atlas_lookup import ids_from_coords
+from boundary_distances import OTHER_LABEL
+
+
+# // DEFAULT SETTINGS //
+AGREEMENT_REGIONS = ["dmpag", "dlpag", "lpag", "vlpag"] # labels compared between atlases (each includes its descendants)
+N_DRAWS = 1000 # number of jittered copies of each cell
+REGISTRATION_SIGMA = 50 # standard deviation (in microns) of the registration error along each axis
+CHUNK_LOOKUPS = 2_000_000 # number of lookups per chunk (cells per chunk = CHUNK_LOOKUPS // n_draws), bounds memory per worker
+MANUAL = "manual" # name of the manual registration in confusion matrices and agreement tables
+
+
+# // REGISTRATION ERROR //
+class RegistrationError:
+    def __init__(self, sigma_um = REGISTRATION_SIGMA, model = "gaussian", bias_um = 0):
+        """
+        Random offsets (in microns) added to the coordinates of the cells
+
+        :param sigma_um: float or 3-tuple of float, standard deviation of the error along each axis (AP, DV, ML)
+        :param model: str, "gaussian" or "uniform" (a box with the same standard deviation)
+        :param bias_um: float or 3-tuple of float, systematic offset added to all draws
+        """
+        if model not in ("gaussian", "uniform"):
+            raise ValueError(f"Registration error model should be 'gaussian' or 'uniform', not {model}")
+        self.sigma_um = np.broadcast_to(np.asarray(sigma_um, dtype = np.float64), (3,))
+        self.bias_um = np.broadcast_to(np.asarray(bias_um, dtype = np.float64), (3,))
+        self.model = model
+
+    def __repr__(self):
+        return f"RegistrationError({self.model}, sigma {self.sigma_um.tolist()} um, bias {self.bias_um.tolist()} um)"
+
+    def sample(self, rng, shape):
+        """
+        Draw offsets as an array of shape (*shape, 3)
+
+        :param rng: np.random.Generator
+        :param shape: tuple of int
+        """
+        if self.model == "gaussian":
+            offsets = rng.standard_normal((*shape, 3))
+        else:
+            offsets = rng.uniform(-np.sqrt(3), np.sqrt(3), (*shape, 3)) # unit standard deviation
+        return offsets * self.sigma_um + self.bias_um
+
+
+# // RESULTS //
+class AgreementResult:
+    def __init__(self, atlas_names, regions, n_draws, counts, point_labels, manual = None, manual_matches = None,
+        point_matches = None, pair_counts = None, index = None):
+        """
+        Label counts of the jittered cells in each atlas. Label i + 1 is regions[i], label 0 is OTHER_LABEL.
+
+        :param atlas_names: list of str
+        :param regions: list of str
+        :param n_draws: int, number of draws per cell
+        :param counts: dict of {atlas_name: (N, n_labels) array}, number of draws of each cell with each label
+        :param point_labels: dict of {atlas_name: (N,) array}, label of each cell without jitter
+        :param manual: (N,) array, manual label of each cell (None if there is no manual registration)
+        :param manual_matches: dict of {atlas_name: (n_draws, n_labels) array}, cells of each manual label matching it, per draw
+        :param point_matches: dict of {atlas_name: (n_draws, n_labels) array}, cells of each point label matching it, per draw
+        :param pair_counts: dict of {(atlas_name, atlas_name): (n_labels, n_labels) array}, joint label counts over all draws
+        :param index: pd.Index of the cells (e.g. cell IDs)
+        """
+        self.atlas_names, self.regions, self.n_draws = list(atlas_names), list(regions), n_draws
+        self.names = [OTHER_LABEL] + self.regions
+        self.counts, self.point_labels = counts, point_labels
+        self.manual, self.manual_matches = manual, manual_matches
+        self.point_matches, self.pair_counts = point_matches, pair_counts
+        self.index = index if index is not None else pd.RangeIndex(len(next(iter(point_labels.values()))))
+
+    def __repr__(self):
+        return f"AgreementResult of {len(self.index)} cells x {self.n_draws} draws in {self.atlas_names}"
+
+    def probabilities(self, atlas_name):
+        """
+        Probability of each label for each cell, as a DataFrame with one column per label
+
+        :param atlas_name: str
+        """
+        return pd.DataFrame(self.counts[atlas_name] / self.n_draws, index = self.index, columns = self.names)
+
+    def most_likely(self, atlas_name):
+        """
+        Most likely label of each cell and its probability, with the label of the cell without jitter
+
+        :param atlas_name: str
+        """
+        probabilities = self.probabilities(atlas_name)
+        return pd.DataFrame(dict(
+            label = probabilities.idxmax(axis = 1),
+            probability = probabilities.max(axis = 1),
+            point_label = np.asarray(self.names, dtype = object)[self.point_labels[atlas_name]]),
+            index = self.index)
+
+    def confusion(self, atlas_name, other = MANUAL):
+        """
+        Expected number of cells with each pair of labels (mean over draws): rows are the labels of `other`
+        (the manual registration or another atlas), columns the labels of `atlas_name`
+
+        :param atlas_name: str
+        :param other: str, MANUAL or the name of another atlas
+        """
+        if other == MANUAL:
+            self._check_manual()
+            n_labels = len(self.names)
+            matrix = np.stack([np.bincount(self.manual, weights = self.counts[atlas_name][:, label], minlength = n_labels)
+                for label in range(n_labels)], axis = 1) / self.n_draws
+        elif (other, atlas_name) in self.pair_counts:
+            matrix = self.pair_counts[(other, atlas_name)] / self.n_draws
+        else:
+            matrix = self.pair_counts[(atlas_name, other)].T / self.n_draws
+        return pd.DataFrame(matrix, index = pd.Index(self.names, name = other), columns = pd.Index(self.names, name = atlas_name))
+
+    def agreement(self, atlas_name, against = MANUAL, ci = 95):
+        """
+        Fraction of the cells of each label that get the same label in the atlas, as a DataFrame with the mean over
+        draws and a confidence interval across draws. The "all" row pools all cells.
+
+        :param atlas_name: str
+        :param against: str, MANUAL to compare with the manual registration, or "point" to compare with the label of
+            the cell without jitter in the same atlas (stability of the label under registration error)
+        :param ci: float, width (in %) of the confidence interval
+        """
+        if against == MANUAL:
+            self._check_manual()
+            matches, reference = self.manual_matches[atlas_name], self.manual
+        elif against == "point":
+            matches, reference = self.point_matches[atlas_name], self.point_labels[atlas_name]
+        else:
+            raise ValueError(f"Agreement should be computed against '{MANUAL}' or 'point', not {against}")
+
+        n_cells = np.bincount(reference, minlength = len(self.names))
+        matches = np.column_stack([matches, matches.sum(axis = 1)]) # per draw, per label and pooled
+        n_cells = np.append(n_cells, n_cells.sum())
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            fractions = matches / n_cells
+            point = self._point_matches(atlas_name, reference) / n_cells
+        low, high = np.percentile(fractions, [(100 - ci) / 2, (100 + ci) / 2], axis = 0)
+        return pd.DataFrame(dict(
+            n_cells = n_cells,
+            agreement = fractions.mean(axis = 0),
+            ci_low = low,
+            ci_high = high,
+            point_agreement = point),
+            index = pd.Index(self.names + ["all"], name = "label"))
+
+    def summary(self, against = MANUAL, ci = 95):
+        """
+        Agreement tables of all atlases, concatenated with the atlas name as the first index level
+
+        :param against: str, MANUAL or "point" (see `agreement()`)
+        :param ci: float, width (in %) of the confidence interval
+        """
+        return pd.concat({atlas_name: self.agreement(atlas_name, against = against, ci = ci) for atlas_name in self.atlas_names},
+            names = ["atlas"])
+
+    def _point_matches(self, atlas_name, reference):
+        """
+        Number of cells of each reference label (and pooled) whose label without jitter is the same
+        """
+        point_labels = self.point_labels[atlas_name]
+        matches = np.bincount(reference[point_labels == reference], minlength = len(self.names))
+        return np.append(matches, matches.sum())
+
+    def _check_manual(self):
+        if self.manual is None:
+            raise ValueError("No manual registration was given to atlas_agreement()")
+
+
+# // AGREEMENT //
+def atlas_agreement(atlases, coords_um, regions = AGREEMENT_REGIONS, manual = None, n_draws = N_DRAWS,
+    error = None, chunk_lookups = CHUNK_LOOKUPS, workers = None, seed = 0, index = None):
+    """
+    Jitter each cell n_draws times with a registration-error model and look up all draws in all atlases
+
+    :param atlases: dict of {name: BrainGlobeAtlas or atlas name}. Atlas names are opened memory-mapped in worker processes,
+        atlas objects are looked up in this process
+    :param coords_um: np.ndarray, (N, 3) array of coordinates in microns
+    :param regions: list of str, acronyms of the labels (each includes its descendants, nested regions get the deepest label)
+    :param manual: array-like of str, manual label of each cell (labels not in regions count as OTHER_LABEL, case is ignored)
+    :param n_draws: int, number of draws per cell
+    :param error: RegistrationError (or any object with a `sample(rng, shape)` method), defaults to a gaussian of REGISTRATION_SIGMA
+    :param chunk_lookups: int, number of lookups per atlas in each chunk
+    :param workers: int, number of worker processes (defaults to the number of cores). Use 1 in scripts without a main guard
+    :param seed: int, seed of the random draws
+    :param index: pd.Index of the cells in the results (e.g. cell IDs)
+    """
+    from atlas_volumes import get_atlas
+
+    coords_um = np.atleast_2d(np.asarray(coords_um, dtype = np.float64))
+    error = error if error is not None else RegistrationError()
+    regions = list(regions)
+    atlas_names = list(atlases)
+    by_name = all(isinstance(atlas, str) for atlas in atlases.values())
+    opened = {name: get_atlas(atlas) if isinstance(atlas, str) else atlas for name, atlas in atlases.items()}
+    tables = {name: _label_table(atlas, regions) for name, atlas in opened.items()} # done once, so missing regions are reported once
+
+    manual_labels = None
+    if manual is not None:
+        codes = {region.lower(): i + 1 for i, region in enumerate(regions)}
+        manual_labels = np.array([codes.get(str(label).lower(), 0) for label in manual], dtype = np.int64)
+
+    # chunks of cells with their own random streams
+    cells_per_chunk = max(1, chunk_lookups // n_draws)
+    starts = range(0, len(coords_um), cells_per_chunk)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    jobs = [(atlases if by_name else None, tables, regions, coords_um[start:start + cells_per_chunk],
+        None if manual_labels is None else manual_labels[start:start + cells_per_chunk], n_draws, error, chunk_seed)
+        for start, chunk_seed in zip(starts, seeds)]
+
+    workers = min(workers or cpu_count(), len(jobs)) if by_name else 1
+    if workers <= 1:
+        chunks = [_agreement_chunk(*job, atlases = opened) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            chunks = list(pool.map(_agreement_chunk, *zip(*jobs)))
+
+    # per-cell results are concatenated, per-draw and pairwise counts are summed
+    n_labels = len(regions) + 1
+    counts = {name: np.concatenate([c["counts"][name] for c in chunks]) if chunks else np.zeros((0, n_labels), np.int64) for name in atlas_names}
+    point_labels = {name: np.concatenate([c["point_labels"][name] for c in chunks]) if chunks else np.zeros(0, np.int64) for name in atlas_names}
+    point_matches = {name: sum(c["point_matches"][name] for c in chunks) for name in atlas_names}
+    pair_counts = {pair: sum(c["pair_counts"][pair] for c in chunks) for pair in combinations(atlas_names, 2)}
+    manual_matches = {name: sum(c["manual_matches"][name] for c in chunks) for name in atlas_names} if manual_labels is not None else None
+    return AgreementResult(atlas_names, regions, n_draws, counts, point_labels, manual = manual_labels, manual_matches = manual_matches,
+        point_matches = point_matches, pair_counts = pair_counts, index = index)
+
+
+def _agreement_chunk(atlas_names, tables, regions, coords_um, manual, n_draws, error, chunk_seed, atlases = None):
+    """
+    Look up the draws of a chunk of cells in all atlases and count labels (run in worker processes)
+    """
+    from atlas_volumes import get_atlas
+
+    if atlases is None:
+        atlases = {name: get_atlas(atlas_name) for name, atlas_name in atlas_names.items()}
+    rng = np.random.default_rng(chunk_seed)
+    n_cells, n_labels = len(coords_um), len(regions) + 1
+    jittered = (coords_um[:, None, :] + error.sample(rng, (n_cells, n_draws))).reshape(-1, 3) # same draws for all atlases
+
+    rows = np.repeat(np.arange(n_cells), n_draws) * n_labels
+    result = dict(counts = {}, point_labels = {}, point_matches = {}, manual_matches = {}, pair_counts = {})
+    labels = {}
+    for name, atlas in atlases.items():
+        point = _labels_of(tables[name], ids_from_coords(atlas, coords_um, microns = True))
+        labels[name] = _labels_of(tables[name], ids_from_coords(atlas, jittered, microns = True)).reshape(n_cells, n_draws)
+        result["point_labels"][name] = point
+        result["counts"][name] = np.bincount(rows + labels[name].ravel(), minlength = n_cells * n_labels).reshape(n_cells, n_labels)
+        result["point_matches"][name] = _matches_per_draw(labels[name], point, n_labels)
+        if manual is not None:
+            result["manual_matches"][name] = _matches_per_draw(labels[name], manual, n_labels)
+
+    for first, second in combinations(atlases, 2):
+        result["pair_counts"][(first, second)] = np.bincount(labels[first].ravel() * n_labels + labels[second].ravel(),
+            minlength = n_labels ** 2).reshape(n_labels, n_labels)
+    return result
+
+
+# // UTILS //
+def _label_table(atlas, regions):
+    """
+    Sorted structure IDs of an atlas and the label of each, with a last entry (label 0) for IDs not in the atlas
+    """
+    ids = get_hierarchy_table(atlas).ids
+    return ids, np.append(region_labels(atlas, ids, regions), 0).astype(np.int64)
+
+
+def _labels_of(table, ids):
+    """
+    Label of each structure ID from a table of `_label_table()`
+    """
+    sorted_ids, labels = table
+    rows = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    rows[sorted_ids[rows] != ids] = len(sorted_ids)
+    return labels[rows]
+
+
+def _matches_per_draw(labels, reference, n_labels):
+    """
+    For each draw, number of cells of each reference label whose jittered label is the same, as a (n_draws, n_labels) array
+    """
+    matches = np.zeros((labels.shape[1], n_labels), dtype = np.int64)
+    same = labels == reference[:, None]
+    for label in np.unique(reference):
+        matches[:, label] = same[reference == label].sum(axis = 0)
+    return matches
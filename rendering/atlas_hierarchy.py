@@ -0,0 +1,167 @@
+"""
+    Dense ancestor tables to roll structure IDs up the atlas hierarchy (the `hierarchy_lev` argument of `structure_from_coords()`)
+    and to test membership (e.g. "is this cell inside the PAG?") for whole columns of IDs at once.
+
+    For each atlas, the structures' `structure_id_path` are stored in a (n_structures, max_depth) array, so rolling IDs up
+    to a hierarchy level is a single NumPy gather. The ancestors of each structure are also stored as a packed bitmask,
+    so testing membership to any region is a single gather plus a bit test, with no tree traversal.
+
+    Example:
+        from atlas_hierarchy import get_hierarchy_table
+        hierarchy = get_hierarchy_table(kim_atlas_10)
+        area_dataframe["inside_PAG"] = hierarchy.is_within(area_dataframe["areaID_kim_atlas_10"].values, "PAG")
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# // DEFAULT SETTINGS //
+OUTSIDE_ATLAS_ID = 0 # ID returned for coordinates that fall outside the annotation volume
+OUTSIDE_ATLAS_ACRONYM = "Outside atlas" # acronym returned for coordinates outside the atlas or IDs missing from the atlas structures
+
+_tables = {} # {atlas_name: HierarchyTable}
+
+
+# // HIERARCHY TABLE //
+class HierarchyTable:
+    def __init__(self, structures):
+        """
+        Dense ancestor table and ancestor-membership bitmask of an atlas ontology.
+        Rows follow the sorted structure IDs; an extra last row stands for IDs outside the atlas.
+
+        :param structures: dict-like of {id: structure} with "acronym" and "structure_id_path" entries (e.g. BrainGlobeAtlas.structures)
+        """
+        self.ids = np.array(sorted(int(i) for i in structures.keys()), dtype = np.int64)
+        paths = [list(structures[int(i)]["structure_id_path"]) for i in self.ids]
+        self.acronyms = np.array([structures[int(i)]["acronym"] for i in self.ids] + [OUTSIDE_ATLAS_ACRONYM], dtype = object)
+
+        n_structures = len(self.ids)
+        self.depths = np.array([len(p) - 1 for p in paths] + [0], dtype = np.int64) # hierarchy level of each structure
+        self.max_depth = int(self.depths.max()) + 1
+
+        # ancestors[row, level] is the ancestor at that level. Levels deeper than the structure itself repeat the structure
+        self.ancestors = np.full((n_structures + 1, self.max_depth), OUTSIDE_ATLAS_ID, dtype = np.int64)
+        for row, path in enumerate(paths):
+            self.ancestors[row, :len(path)] = path
+            self.ancestors[row, len(path):] = path[-1]
+
+        # membership[row, col] is true if structure `col` is the structure at `row` or one of its ancestors
+        membership = np.zeros((n_structures + 1, n_structures), dtype = bool)
+        for row, path in enumerate(paths):
+            membership[row, self._rows(path)] = True
+        self.membership_bits = np.packbits(membership, axis = 1)
+
+    def __repr__(self):
+        return f"HierarchyTable with {len(self.ids)} structures and {self.max_depth} levels"
+
+    def _rows(self, ids):
+        """
+        Row of each structure ID in the tables (IDs not in the atlas map to the last row)
+
+        :param ids: np.ndarray, structure IDs
+        """
+        ids = np.asarray(ids, dtype = np.int64)
+        rows = np.searchsorted(self.ids, ids)
+        rows[rows == len(self.ids)] = 0
+        return np.where(self.ids[rows] == ids, rows, len(self.ids))
+
+    def at_level(self, ids, hierarchy_lev):
+        """
+        Roll structure IDs up to their ancestor at a hierarchy level, like `structure_from_coords(..., hierarchy_lev)`.
+        Structures shallower than the level are returned unchanged and IDs outside the atlas stay `OUTSIDE_ATLAS_ID`.
+
+        :param ids: np.ndarray, structure IDs
+        :param hierarchy_lev: int, hierarchy level (0 is the root)
+        """
+        return self.ancestors[self._rows(ids), hierarchy_lev]
+
+    def is_within(self, ids, region):
+        """
+        Test whether structure IDs are a region or one of its descendants
+
+        :param ids: np.ndarray, structure IDs
+        :param region: str or int, acronym or ID of the region
+        """
+        col = self.row_of(region)
+        bits = self.membership_bits[self._rows(ids), col >> 3]
+        return ((bits >> (7 - (col & 7))) & 1).astype(bool)
+
+    def row_of(self, region):
+        """
+        Row of a region in the tables
+
+        :param region: str or int, acronym or ID of the region
+        """
+        if isinstance(region, str):
+            matches = np.flatnonzero(self.acronyms[:-1] == region)
+        else:
+            matches = np.flatnonzero(self.ids == int(region))
+
+        if not len(matches):
+            raise KeyError(f"The region {region} doesn't seem to belong to the atlas being used")
+        return int(matches[0])
+
+    def acronyms_of(self, ids):
+        """
+        Acronym of each structure ID (`OUTSIDE_ATLAS_ACRONYM` for IDs outside the atlas)
+
+        :param ids: np.ndarray, structure IDs
+        """
+        return self.acronyms[self._rows(ids)]
+
+
+def get_hierarchy_table(atlas):
+    """
+    Get the hierarchy table of an atlas, building it the first time it is requested
+
+    :param atlas: BrainGlobeAtlas (or RegionOfInterest)
+    """
+    if atlas.atlas_name not in _tables:
+        _tables[atlas.atlas_name] = HierarchyTable(atlas.structures)
+    return _tables[atlas.atlas_name]
+
+
+# // REGION LABELS //
+def region_labels(atlas, ids, regions):
+    """
+    Label of each structure ID among a list of regions: i + 1 for regions[i], 0 for IDs in none of them.
+    When regions are nested (e.g. "PAG" and "lpag"), IDs get the label of the deepest region containing them.
+
+    :param atlas: BrainGlobeAtlas
+    :param ids: np.ndarray, structure IDs
+    :param regions: list of str, acronyms of the regions (each includes its descendants)
+    """
+    hierarchy = get_hierarchy_table(atlas)
+    depths = {}
+    for region in regions:
+        try:
+            depths[region] = hierarchy.depths[hierarchy.row_of(region)]
+        except KeyError:
+            print(f"The region {region} doesn't seem to belong to the atlas being used: {atlas.atlas_name}. Skipping")
+
+    # the region test is done once per distinct ID, deepest regions first so that they keep their IDs
+    ids = np.asarray(ids)
+    unique_ids, inverse = np.unique(ids, return_inverse = True)
+    labels = np.zeros(len(unique_ids), dtype = np.min_scalar_type(len(regions)))
+    for region in sorted(depths, key = depths.get, reverse = True):
+        labels[hierarchy.is_within(unique_ids, region) & (labels == 0)] = regions.index(region) + 1
+    return labels[inverse].reshape(ids.shape)
+
+
+# // SUMMARY TABLES //
+def count_by_level(atlas, ids, hierarchy_lev):
+    """
+    Number of cells in each structure after rolling their IDs up to a hierarchy level
+
+    :param atlas: BrainGlobeAtlas
+    :param ids: np.ndarray, structure ID of each cell
+    :param hierarchy_lev: int, hierarchy level (0 is the root)
+    """
+    hierarchy = get_hierarchy_table(atlas)
+    level_ids, counts = np.unique(hierarchy.at_level(ids, hierarchy_lev), return_counts = True)
+    return pd.DataFrame(dict(
+        areaID = level_ids,
+        acronym = hierarchy.acronyms_of(level_ids),
+        n_cells = counts,
+        ))
@@ -0,0 +1,126 @@
+"""
+    Batch version of brainglobe's `structure_from_coords()` to get the structure ID and acronym of many cells at once.
+    https://github.com/brainglobe/bg-atlasapi/blob/3cb46466094a8a0231f67f1666ca0697d525b12f/bg_atlasapi/core.py#L205
+
+    Instead of calling `structure_from_coords()` once per cell and per atlas, the coordinates of all cells are used
+    to index each annotation volume in a single step, and the acronyms are obtained from a single ID->acronym table lookup.
+
+    Example:
+        from bg_atlasapi.bg_atlas import BrainGlobeAtlas
+        from atlas_lookup import structures_from_coords
+
+        atlases = {"allen_atlas_10": BrainGlobeAtlas("allen_mouse_10um"), "kim_atlas_10": BrainGlobeAtlas("kim_mouse_10um")}
+        area_dataframe = structures_from_coords(atlases, pag_data[["CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"]].values)
+"""
+
+import numpy as np
+import pandas as pd
+
+from atlas_hierarchy import get_hierarchy_table, OUTSIDE_ATLAS_ID, OUTSIDE_ATLAS_ACRONYM
+from profiling import stage
+
+
+# // COORDINATES TO VOXELS //
+def coords_to_voxels(atlas, coords, microns = False, rounding = "floor"):
+    """
+    Convert an (N, 3) array of coordinates into integer voxel indices of the atlas annotation volume.
+
+    :param atlas: BrainGlobeAtlas (or any object with `resolution`)
+    :param coords: np.ndarray or list, (N, 3) array of coordinates (or a single triplet)
+    :param microns: bool, if true coordinates are interpreted in microns
+    :param rounding: str, "floor" to take the voxel containing the coordinate (like `structure_from_coords()`)
+        or "nearest" to round to the nearest voxel index
+    """
+    coords = np.atleast_2d(np.asarray(coords, dtype = np.float64))
+    if coords.shape[1] != 3:
+        raise ValueError(f"Coordinates should be an (N, 3) array, not {coords.shape}")
+
+    if microns:
+        coords = coords / np.asarray(atlas.resolution, dtype = np.float64)
+
+    if rounding == "floor":
+        return np.floor(coords).astype(np.int64)
+    elif rounding == "nearest":
+        return np.round(coords).astype(np.int64)
+    else:
+        raise ValueError(f"Rounding should be 'floor' or 'nearest', not {rounding}")
+
+
+# // STRUCTURE IDS //
+def ids_from_coords(atlas, coords, microns = False, rounding = "floor"):
+    """
+    Get the structure ID of each coordinate triplet with a single fancy-index of the annotation volume.
+    Coordinates outside the annotation volume get `OUTSIDE_ATLAS_ID`.
+
+    :param atlas: BrainGlobeAtlas, RegionOfInterest or ResampledAtlas
+    :param coords: np.ndarray, (N, 3) array of coordinates
+    :param microns: bool, if true coordinates are interpreted in microns
+    :param rounding: str, "floor" or "nearest" (see `coords_to_voxels()`)
+    """
+    voxels = coords_to_voxels(atlas, coords, microns = microns, rounding = rounding)
+
+    # cropped (atlas_roi.py) and resampled (atlas_resolution.py) atlases know how to index their own annotation
+    if hasattr(atlas, "ids_from_voxels"):
+        return atlas.ids_from_voxels(voxels)
+    return ids_from_voxels(atlas.annotation, voxels)
+
+
+def ids_from_voxels(annotation, voxels):
+    """
+    Index an annotation volume with an (N, 3) array of integer voxel indices.
+    Voxels outside the volume get `OUTSIDE_ATLAS_ID`.
+
+    :param annotation: np.ndarray, 3D annotation volume
+    :param voxels: np.ndarray, (N, 3) array of integer voxel indices
+    """
+    inside = np.all((voxels >= 0) & (voxels < np.asarray(annotation.shape)), axis = 1)
+    ids = np.full(len(voxels), OUTSIDE_ATLAS_ID, dtype = annotation.dtype)
+    ids[inside] = annotation[voxels[inside, 0], voxels[inside, 1], voxels[inside, 2]]
+    return ids
+
+
+# // STRUCTURE ACRONYMS //
+def acronyms_from_ids(atlas, ids):
+    """
+    Map an array of structure IDs to their acronyms.
+    Only the unique IDs are looked up in the atlas structures, the result is then broadcast back to all cells.
+
+    :param atlas: BrainGlobeAtlas
+    :param ids: np.ndarray, structure IDs
+    """
+    unique_ids, inverse = np.unique(np.asarray(ids), return_inverse = True)
+
+    table = np.empty(len(unique_ids), dtype = object)
+    for n, structure_id in enumerate(unique_ids):
+        try:
+            table[n] = atlas.structures[int(structure_id)]["acronym"]
+        except KeyError:
+            table[n] = OUTSIDE_ATLAS_ACRONYM
+
+    return table[inverse.reshape(-1)]
+
+
+# // MANY ATLASES AT ONCE //
+def structures_from_coords(atlases, coords, microns = False, as_acronym = True, hierarchy_lev = None, rounding = "floor"):
+    """
+    Get the structure ID (and acronym) of every cell for every atlas.
+    Returns a DataFrame with columns `areaID_<atlas name>` and `acronym_<atlas name>`, one row per cell.
+
+    :param atlases: dict of {name: BrainGlobeAtlas}
+    :param coords: np.ndarray, (N, 3) array of coordinates
+    :param microns: bool, if true coordinates are interpreted in microns
+    :param as_acronym: bool, if true the acronym columns are added
+    :param hierarchy_lev: int or None, if specified the IDs are rolled up to their parent at this hierarchy level (see atlas_hierarchy.py)
+    :param rounding: str, "floor" or "nearest" (see `coords_to_voxels()`)
+    """
+    columns = {}
+    for name, atlas in atlases.items():
+        with stage("lookup", atlas = name, cells = len(coords)):
+            ids = ids_from_coords(atlas, coords, microns = microns, rounding = rounding)
+            if hierarchy_lev is not None:
+                ids = get_hierarchy_table(atlas).at_level(ids, hierarchy_lev)
+            columns["areaID_" + name] = ids
+            if as_acronym:
+                columns["acronym_" + name] = acronyms_from_ids(atlas, ids)
+
+    return pd.DataFrame(columns)
@@ -0,0 +1,148 @@
+"""
+    Resolution-aware structure lookups with coordinates in microns.
+
+    Coordinates in microns can be resolved against any installed resolution of an atlas (10, 25 or 50um), with the
+    conversion to voxels (and the rounding) done in one vectorized step instead of dividing by 2.5 and calling `round()`
+    for every cell. Coarser resolutions can also be answered from an already loaded finer atlas through `ResampledAtlas`,
+    a downsampled view of its annotation, so the same atlas does not need to be loaded twice.
+
+    Example:
+        from atlas_volumes import get_atlas
+        from atlas_resolution import ResampledAtlas
+        from atlas_lookup import structures_from_coords
+
+        allen_atlas_10 = get_atlas("allen_mouse_10um")
+        atlases = dict(allen_atlas_10 = allen_atlas_10, allen_atlas_25 = ResampledAtlas(allen_atlas_10, 25))
+        area_dataframe = structures_from_coords(atlases, coordinates_um, microns = True)
+"""
+
+import numpy as np
+
+from atlas_hierarchy import OUTSIDE_ATLAS_ID
+from atlas_lookup import ids_from_voxels, structures_from_coords
+from atlas_volumes import get_atlas, cached_atlas
+
+
+# // DEFAULT SETTINGS //
+RESOLUTIONS = [10, 25, 50] # resolutions (in microns) of the brainglobe mouse atlases
+
+
+# // DOWNSAMPLED VIEW //
+class ResampledAtlas:
+    def __init__(self, atlas, resolution, shape = None):
+        """
+        View of an atlas at a coarser resolution. Each coarse voxel takes the label found at its centre in the source atlas,
+        so lookups index the source annotation directly and no downsampled copy is stored unless `annotation` is requested.
+
+        :param atlas: BrainGlobeAtlas (or RegionOfInterest) at a finer resolution
+        :param resolution: float or 3-tuple, resolution (in microns) of the view
+        :param shape: 3-tuple, shape of the view (e.g. of a gene expression grid). Defaults to the atlas shape divided by the scale
+        """
+        self.source = atlas
+        self.atlas_name = atlas.atlas_name # same ontology as the source atlas
+        self.structures = atlas.structures
+        self.resolution = tuple(float(r) for r in np.broadcast_to(resolution, 3))
+        self.scale = np.asarray(self.resolution) / np.asarray(atlas.resolution, dtype = np.float64)
+        if np.any(self.scale < 1):
+            raise ValueError(f"ResampledAtlas can only downsample: {atlas.resolution}um -> {self.resolution}um")
+
+        if shape is None:
+            shape = [int(round(n / s)) for n, s in zip(_full_shape(atlas), self.scale)]
+        self.shape = tuple(int(n) for n in shape)
+        self._annotation = None
+
+    def __repr__(self):
+        return f"ResampledAtlas of {self.atlas_name} at {self.resolution}um"
+
+    def to_source_voxels(self, voxels):
+        """
+        Source atlas voxel at the centre of each coarse voxel
+
+        :param voxels: np.ndarray, (N, 3) array of integer voxel indices of the view
+        """
+        return np.floor((np.asarray(voxels) + 0.5) * self.scale).astype(np.int64)
+
+    def ids_from_voxels(self, voxels):
+        """
+        Structure ID of each coarse voxel. Voxels outside the view get `OUTSIDE_ATLAS_ID`.
+
+        :param voxels: np.ndarray, (N, 3) array of integer voxel indices of the view
+        """
+        voxels = np.asarray(voxels)
+        inside = np.all((voxels >= 0) & (voxels < np.asarray(self.shape)), axis = 1)
+        source_voxels = self.to_source_voxels(voxels)
+        source_voxels[~inside] = -1 # keep voxels outside the view outside the source too
+
+        if hasattr(self.source, "ids_from_voxels"):
+            return self.source.ids_from_voxels(source_voxels)
+        return ids_from_voxels(self.source.annotation, source_voxels)
+
+    @property
+    def annotation(self):
+        """
+        Downsampled annotation volume, created the first time it is requested
+        """
+        if self._annotation is None:
+            if hasattr(self.source, "offset"):
+                raise ValueError("The annotation of a ResampledAtlas can only be created from a full atlas, not from a RegionOfInterest")
+
+            axes = [np.floor((np.arange(n) + 0.5) * s).astype(np.int64) for n, s in zip(self.shape, self.scale)]
+            sizes = self.source.annotation.shape
+            annotation = np.array(self.source.annotation[np.ix_(*[np.minimum(a, m - 1) for a, m in zip(axes, sizes)])])
+
+            # coarse voxels whose centre falls beyond the source volume (when `shape` is larger than the atlas) are outside the atlas
+            inside = [a < m for a, m in zip(axes, sizes)]
+            outside = ~(inside[0][:, None, None] & inside[1][None, :, None] & inside[2][None, None, :])
+            annotation[outside] = OUTSIDE_ATLAS_ID
+            self._annotation = annotation
+        return self._annotation
+
+
+# // LOOKUPS IN MICRONS //
+def atlas_at_resolution(atlas_name, resolution, downsample = False):
+    """
+    Get an atlas at a given resolution, e.g. atlas_at_resolution("allen_mouse", 25).
+    With `downsample`, a finer resolution of the same atlas that is already loaded is reused through a ResampledAtlas.
+
+    :param atlas_name: str, atlas name without resolution (e.g. "allen_mouse", "kim_mouse")
+    :param resolution: int, resolution in microns (10, 25 or 50)
+    :param downsample: bool, if true answer from an already loaded finer atlas when possible
+    """
+    if downsample:
+        for finer in RESOLUTIONS:
+            loaded = cached_atlas(f"{atlas_name}_{finer}um")
+            if finer < resolution and loaded is not None:
+                return ResampledAtlas(loaded, resolution)
+
+    return get_atlas(f"{atlas_name}_{resolution}um")
+
+
+def structures_from_microns(atlas_names, coords_um, resolutions = RESOLUTIONS, downsample = False, **kwargs):
+    """
+    Look up coordinates in microns in several atlases and resolutions at once.
+    Returns a DataFrame with columns `areaID_<atlas name>_<resolution>` and `acronym_<atlas name>_<resolution>`.
+
+    :param atlas_names: list of str, atlas names without resolution (e.g. ["allen_mouse", "kim_mouse"])
+    :param coords_um: np.ndarray, (N, 3) array of coordinates in microns
+    :param resolutions: list of int, resolutions in microns
+    :param downsample: bool, if true coarser resolutions are answered from an already loaded finer atlas
+    :param kwargs: keyword arguments passed to `structures_from_coords()` (e.g. rounding, hierarchy_lev)
+    """
+    atlases = {}
+    for resolution in sorted(resolutions): # finer atlases first, so they can be reused when downsampling
+        for atlas_name in atlas_names:
+            atlases[f"{atlas_name}_{resolution}"] = atlas_at_resolution(atlas_name, resolution, downsample = downsample)
+
+    return structures_from_coords(atlases, coords_um, microns = True, **kwargs)
+
+
+# // UTILS //
+def _full_shape(atlas):
+    """
+    Shape of the full annotation volume of an atlas (without loading it)
+
+    :param atlas: BrainGlobeAtlas, RegionOfInterest or ResampledAtlas
+    """
+    if hasattr(atlas, "offset"): # a RegionOfInterest covers a part of its atlas, but keeps full-atlas voxel indices
+        return atlas.atlas.shape
+    return atlas.shape
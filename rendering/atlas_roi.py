@@ -0,0 +1,263 @@
+"""
+    Cropped region-of-interest (ROI) subvolumes of a brainglobe atlas for PAG-centric work.
+
+    All the analyses in this repository only care about the PAG and its neighbours, so instead of indexing or meshing the
+    whole-brain annotation volume, we crop the bounding box of a set of structures (plus a margin) once and store it on disk.
+    The crop keeps its voxel offset in the full atlas, so coordinates can be given in full-atlas voxels or microns as usual.
+    ROIs can be passed to the batch lookups in atlas_lookup.py in place of a full atlas.
+
+    Example:
+        from atlas_volumes import get_atlas
+        from atlas_roi import get_roi
+        from atlas_lookup import structures_from_coords
+
+        pag_roi = get_roi(get_atlas("kim_mouse_10um"), regions = ["PAG", "DR", "SCm"], margin = 10)
+        area_dataframe = structures_from_coords(dict(kim_atlas_10 = pag_roi), coordinates_10)
+"""
+
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+from atlas_lookup import ids_from_voxels
+from profiling import stage, cache_hit, cache_miss
+
+
+# // DEFAULT SETTINGS //
+PAG_REGIONS = ["PAG", "DR", "SCm"] # the PAG and its neighbours. Subdivisions (e.g. Kim's dmpag/dlpag/lpag/vlpag) are included as descendants
+ROI_MARGIN = 10 # margin (in voxels) added around the bounding box of the regions
+ROI_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "roi" # where cropped volumes are stored
+BOUNDING_BOX_CHUNK = 64 # number of planes along the first axis scanned at once when computing bounding boxes
+
+
+# // REGION OF INTEREST //
+class RegionOfInterest:
+    def __init__(self, atlas, regions, offset, annotation, reference = None, margin = ROI_MARGIN):
+        """
+        Annotation (and optionally reference) subvolume of an atlas, starting at voxel `offset` of the full volumes.
+
+        :param atlas: BrainGlobeAtlas the ROI was cropped from (used for its structures and resolution)
+        :param regions: list of str, acronyms of the regions contained in the ROI
+        :param offset: 3-tuple of int, voxel index of the ROI origin in the full atlas
+        :param annotation: np.ndarray, cropped annotation volume
+        :param reference: np.ndarray or None, cropped reference volume
+        :param margin: int, margin (in voxels) added around the bounding box of the regions
+        """
+        self.atlas = atlas
+        self.atlas_name = atlas.atlas_name
+        self.structures = atlas.structures
+        self.resolution = atlas.resolution
+        self.regions = list(regions)
+        self.margin = margin
+        self.offset = np.asarray(offset, dtype = np.int64)
+        self.annotation = annotation
+        self.reference = reference
+
+    def __repr__(self):
+        return f"RegionOfInterest of {self.atlas_name} around {self.regions}: shape {self.shape} at offset {self.offset.tolist()}"
+
+    @property
+    def shape(self):
+        return self.annotation.shape
+
+    @property
+    def origin_um(self):
+        """
+        Position of the ROI origin in microns in the atlas space
+        """
+        return self.offset * np.asarray(self.resolution)
+
+    @property
+    def fraction_of_atlas(self):
+        """
+        Size of the ROI relative to the full annotation volume
+        """
+        return np.prod(self.shape) / np.prod(self.atlas.shape)
+
+    def contains(self, voxels):
+        """
+        Check which full-atlas voxel indices fall inside the ROI
+
+        :param voxels: np.ndarray, (N, 3) array of integer voxel indices
+        """
+        local = np.asarray(voxels) - self.offset
+        return np.all((local >= 0) & (local < np.asarray(self.shape)), axis = 1)
+
+    def ids_from_voxels(self, voxels):
+        """
+        Structure ID at each full-atlas voxel index. Voxels outside the ROI get `OUTSIDE_ATLAS_ID`.
+
+        :param voxels: np.ndarray, (N, 3) array of integer voxel indices in the full atlas
+        """
+        return ids_from_voxels(self.annotation, np.asarray(voxels) - self.offset)
+
+    def region_mask(self, region):
+        """
+        Boolean mask (in ROI voxels) of a region and all its descendants
+
+        :param region: str or int, acronym or ID of the region
+        """
+        return np.isin(self.annotation, _descendant_ids(self.atlas, [region]))
+
+    def region_mesh(self, region, smooth = True, decimate = None):
+        """
+        Create a vedo Mesh of a region from the cropped annotation, placed in the atlas space (microns).
+
+        :param region: str or int, acronym or ID of the region
+        :param smooth: bool, if true the mesh is smoothed
+        :param decimate: float or None, if given the fraction of triangles to keep
+        """
+        from vedo import Volume
+
+        mask = self.region_mask(region).astype(np.uint8)
+        mesh = Volume(mask, spacing = self.resolution, origin = self.origin_um).isosurface(0.5)
+        if smooth:
+            mesh.smoothLaplacian()
+        if decimate is not None:
+            mesh.decimate(fraction = decimate)
+        return mesh
+
+    # // SAVE AND LOAD //
+    def save(self, filepath):
+        """
+        Save the cropped volumes and their offset to a compressed .npz file
+
+        :param filepath: str, Path
+        """
+        arrays = dict(offset = self.offset, annotation = np.asarray(self.annotation), regions = np.array(self.regions), margin = self.margin)
+        if self.reference is not None:
+            arrays["reference"] = np.asarray(self.reference)
+
+        filepath = Path(filepath)
+        filepath.parent.mkdir(parents = True, exist_ok = True)
+        tmp_file = filepath.with_suffix(".tmp.npz")
+        np.savez_compressed(tmp_file, **arrays)
+        tmp_file.replace(filepath) # only complete files end up in the cache
+
+    @classmethod
+    def load(cls, filepath, atlas):
+        """
+        Load an ROI saved with `save()`
+
+        :param filepath: str, Path
+        :param atlas: BrainGlobeAtlas the ROI was cropped from
+        """
+        with np.load(filepath) as data:
+            return cls(
+                atlas,
+                regions = data["regions"].tolist(),
+                offset = data["offset"],
+                annotation = data["annotation"],
+                reference = data["reference"] if "reference" in data.files else None,
+                margin = int(data["margin"]),
+                )
+
+    @classmethod
+    def from_atlas(cls, atlas, regions = PAG_REGIONS, margin = ROI_MARGIN, with_reference = False):
+        """
+        Crop the bounding box of a set of regions (and their descendants) out of an atlas
+
+        :param atlas: BrainGlobeAtlas
+        :param regions: list of str, acronyms of the regions to include
+        :param margin: int, margin (in voxels) added around the bounding box
+        :param with_reference: bool, if true the reference volume is cropped too
+        """
+        ids = _descendant_ids(atlas, regions)
+        if not len(ids):
+            raise ValueError(f"None of the regions {regions} belong to the atlas being used: {atlas.atlas_name}")
+
+        start, stop = _bounding_box(atlas.annotation, ids)
+        start = np.maximum(start - margin, 0)
+        stop = np.minimum(stop + margin, atlas.annotation.shape)
+        crop = tuple(slice(a, b) for a, b in zip(start, stop))
+
+        return cls(
+            atlas,
+            regions = regions,
+            offset = start,
+            annotation = np.array(atlas.annotation[crop]),
+            reference = np.array(atlas.reference[crop]) if with_reference else None,
+            margin = margin,
+            )
+
+
+# // CACHE //
+def get_roi(atlas, regions = PAG_REGIONS, margin = ROI_MARGIN, with_reference = False, roi_folder = ROI_FOLDER):
+    """
+    Get the ROI of an atlas around some regions, cropping it and saving it to disk the first time it is requested.
+    Cached ROIs are keyed by atlas name (including its version), regions and margin, so they are shared across scripts and notebooks.
+
+    :param atlas: BrainGlobeAtlas
+    :param regions: list of str, acronyms of the regions to include
+    :param margin: int, margin (in voxels) added around the bounding box
+    :param with_reference: bool, if true the reference volume is cropped too
+    :param roi_folder: str, Path. Where cropped volumes are stored
+    """
+    filepath = Path(roi_folder) / roi_filename(atlas, regions, margin, with_reference)
+    if filepath.exists():
+        cache_hit("roi")
+        return RegionOfInterest.load(filepath, atlas)
+
+    cache_miss("roi")
+    with stage("roi.crop", atlas = atlas.atlas_name, regions = list(regions)):
+        roi = RegionOfInterest.from_atlas(atlas, regions = regions, margin = margin, with_reference = with_reference)
+        roi.save(filepath)
+    return roi
+
+
+def roi_filename(atlas, regions, margin, with_reference = False):
+    """
+    File name of a cached ROI
+
+    :param atlas: BrainGlobeAtlas
+    :param regions: list of str, acronyms of the regions included
+    :param margin: int, margin (in voxels) added around the bounding box
+    :param with_reference: bool, if true the reference volume is cropped too
+    """
+    atlas_name = getattr(atlas, "local_full_name", None) or atlas.atlas_name # includes the atlas version when available
+    key = "-".join(sorted(str(r) for r in regions)) + f"_margin{margin}" + ("_reference" if with_reference else "")
+    return f"{atlas_name}_{hashlib.sha1(key.encode()).hexdigest()[:12]}.npz"
+
+
+# // UTILS //
+def _descendant_ids(atlas, regions):
+    """
+    IDs of a set of regions and all their descendants in the atlas hierarchy
+
+    :param atlas: BrainGlobeAtlas
+    :param regions: list of str or int, acronyms or IDs of the regions
+    """
+    region_ids = []
+    for region in regions:
+        try:
+            region_ids.append(atlas.structures[region]["id"])
+        except KeyError:
+            print(f"The region {region} doesn't seem to belong to the atlas being used: {atlas.atlas_name}. Skipping")
+
+    region_ids = set(region_ids)
+    return np.array([s["id"] for s in atlas.structures.values() if region_ids.intersection(s["structure_id_path"])], dtype = np.int64)
+
+
+def _bounding_box(annotation, ids, chunk = BOUNDING_BOX_CHUNK):
+    """
+    Bounding box (start, stop voxel indices) of the voxels labelled with any of `ids`.
+    The volume is scanned in chunks of planes to keep memory bounded on 10um atlases.
+
+    :param annotation: np.ndarray, 3D annotation volume
+    :param ids: np.ndarray, structure IDs
+    :param chunk: int, number of planes along the first axis scanned at once
+    """
+    found = [np.zeros(n, dtype = bool) for n in annotation.shape]
+    for i in range(0, annotation.shape[0], chunk):
+        mask = np.isin(annotation[i:i + chunk], ids)
+        found[0][i:i + chunk] = mask.any(axis = (1, 2))
+        found[1] |= mask.any(axis = (0, 2))
+        found[2] |= mask.any(axis = (0, 1))
+
+    if not found[0].any():
+        raise ValueError("None of the regions are present in the annotation volume")
+
+    start = np.array([np.argmax(f) for f in found])
+    stop = np.array([len(f) - np.argmax(f[::-1]) for f in found])
+    return start, stop
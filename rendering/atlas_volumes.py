@@ -0,0 +1,195 @@
+"""
+    Memory-mapped, lazily loaded brainglobe atlases with a process-wide LRU cache.
+
+    The first time a volume is used, its tiff file is converted to an uncompressed .npy file next to the brainglobe atlases,
+    one plane at a time, so the conversion itself never holds more than a plane in memory.
+    From then on, `atlas.reference` and `atlas.annotation` are read-only memory-mapped arrays: opening an atlas takes
+    seconds and only the pages that are actually touched (e.g. the voxels around the registered cells) become resident.
+
+    Atlases are shared through `get_atlas()`, which keeps them open. With a budget set (`set_cache_budget()`), whole atlases
+    are evicted, least recently used first, once the mapped volumes exceed it. The budget counts the size of the mapped
+    volumes, not their resident pages: the OS reclaims untouched or clean pages of mapped files by itself, so the budget
+    only limits how much address space and how many open files the cached atlases hold. A single 10um atlas maps about
+    7 GB (4.8 GB of annotation and 2.4 GB of reference), so a budget smaller than the atlases used together makes them
+    be evicted and mapped again over and over.
+
+    There is no cap on resident memory: touched pages of the mapped volumes count in the process' resident size until the
+    OS reclaims them. They are clean, file-backed pages that can be dropped under memory pressure (also within a container's
+    memory limit) rather than leading to out-of-memory errors, but a script that scans whole 10um volumes on a 4 GB worker
+    will keep re-reading them from disk. Keeping resident memory under a fixed budget is not enforced here.
+
+    Example:
+        from atlas_volumes import get_atlas
+        allen_atlas_10 = get_atlas("allen_mouse_10um")
+        allen_atlas_10.annotation[660, 400, 570]
+"""
+
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from bg_atlasapi.bg_atlas import BrainGlobeAtlas
+import tifffile
+
+from profiling import stage, cache_hit, cache_miss
+
+
+# // DEFAULT SETTINGS //
+MAX_CACHE_BYTES = None # byte budget of the mapped (not resident) volumes of all the cached atlases, None keeps all atlases open
+MEMMAP_DIRNAME = "memmap" # folder inside brainglobe's directory where the .npy copies of the volumes are stored
+
+_atlases = OrderedDict() # {atlas_name: MemmapAtlas}, least recently used first
+
+
+# // MEMORY-MAPPED ATLAS //
+class MemmapAtlas(BrainGlobeAtlas):
+    def __init__(self, atlas_name, **kwargs):
+        """
+        BrainGlobeAtlas whose reference and annotation volumes are read-only memory-mapped arrays.
+        All other BrainGlobeAtlas methods (e.g. `structure_from_coords()`) work as usual on top of them.
+
+        :param atlas_name: str, atlas name from brainglobe's atlas API atlases
+        :param kwargs: keyword arguments passed to BrainGlobeAtlas
+        """
+        kwargs.setdefault("check_latest", False) # avoid waiting for the remote server
+        kwargs.setdefault("print_authors", False)
+        BrainGlobeAtlas.__init__(self, atlas_name, **kwargs)
+
+        self.memmap_dir = Path(self.brainglobe_dir) / MEMMAP_DIRNAME / self.local_full_name
+
+    @property
+    def reference(self):
+        if self._reference is None:
+            self._reference = self._memmap("reference")
+            _mark_used(self)
+        return self._reference
+
+    @property
+    def annotation(self):
+        if self._annotation is None:
+            self._annotation = self._memmap("annotation")
+            _mark_used(self)
+        return self._annotation
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes of the volumes currently mapped (their full size, whether or not their pages are resident)
+        """
+        return sum(v.nbytes for v in (self._reference, self._annotation) if v is not None)
+
+    def _memmap(self, volume_name):
+        """
+        Map a volume, converting it from tiff to .npy the first time it is used
+
+        :param volume_name: str, "reference" or "annotation"
+        """
+        npy_file = self.memmap_dir / f"{volume_name}.npy"
+        if not npy_file.exists():
+            self.memmap_dir.mkdir(parents = True, exist_ok = True)
+            tmp_file = self.memmap_dir / f"{volume_name}.tmp.npy"
+            _tiff_to_npy(self.root_dir / f"{volume_name}.tiff", tmp_file)
+            tmp_file.replace(npy_file) # only complete files end up in the cache
+
+        return np.load(npy_file, mmap_mode = "r")
+
+    def release(self):
+        """
+        Drop the references to the mapped volumes. They are unmapped once no other array refers to them.
+        """
+        self._reference = None
+        self._annotation = None
+        self._hemispheres = None
+
+
+def _tiff_to_npy(tiff_file, npy_file):
+    """
+    Write the volume of a tiff file to an .npy file one plane (tiff page) at a time, without loading the whole volume
+
+    :param tiff_file: str, Path
+    :param npy_file: str, Path
+    """
+    with tifffile.TiffFile(tiff_file) as tif:
+        series = tif.series[0]
+        volume = np.lib.format.open_memmap(npy_file, mode = "w+", dtype = series.dtype, shape = series.shape)
+        if len(series.pages) == series.shape[0]:
+            for i, page in enumerate(series.pages):
+                volume[i] = page.asarray()
+        else: # not one page per plane (e.g. a single page with the whole volume)
+            volume[:] = series.asarray()
+        volume.flush()
+        del volume
+
+
+# // LRU CACHE //
+def get_atlas(atlas_name):
+    """
+    Get a MemmapAtlas from the process-wide cache, opening it if needed
+
+    :param atlas_name: str, atlas name from brainglobe's atlas API atlases
+    """
+    atlas = _atlases.get(atlas_name)
+    if atlas is None:
+        cache_miss("atlas")
+        with stage("atlas.open", atlas = atlas_name):
+            atlas = MemmapAtlas(atlas_name)
+    else:
+        cache_hit("atlas")
+    _mark_used(atlas)
+    return atlas
+
+
+def cached_atlas(atlas_name):
+    """
+    Get an atlas only if it is already in the cache, without opening it
+
+    :param atlas_name: str, atlas name from brainglobe's atlas API atlases
+    """
+    return _atlases.get(atlas_name)
+
+
+def set_cache_budget(max_bytes):
+    """
+    Change the byte budget of the atlas cache and evict atlases if needed
+
+    :param max_bytes: int, maximum number of bytes of mapped volumes (e.g. 16 * 1024 ** 3 for two 10um atlases), None for no budget
+    """
+    global MAX_CACHE_BYTES
+    MAX_CACHE_BYTES = max_bytes
+    _enforce_budget()
+
+
+def clear_cache():
+    """
+    Release all cached atlases
+    """
+    while _atlases:
+        _, atlas = _atlases.popitem(last = False)
+        atlas.release()
+
+
+def _mark_used(atlas):
+    """
+    Move an atlas to the most recently used end of the cache (re-adding it if it had been evicted)
+
+    :param atlas: MemmapAtlas
+    """
+    _atlases[atlas.atlas_name] = atlas
+    _atlases.move_to_end(atlas.atlas_name)
+    _enforce_budget(keep = atlas)
+
+
+def _enforce_budget(keep = None):
+    """
+    Evict the least recently used atlases until the mapped volumes fit in MAX_CACHE_BYTES
+
+    :param keep: MemmapAtlas that should never be evicted (the one being used)
+    """
+    if MAX_CACHE_BYTES is None:
+        return
+    for atlas_name in list(_atlases.keys()):
+        if sum(a.nbytes for a in _atlases.values()) <= MAX_CACHE_BYTES:
+            break
+        if _atlases[atlas_name] is keep:
+            continue
+        _atlases.pop(atlas_name).release()
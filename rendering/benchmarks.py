@@ -0,0 +1,309 @@
+"""
+    Offline benchmark suite of the lookups, meshes, actors, slicing and rendering used by the PAG scripts.
+
+    All benchmarks run against a SyntheticAtlas and synthetic cells, streamlines and neurons (see synthetic_atlas.py),
+    so they need no downloaded atlas and no network, and give comparable numbers across machines and commits:
+
+        lookup          coordinate -> structure lookup (`structures_from_coords()`) for 10^3 to 10^7 points
+        region_mesh     region mesh load from the multi-LOD mesh cache, cold (generating the levels) and warm
+        point_cloud     single point-sprite actor of many cells (`CellCloud`) and recoloring by a column
+        streamlines     merged streamlines actor and recoloring by experiment
+        neuron_meshes   tube and soma meshes of a synthetic neuron
+        slicing         stack of virtual sections with the reference volume and the contours of a subdivision
+        rendering       offscreen frames of a scene with the PAG subdivisions, cells and streamlines
+
+    Each benchmark reports the median, minimum and maximum time over a number of repeats. Results are written as JSON
+    and can be compared with a baseline (the JSON of an earlier run): a benchmark slower than the baseline by more than
+    the threshold (e.g. 25%) is a regression, and a benchmark of the baseline that did not run is missing: in both cases the
+    script exits with an error. Groups whose dependencies are not installed (e.g. vtk for the actors) are reported as skipped,
+    as are the baseline's benchmarks of groups that were skipped or left out with --only; any other error fails the run.
+
+    Example:
+        python benchmarks.py --output baseline.json # on the reference commit
+        python benchmarks.py --output results.json --baseline baseline.json --threshold 0.25
+        python benchmarks.py --only lookup slicing --max-points 1e6
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing import cpu_count
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from synthetic_atlas import SyntheticAtlas, synthetic_cells, synthetic_metadata, synthetic_streamlines, synthetic_neuron
+
+
+# // DEFAULT SETTINGS //
+BENCHMARKS_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "benchmarks" # where results are written by default
+RESOLUTION = 25 # resolution (in microns) of the synthetic atlas
+LOOKUP_SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7] # number of points looked up
+REPEATS = 5 # number of timed runs of each benchmark (after one untimed warm-up run)
+REGRESSION_THRESHOLD = 0.25 # relative slowdown (vs the baseline) reported as a regression
+MIN_DURATION = 0.001 # benchmarks faster than this (in seconds) in the baseline are not compared (timer noise)
+N_CELLS = [10 ** 4, 10 ** 5, 10 ** 6] # number of cells of the point cloud
+N_FRAMES = 30 # number of frames rendered
+
+
+# // TIMING //
+def time_it(function, repeats = REPEATS, warmup = True, setup = None):
+    """
+    Time a function, returning the median, minimum and maximum wall time (in seconds) over the repeats
+
+    :param function: callable without arguments (or taking the value returned by setup)
+    :param repeats: int, number of timed runs
+    :param warmup: bool, if true the function is run once before the timed runs
+    :param setup: callable run (untimed) before each run, its return value is passed to the function
+    """
+    arguments = lambda: (setup(),) if setup is not None else ()
+    if warmup:
+        function(*arguments())
+    times = []
+    for _ in range(repeats):
+        args = arguments()
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return dict(median_s = float(np.median(times)), min_s = float(np.min(times)), max_s = float(np.max(times)), repeats = repeats)
+
+
+# // BENCHMARKS //
+def bench_lookup(atlas, repeats = REPEATS, max_points = max(LOOKUP_SIZES), **kwargs):
+    from atlas_lookup import structures_from_coords
+
+    results = {}
+    atlas.annotation # generated before timing
+    for n_points in [n for n in LOOKUP_SIZES if n <= max_points]:
+        coords = synthetic_cells(atlas, n_points)
+        timing = time_it(lambda: structures_from_coords(dict(synthetic = atlas), coords, microns = True), repeats = repeats)
+        results[f"lookup_{_size_label(n_points)}"] = dict(timing, points = n_points, points_per_s = n_points / timing["median_s"])
+    return results
+
+
+def bench_region_mesh(atlas, repeats = REPEATS, **kwargs):
+    import mesh_cache
+
+    results = {}
+    for region in ("root", "PAG", "lpag"):
+        atlas.meshfile_from_structure(region) # the .obj files stand for the atlas meshes, they are not part of the timing
+        folder = Path(tempfile.mkdtemp(prefix = "mesh_cache_"))
+        try:
+            cold = lambda _: mesh_cache.region_mesh(atlas, region, quality = "high", cache_folder = folder)
+            clear = lambda: shutil.rmtree(folder / atlas.local_full_name, ignore_errors = True)
+            results[f"region_mesh_cold_{region}"] = time_it(cold, repeats = max(1, repeats // 2), warmup = False, setup = clear)
+            cold(None)
+            for quality in ("high", "low"):
+                warm = lambda: mesh_cache.region_mesh(atlas, region, quality = quality, cache_folder = folder)
+                results[f"region_mesh_warm_{region}_{quality}"] = time_it(warm, repeats = repeats)
+        finally:
+            shutil.rmtree(folder, ignore_errors = True)
+    return results
+
+
+def bench_point_cloud(atlas, repeats = REPEATS, **kwargs):
+    from cell_cloud import CellCloud
+
+    results = {}
+    for n_cells in N_CELLS:
+        metadata = synthetic_metadata(atlas, n_cells)
+        results[f"point_cloud_build_{_size_label(n_cells)}"] = time_it(lambda: CellCloud(metadata, scale = 10), repeats = repeats)
+        cloud = CellCloud(metadata, scale = 10)
+        results[f"point_cloud_color_{_size_label(n_cells)}"] = time_it(lambda: cloud.color_by("cell.type"), repeats = repeats)
+    return results
+
+
+def bench_streamlines(atlas, repeats = REPEATS, **kwargs):
+    from streamline_cache import streamlines_actor, color_by_experiment
+
+    streamlines = synthetic_streamlines(atlas, n_experiments = 50, lines_per_experiment = 50, points_per_line = 100)
+    colors = {eid: ("salmon" if i % 2 else "skyblue") for i, eid in enumerate(streamlines)}
+    actor = streamlines_actor(streamlines)
+    return dict(
+        streamlines_actor = time_it(lambda: streamlines_actor(streamlines), repeats = repeats),
+        streamlines_color = time_it(lambda: color_by_experiment(actor, colors), repeats = repeats))
+
+
+def bench_neuron_meshes(atlas, repeats = REPEATS, **kwargs):
+    from neuron_store import tube_mesh, sphere_mesh
+
+    points, parents = synthetic_neuron(atlas, n_nodes = 20000)
+    return dict(
+        neuron_tubes = dict(time_it(lambda: tube_mesh(points, parents), repeats = repeats), nodes = len(points)),
+        neuron_soma = time_it(lambda: sphere_mesh(points[0]), repeats = repeats))
+
+
+def bench_slicing(atlas, repeats = REPEATS, **kwargs):
+    from virtual_sections import section_stack
+
+    atlas.annotation
+    stack = lambda: section_stack(atlas, normal = "AP", thickness = 50, regions = ["PAG"], with_reference = True)
+    sections = stack()
+    oblique = lambda: section_stack(atlas, normal = (1, 0.3, 0), thickness = 50, regions = ["PAG"])
+    return dict(
+        slicing_stack = dict(time_it(stack, repeats = repeats), sections = len(sections)),
+        slicing_oblique = time_it(oblique, repeats = repeats),
+        slicing_contours = time_it(lambda: sections.contours("lpag"), repeats = repeats))
+
+
+def bench_rendering(atlas, repeats = REPEATS, n_frames = N_FRAMES, **kwargs):
+    from vedo import Plotter, load
+    from cell_cloud import CellCloud
+    from streamline_cache import streamlines_actor
+
+    meshes = [load(str(atlas.meshfile_from_structure(region))).alpha(0.4) for region in ("dmpag", "dlpag", "lpag", "vlpag")]
+    cells = CellCloud(synthetic_metadata(atlas, 100000), scale = 10)
+    streamlines = streamlines_actor(synthetic_streamlines(atlas))
+
+    plotter = Plotter(offscreen = True, size = (1200, 900))
+    plotter.show(*meshes, cells.mesh, streamlines.mesh, interactive = False)
+    window, camera = plotter.window, plotter.renderer.GetActiveCamera()
+
+    def frames():
+        for _ in range(n_frames):
+            camera.Azimuth(360 / n_frames)
+            window.Render()
+
+    timing = time_it(frames, repeats = repeats)
+    plotter.close()
+    return dict(rendering_frames = dict(timing, frames = n_frames, frame_s = timing["median_s"] / n_frames))
+
+
+BENCHMARKS = dict(lookup = bench_lookup, region_mesh = bench_region_mesh, point_cloud = bench_point_cloud, streamlines = bench_streamlines,
+    neuron_meshes = bench_neuron_meshes, slicing = bench_slicing, rendering = bench_rendering)
+
+
+# // SUITE //
+def run_benchmarks(only = None, resolution = RESOLUTION, repeats = REPEATS, max_points = max(LOOKUP_SIZES), verbose = True):
+    """
+    Run the benchmarks against a synthetic atlas. Returns {"meta": {...}, "results": {benchmark: timing}}
+
+    :param only: list of str, groups of benchmarks to run (keys of BENCHMARKS, defaults to all)
+    :param resolution: float, resolution (in microns) of the synthetic atlas
+    :param repeats: int, number of timed runs of each benchmark
+    :param max_points: int, largest number of points looked up
+    :param verbose: bool, if true each result is printed
+    """
+    atlas = SyntheticAtlas(resolution)
+    results, groups, skipped = {}, {}, {}
+    for group in only or BENCHMARKS:
+        try:
+            group_results = BENCHMARKS[group](atlas, repeats = repeats, max_points = max_points)
+        except ImportError as e: # e.g. vtk is not installed, other errors fail the run
+            skipped[group] = f"{type(e).__name__}: {e}"
+            if verbose:
+                print(f"{group:<36} skipped ({skipped[group]})")
+            continue
+        results.update(group_results)
+        groups[group] = list(group_results)
+        if verbose:
+            for name, result in group_results.items():
+                print(f"{name:<36} {1000 * result['median_s']:10.2f}ms (min {1000 * result['min_s']:.2f}ms, max {1000 * result['max_s']:.2f}ms)")
+
+    meta = dict(date = datetime.now().isoformat(timespec = "seconds"), atlas = atlas.atlas_name, repeats = repeats,
+        python = platform.python_version(), numpy = np.__version__, pandas = pd.__version__,
+        platform = platform.platform(), processor = platform.processor(), cpu_count = cpu_count(), groups = groups, skipped = skipped)
+    return dict(meta = meta, results = results)
+
+
+def compare(results, baseline, threshold = REGRESSION_THRESHOLD, thresholds = None):
+    """
+    Compare results with a baseline, as a DataFrame with the ratio of the median times and the status of each benchmark:
+    "regression" (slower by more than the threshold), "faster" (faster by more than the threshold), "ok", "new",
+    "missing" (in the baseline but not in the results although its group ran) or "skipped" (its group did not run)
+
+    :param results: dict, as returned by `run_benchmarks()` (or read from its JSON)
+    :param baseline: dict, results of an earlier run
+    :param threshold: float, relative slowdown reported as a regression
+    :param thresholds: dict of {benchmark: threshold} overriding the threshold of some benchmarks
+    """
+    thresholds = thresholds or {}
+    current, reference = results["results"], baseline["results"]
+    ran = results["meta"].get("groups", {})
+    group_of = {name: group for group, names in baseline["meta"].get("groups", {}).items() for name in names}
+    rows = []
+    for name in list(reference) + [n for n in current if n not in reference]:
+        limit = thresholds.get(name, threshold)
+        before = reference.get(name, {}).get("median_s")
+        after = current.get(name, {}).get("median_s")
+        if before is None:
+            status, ratio = "new", np.nan
+        elif after is None:
+            status, ratio = ("missing" if group_of.get(name) in ran or name not in group_of else "skipped"), np.nan
+        else:
+            ratio = after / before
+            if before < MIN_DURATION:
+                status = "ok"
+            elif ratio > 1 + limit:
+                status = "regression"
+            elif ratio < 1 / (1 + limit):
+                status = "faster"
+            else:
+                status = "ok"
+        rows.append(dict(benchmark = name, baseline_s = before, median_s = after, ratio = ratio, threshold = limit, status = status))
+    return pd.DataFrame(rows).set_index("benchmark")
+
+
+def save_results(results, filepath):
+    """
+    Write results as JSON
+
+    :param results: dict, as returned by `run_benchmarks()`
+    :param filepath: str, Path
+    """
+    filepath = Path(filepath)
+    filepath.parent.mkdir(parents = True, exist_ok = True)
+    tmp_file = filepath.with_name(filepath.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(results, f, indent = 2)
+    tmp_file.replace(filepath)
+
+
+def load_results(filepath):
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def _size_label(n):
+    """
+    Short label of a power of ten (e.g. 1e5)
+    """
+    return f"1e{int(round(np.log10(n)))}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run the offline benchmarks against a synthetic atlas and compare them with a baseline")
+    parser.add_argument("--only", nargs = "+", choices = list(BENCHMARKS), help = "groups of benchmarks to run (defaults to all)")
+    parser.add_argument("--output", default = None, help = "JSON file of the results (defaults to BENCHMARKS_FOLDER/<date and time>.json)")
+    parser.add_argument("--baseline", default = None, help = "JSON file of the results of an earlier run to compare with")
+    parser.add_argument("--threshold", type = float, default = REGRESSION_THRESHOLD, help = "relative slowdown reported as a regression")
+    parser.add_argument("--thresholds", default = None, help = "JSON file of {benchmark: threshold} overriding the threshold of some benchmarks")
+    parser.add_argument("--resolution", type = float, default = RESOLUTION, help = "resolution (in microns) of the synthetic atlas")
+    parser.add_argument("--repeats", type = int, default = REPEATS, help = "number of timed runs of each benchmark")
+    parser.add_argument("--max-points", type = float, default = max(LOOKUP_SIZES), help = "largest number of points looked up")
+    args = parser.parse_args()
+
+    results = run_benchmarks(only = args.only, resolution = args.resolution, repeats = args.repeats, max_points = int(args.max_points))
+    output = Path(args.output) if args.output else BENCHMARKS_FOLDER / f"benchmarks_{datetime.now():%Y%m%d_%H%M%S}.json"
+    save_results(results, output)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        thresholds = load_results(args.thresholds) if args.thresholds else None
+        comparison = compare(results, load_results(args.baseline), threshold = args.threshold, thresholds = thresholds)
+        with pd.option_context("display.max_rows", None, "display.width", 200, "display.float_format", "{:.4f}".format):
+            print(comparison)
+        regressions = comparison.index[comparison["status"] == "regression"].tolist()
+        missing = comparison.index[comparison["status"] == "missing"].tolist()
+        if regressions:
+            print(f"{len(regressions)} regressions: {regressions}")
+        if missing:
+            print(f"{len(missing)} missing: {missing}")
+        if regressions or missing:
+            sys.exit(1)
@@ -0,0 +1,219 @@
+"""
+    Distance of cells to the borders between PAG subdivisions, from distance transforms precomputed on the PAG ROI.
+
+    How much to trust the subdivision of a cell depends on how close it sits to a dmpag/dlpag/lpag/vlpag border. Instead
+    of measuring distances to region meshes cell by cell, the ROI around the PAG (see atlas_roi.py) is labelled once by
+    subdivision, and a Euclidean distance transform of each label gives, for every voxel, the distance to the nearest
+    voxel with another label and that label. These fields are cached on disk per atlas and subdivisions, and reading them
+    for any number of cells is a single lookup.
+
+    Distances are measured to the border, half-way between voxel centres: a voxel next to another subdivision is half a
+    voxel away from it. Signed distance fields of single subdivisions (positive inside, negative outside) are also available.
+
+    Example:
+        from boundary_distances import get_boundary_distances
+        distances = get_boundary_distances(get_atlas("kim_mouse_10um"), subdivisions = ["dmpag", "dlpag", "lpag", "vlpag"])
+        borders = distances.query(coordinates_um, microns = True) # subdivision, boundary_distance (um) and neighbour of each cell
+"""
+
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from atlas_hierarchy import region_labels
+from atlas_lookup import coords_to_voxels
+from atlas_roi import get_roi, ROI_MARGIN
+from profiling import stage, cache_hit, cache_miss
+
+
+# // DEFAULT SETTINGS //
+PAG_SUBDIVISIONS = ["dmpag", "dlpag", "lpag", "vlpag"] # subdivisions of the PAG in the kim atlas
+DISTANCES_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "distances" # where distance fields are stored
+OTHER_LABEL = "other" # label of the voxels outside all subdivisions (e.g. the aqueduct or the regions around the PAG)
+
+
+# // DISTANCE FIELDS //
+class BoundaryDistances:
+    def __init__(self, atlas, subdivisions, offset, labels, distance, neighbour, folder = None):
+        """
+        Subdivision of each voxel of a ROI, distance (in microns) to the nearest voxel of another subdivision and that subdivision
+
+        :param atlas: BrainGlobeAtlas the ROI was cropped from
+        :param subdivisions: list of str, acronyms of the subdivisions (label i + 1 is subdivisions[i], label 0 is OTHER_LABEL)
+        :param offset: 3-tuple of int, voxel index of the ROI origin in the full atlas
+        :param labels: np.ndarray, 3D uint8 label of each voxel
+        :param distance: np.ndarray, 3D float32 distance (in microns) of each voxel to the border of its label
+        :param neighbour: np.ndarray, 3D uint8 label on the other side of that border
+        :param folder: Path, folder of the cached fields (signed distance fields are cached there)
+        """
+        self.atlas = atlas
+        self.subdivisions = list(subdivisions)
+        self.names = np.array([OTHER_LABEL] + self.subdivisions, dtype = object)
+        self.offset = np.asarray(offset, dtype = np.int64)
+        self.resolution = np.asarray(atlas.resolution, dtype = np.float64)
+        self.labels, self.distance, self.neighbour = labels, distance, neighbour
+        self.folder = folder
+
+    def __repr__(self):
+        return f"BoundaryDistances of {self.subdivisions} in {self.atlas.atlas_name}: shape {self.labels.shape} at offset {self.offset.tolist()}"
+
+    def query(self, coords, microns = False, rounding = "floor"):
+        """
+        Subdivision of each cell, distance (in microns) to its nearest border and subdivision on the other side of the border,
+        as a DataFrame with columns subdivision, boundary_distance and neighbour. Cells outside the ROI get NaN distances.
+
+        :param coords: np.ndarray, (N, 3) array of coordinates
+        :param microns: bool, if true coordinates are interpreted in microns (otherwise in voxels of the atlas)
+        :param rounding: str, "floor" or "nearest" (see `coords_to_voxels()`)
+        """
+        voxels = coords_to_voxels(self.atlas, coords, microns = microns, rounding = rounding) - self.offset
+        inside = np.all((voxels >= 0) & (voxels < np.asarray(self.labels.shape)), axis = 1)
+        index = tuple(voxels[inside].T)
+
+        labels = np.zeros(len(voxels), dtype = np.uint8)
+        neighbours = np.zeros(len(voxels), dtype = np.uint8)
+        distances = np.full(len(voxels), np.nan, dtype = np.float32)
+        labels[inside], neighbours[inside], distances[inside] = self.labels[index], self.neighbour[index], self.distance[index]
+        return pd.DataFrame(dict(subdivision = self.names[labels], boundary_distance = distances, neighbour = self.names[neighbours]))
+
+    def signed_distance(self, subdivision):
+        """
+        Signed distance field (in microns) of a subdivision over the ROI: positive inside, negative outside, 0 on its border
+
+        :param subdivision: str, acronym of one of the subdivisions
+        """
+        label = self.subdivisions.index(subdivision) + 1
+        filepath = self.folder / f"signed_{subdivision}.npy" if self.folder is not None else None
+        if filepath is not None and filepath.exists():
+            return np.load(filepath, mmap_mode = "r")
+
+        field = _signed_distance(np.asarray(self.labels) == label, self.resolution)
+        if filepath is not None:
+            tmp_file = filepath.with_name(filepath.name + ".tmp")
+            with open(tmp_file, "wb") as f:
+                np.save(f, field)
+            tmp_file.replace(filepath)
+        return field
+
+    def signed_distance_at(self, coords, subdivision, microns = False, rounding = "floor"):
+        """
+        Signed distance (in microns) of each cell to a subdivision: positive inside, negative outside, NaN outside the ROI
+
+        :param coords: np.ndarray, (N, 3) array of coordinates
+        :param subdivision: str, acronym of one of the subdivisions
+        :param microns: bool, if true coordinates are interpreted in microns (otherwise in voxels of the atlas)
+        :param rounding: str, "floor" or "nearest" (see `coords_to_voxels()`)
+        """
+        field = self.signed_distance(subdivision)
+        voxels = coords_to_voxels(self.atlas, coords, microns = microns, rounding = rounding) - self.offset
+        inside = np.all((voxels >= 0) & (voxels < np.asarray(field.shape)), axis = 1)
+        distances = np.full(len(voxels), np.nan, dtype = np.float32)
+        distances[inside] = field[tuple(voxels[inside].T)]
+        return distances
+
+    @classmethod
+    def from_atlas(cls, atlas, subdivisions = PAG_SUBDIVISIONS, roi_regions = ["PAG"], margin = ROI_MARGIN):
+        """
+        Label a ROI of an atlas by subdivision and compute the distance transforms of all labels
+
+        :param atlas: BrainGlobeAtlas
+        :param subdivisions: list of str, acronyms of the subdivisions (each includes its descendants)
+        :param roi_regions: list of str, regions framed by the ROI (it should contain all the subdivisions)
+        :param margin: int, margin (in voxels) added around the regions
+        """
+        from scipy.ndimage import distance_transform_edt
+
+        roi = get_roi(atlas, regions = roi_regions, margin = margin)
+        labels = region_labels(atlas, np.asarray(roi.annotation), list(subdivisions)).astype(np.uint8)
+
+        # for each label, the distance from its voxels to the nearest voxel with another label, and that voxel's label
+        resolution = np.asarray(atlas.resolution, dtype = np.float64)
+        distance = np.zeros(roi.shape, dtype = np.float32)
+        neighbour = np.zeros(roi.shape, dtype = np.uint8)
+        for label in np.unique(labels):
+            mask = labels == label
+            if mask.all():
+                distance[mask] = np.inf
+                continue
+            edt, nearest = distance_transform_edt(mask, sampling = resolution, return_indices = True)
+            distance[mask] = edt[mask] - resolution.min() / 2 # the border is half-way between voxel centres
+            neighbour[mask] = labels[tuple(n[mask] for n in nearest)]
+        return cls(atlas, subdivisions, roi.offset, labels, distance, neighbour)
+
+    # // SAVE AND LOAD //
+    def save(self, folder):
+        """
+        Save the fields as .npy files (read memory-mapped) with a .json file of the subdivisions and offset
+
+        :param folder: str, Path
+        """
+        folder = Path(folder)
+        tmp_folder = folder.with_name(folder.name + ".tmp")
+        shutil.rmtree(tmp_folder, ignore_errors = True)
+        tmp_folder.mkdir(parents = True)
+        for name in ("labels", "distance", "neighbour"):
+            np.save(tmp_folder / f"{name}.npy", np.asarray(getattr(self, name)))
+        with open(tmp_folder / "info.json", "w") as f:
+            json.dump(dict(atlas_name = self.atlas.atlas_name, subdivisions = self.subdivisions, offset = self.offset.tolist()), f)
+
+        shutil.rmtree(folder, ignore_errors = True) # only complete folders end up in the cache
+        tmp_folder.replace(folder)
+        self.folder = folder
+
+    @classmethod
+    def load(cls, folder, atlas):
+        """
+        Load fields saved with `save()`
+
+        :param folder: str, Path
+        :param atlas: BrainGlobeAtlas the fields were computed from
+        """
+        folder = Path(folder)
+        with open(folder / "info.json") as f:
+            info = json.load(f)
+        fields = {name: np.load(folder / f"{name}.npy", mmap_mode = "r") for name in ("labels", "distance", "neighbour")}
+        return cls(atlas, info["subdivisions"], info["offset"], folder = folder, **fields)
+
+
+# // CACHE //
+def get_boundary_distances(atlas, subdivisions = PAG_SUBDIVISIONS, roi_regions = ["PAG"], margin = ROI_MARGIN, folder = DISTANCES_FOLDER):
+    """
+    Get the boundary distance fields of subdivisions of an atlas, computing them and saving them to disk the first time
+
+    :param atlas: BrainGlobeAtlas
+    :param subdivisions: list of str, acronyms of the subdivisions (each includes its descendants)
+    :param roi_regions: list of str, regions framed by the ROI (it should contain all the subdivisions)
+    :param margin: int, margin (in voxels) added around the regions
+    :param folder: str, Path. Where distance fields are stored
+    """
+    atlas_name = getattr(atlas, "local_full_name", None) or atlas.atlas_name # includes the atlas version when available
+    key = "-".join(subdivisions) + "_roi-" + "-".join(sorted(roi_regions)) + f"_margin{margin}"
+    cache_folder = Path(folder) / f"{atlas_name}_{hashlib.sha1(key.encode()).hexdigest()[:12]}"
+    if (cache_folder / "info.json").exists():
+        cache_hit("boundary_distances")
+        return BoundaryDistances.load(cache_folder, atlas)
+
+    cache_miss("boundary_distances")
+    with stage("boundary_distances.compute", atlas = atlas_name):
+        distances = BoundaryDistances.from_atlas(atlas, subdivisions = subdivisions, roi_regions = roi_regions, margin = margin)
+        distances.save(cache_folder)
+    return distances
+
+
+# // UTILS //
+def _signed_distance(mask, resolution):
+    """
+    Signed distance (in microns) to the border of a mask: positive inside, negative outside
+    """
+    from scipy.ndimage import distance_transform_edt
+
+    half_voxel = np.min(resolution) / 2
+    if mask.all() or not mask.any():
+        return np.full(mask.shape, np.inf if mask.all() else -np.inf, dtype = np.float32)
+    inside = distance_transform_edt(mask, sampling = resolution) - half_voxel
+    outside = distance_transform_edt(~mask, sampling = resolution) - half_voxel
+    return np.where(mask, inside, -outside).astype(np.float32)
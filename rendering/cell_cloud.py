@@ -0,0 +1,193 @@
+"""
+    Render large numbers of cells as a single point-sprite actor colored by a metadata column.
+
+    brainrender's `Points` actor creates a sphere mesh (res = 16-24) for every cell, so memory and rendering time grow with
+    the number of cells times the triangles of a sphere, and a scene colored by category needs one actor per category.
+    `CellCloud` stores only the coordinates (float32) and one RGB color (3 bytes) per cell: vertices are drawn as
+    spheres by the GPU (point sprites), and colors come from a lookup table indexed with the values of a categorical
+    or continuous column. Changing the coloring column only rewrites the colors array, the geometry is never rebuilt.
+
+    Example:
+        from cell_cloud import CellCloud
+        cells = scene.add(CellCloud(pag_data, columns = ["CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"], point_size = 8))
+        cells.color_by("cell.type", palette = dict(VGAT = "salmon", VGluT2 = "skyblue"))
+        cells.color_by("SNN_clusters_cv2_jaccard_k8_letters") # categories get colors from the default palette
+"""
+
+import numpy as np
+import pandas as pd
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray
+from vedo import Mesh, getColor
+from matplotlib import colormaps
+
+from brainrender.actor import Actor
+
+
+# // DEFAULT SETTINGS //
+CCF_COLUMNS = ["CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"] # columns of the metadata with the coordinates of the cells
+POINT_SIZE = 8 # size (in pixels) of the cells
+CATEGORICAL_PALETTE = "tab20" # matplotlib colormap used for categories without a color
+CONTINUOUS_CMAP = "viridis" # matplotlib colormap used for continuous columns
+LUT_SIZE = 256 # number of colors of the lookup tables of continuous columns
+NAN_COLOR = "lightgray" # color of cells with missing values
+COLORS_ARRAY_NAME = "CellColors" # name of the colors array of the cells
+
+
+# // ACTOR //
+class CellCloud(Actor):
+    def __init__(self, data, columns = CCF_COLUMNS, scale = 1, point_size = POINT_SIZE, color = "salmon", alpha = 1, name = "cells"):
+        """
+        Single actor with all cells drawn as spheres of a fixed size on screen (point sprites)
+
+        :param data: pd.DataFrame with the cells' metadata, or (N, 3) array of coordinates
+        :param columns: list of str, columns with the coordinates of the cells (when data is a DataFrame)
+        :param scale: float, factor applied to the coordinates (e.g. 10 for Sharp-Track coordinates at 10um)
+        :param point_size: float, size (in pixels) of the cells
+        :param color: str, color of all cells until `color_by()` is used
+        :param alpha: float
+        :param name: str, name of the actor
+        """
+        if isinstance(data, pd.DataFrame):
+            self.table = data
+            coords = data[columns].values
+        else:
+            self.table = None
+            coords = data
+        coords = np.asarray(coords, dtype = np.float32) * np.float32(scale)
+
+        # vertices only: one vertex cell per cell (legacy layout [1, point id, 1, point id, ...])
+        n_cells = len(coords)
+        polydata = vtk.vtkPolyData()
+        points = vtk.vtkPoints()
+        points.SetData(numpy_to_vtk(coords, deep = True))
+        polydata.SetPoints(points)
+        verts = np.column_stack([np.ones(n_cells, dtype = np.int64), np.arange(n_cells, dtype = np.int64)]).ravel()
+        cells = vtk.vtkCellArray()
+        cells.SetCells(n_cells, numpy_to_vtkIdTypeArray(verts, deep = True))
+        polydata.SetVerts(cells)
+
+        mesh = Mesh(polydata)
+        prop = mesh.GetProperty()
+        prop.SetRepresentationToPoints()
+        prop.SetPointSize(point_size)
+        prop.RenderPointsAsSpheresOn()
+
+        Actor.__init__(self, mesh, name = name, br_class = "Cells")
+        self.mesh.alpha(alpha)
+        self.legend = {}
+        self.color_by(None, color = color)
+
+    def __len__(self):
+        return self.mesh.polydata(False).GetNumberOfPoints()
+
+    def color_by(self, column, palette = None, cmap = CONTINUOUS_CMAP, vmin = None, vmax = None, color = "salmon"):
+        """
+        Color cells by the values of a column. Categorical columns (strings, categories, booleans) get a color per category,
+        numerical columns are mapped through a colormap. Returns {category or value: color} for legends.
+
+        :param column: str (column of the metadata), array, Series or Categorical of values (one per cell) or None to give all cells the same color
+        :param palette: dict {category: color} or list of colors (one per category, in order of appearance or of the categories of a categorical column)
+        :param cmap: str, matplotlib colormap for numerical columns
+        :param vmin, vmax: float, range of values mapped to the colormap (defaults to the values' range)
+        :param color: str, color of all cells when column is None
+        """
+        if column is None:
+            rgb = np.array(getColor(color))
+            self.legend = {}
+            self._set_colors(np.broadcast_to(_to_uint8(rgb), (len(self), 3)))
+            return self.legend
+        if isinstance(column, str) and self.table is None:
+            raise ValueError(f"Coloring by the column {column} needs a DataFrame of metadata, this CellCloud was created from an array of coordinates (pass the values instead)")
+
+        values = self.table[column] if isinstance(column, str) else pd.Series(column).reset_index(drop = True)
+        if len(values) != len(self):
+            raise ValueError(f"Coloring needs one value per cell: {len(values)} values for {len(self)} cells")
+
+        if _is_categorical(values):
+            lut, codes, self.legend = _categorical_lut(values, palette)
+        else:
+            lut, codes, self.legend = _continuous_lut(values.to_numpy(dtype = np.float64), cmap, vmin, vmax)
+
+        self._set_colors(lut[codes]) # missing values (code -1) take the last row of the table: NAN_COLOR
+        return self.legend
+
+    def _set_colors(self, colors):
+        """
+        Replace the colors array of the cells (one uint8 RGB color per cell)
+        """
+        array = numpy_to_vtk(np.ascontiguousarray(colors, dtype = np.uint8), deep = True, array_type = vtk.VTK_UNSIGNED_CHAR)
+        array.SetName(COLORS_ARRAY_NAME)
+
+        point_data = self.mesh.polydata(False).GetPointData()
+        point_data.AddArray(array) # replaces the previous colors array with the same name
+        point_data.SetActiveScalars(COLORS_ARRAY_NAME)
+
+        mapper = self.mesh.GetMapper()
+        mapper.SetScalarModeToUsePointData()
+        mapper.SetColorModeToDirectScalars()
+        mapper.ScalarVisibilityOn()
+        self.mesh.polydata(False).Modified()
+
+
+# // LOOKUP TABLES //
+def _categorical_lut(values, palette = None):
+    """
+    Lookup table with one color per category (and NAN_COLOR in the last row), code of each cell and legend
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = list(values.cat.categories)
+        codes = values.cat.codes.to_numpy()
+    else:
+        codes, categories = pd.factorize(values)
+        categories = list(categories)
+
+    if isinstance(palette, dict):
+        missing = [c for c in categories if c not in palette]
+        defaults = dict(zip(missing, _palette_colors(len(missing))))
+        colors = [palette[c] if c in palette else defaults[c] for c in categories]
+    elif palette is not None:
+        colors = list(palette)[:len(categories)]
+        colors += _palette_colors(len(categories))[len(colors):]
+    else:
+        colors = _palette_colors(len(categories))
+
+    lut = _to_uint8(np.array([getColor(c) for c in colors] + [getColor(NAN_COLOR)]).reshape(-1, 3))
+    return lut, codes, dict(zip(categories, colors))
+
+
+def _continuous_lut(values, cmap, vmin = None, vmax = None):
+    """
+    Lookup table of LUT_SIZE colors of a colormap (and NAN_COLOR in the last row), index of each cell and legend
+    """
+    finite = np.isfinite(values)
+    if vmin is None:
+        vmin = values[finite].min() if finite.any() else 0
+    if vmax is None:
+        vmax = values[finite].max() if finite.any() else 1
+
+    lut = colormaps[cmap].resampled(LUT_SIZE)(np.linspace(0, 1, LUT_SIZE))[:, :3]
+    lut = _to_uint8(np.vstack([lut, getColor(NAN_COLOR)]))
+
+    span = (vmax - vmin) or 1
+    codes = np.full(len(values), -1, dtype = np.intp)
+    codes[finite] = np.clip((values[finite] - vmin) * ((LUT_SIZE - 1) / span), 0, LUT_SIZE - 1).astype(np.intp)
+    return lut, codes, {vmin: tuple(lut[0] / 255), vmax: tuple(lut[LUT_SIZE - 1] / 255)}
+
+
+# // UTILS //
+def _is_categorical(values):
+    return isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == bool or not pd.api.types.is_numeric_dtype(values)
+
+
+def _palette_colors(n):
+    """
+    n colors of the default categorical palette (cycling through it if there are more categories than colors)
+    """
+    palette = colormaps[CATEGORICAL_PALETTE]
+    n_colors = getattr(palette, "N", 20)
+    return [tuple(palette(i % n_colors)[:3]) for i in range(n)]
+
+
+def _to_uint8(rgb):
+    return np.round(np.asarray(rgb, dtype = np.float64) * 255).astype(np.uint8)
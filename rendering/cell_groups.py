@@ -0,0 +1,137 @@
+"""
+    Split cells into groups by one or more metadata columns and render each group with its own color.
+
+    Instead of one `.loc[pag_data["PAG.area"] == "dmpag"]` (a full scan and a copy of the table) per category, the rows are
+    partitioned once: each grouping column is turned into integer codes, the codes of several columns are combined into
+    one code per row, and a stable sort of the codes gives the row indices of every group. Coordinates are taken once
+    from the table and each group only indexes them.
+
+    Groups are rendered as one brainrender `Points` actor per group, or as a single `CellCloud` colored by group.
+
+    Example:
+        from cell_groups import add_cell_groups
+        actors = add_cell_groups(scene, pag_data, by = "PAG.area", palette = dict(dmpag = "cornflowerblue", dlpag = "darkorange"))
+        actors = add_cell_groups(scene, pag_data, by = ["PAG.hemisphere", "cell.type"], mode = "cloud")
+"""
+
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from cell_cloud import CellCloud, CCF_COLUMNS, _palette_colors
+
+
+# // DEFAULT SETTINGS //
+GROUP_NAME_SEPARATOR = " " # separator between the values of the grouping columns in group names (e.g. "left VGAT")
+
+
+# // GROUPS //
+def group_codes(data, by):
+    """
+    Integer code of the group of each row (-1 for rows with a missing value) and the groups, as a list of tuples of column values
+
+    :param data: pd.DataFrame
+    :param by: str or list of str, grouping column(s)
+    """
+    by = [by] if isinstance(by, str) else list(by)
+
+    codes = np.zeros(len(data), dtype = np.int64)
+    missing = np.zeros(len(data), dtype = bool)
+    levels = []
+    for column in by:
+        values = data[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            column_codes, categories = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            column_codes, categories = pd.factorize(values, sort = True)
+        missing |= column_codes < 0
+        codes = codes * len(categories) + column_codes # combined code of all columns (mixed radix)
+        levels.append(list(categories))
+
+    codes[missing] = -1
+    return codes, list(product(*levels)) # same order as the combined codes
+
+
+def group_indices(data, by, drop_empty = True):
+    """
+    Row positions of each group, as {group: index array}. A group is a column value, or a tuple of values for several columns.
+    Rows are partitioned in a single pass: one stable sort of the group codes, then split at the group sizes.
+
+    :param data: pd.DataFrame
+    :param by: str or list of str, grouping column(s)
+    :param drop_empty: bool, if true combinations of values without rows are left out
+    """
+    codes, groups = group_codes(data, by)
+    order = np.argsort(codes, kind = "stable")
+    counts = np.bincount(codes[codes >= 0], minlength = len(groups))
+    n_missing = int(np.sum(codes < 0))
+    splits = np.split(order[n_missing:], np.cumsum(counts)[:-1]) # rows with missing values are sorted first and left out
+
+    single = isinstance(by, str)
+    return {(group[0] if single else group): rows for group, rows in zip(groups, splits) if len(rows) or not drop_empty}
+
+
+def group_name(group):
+    """
+    Name of a group for actors and legends (e.g. "left VGAT")
+    """
+    return GROUP_NAME_SEPARATOR.join(str(v) for v in group) if isinstance(group, tuple) else str(group)
+
+
+# // SCENES //
+def add_cell_groups(scene, data, by, columns = CCF_COLUMNS, palette = None, scale = 1, mode = "points", groups = None, **kwargs):
+    """
+    Add the cells of a table to a scene, colored by group. Returns {group: actor} with mode "points", or the CellCloud with mode "cloud".
+
+    :param scene: Scene
+    :param data: pd.DataFrame with the cells' metadata
+    :param by: str or list of str, grouping column(s) (e.g. "PAG.area" or ["PAG.hemisphere", "cell.type"])
+    :param columns: list of str, columns with the coordinates of the cells
+    :param palette: dict {group: color}, list of colors (one per group) or None to use the default palette
+    :param scale: float, factor applied to the coordinates (e.g. 10 for Sharp-Track coordinates at 10um)
+    :param mode: str, "points" for one brainrender Points actor per group, "cloud" for a single CellCloud colored by group
+    :param groups: list, only render these groups (defaults to all groups)
+    :param kwargs: keyword arguments passed to Points (e.g. radius, res, alpha) or CellCloud (e.g. point_size, alpha)
+    """
+    indices = group_indices(data, by)
+    if groups is not None:
+        indices = {g: indices[g] for g in groups if g in indices}
+    colors = _group_colors(list(indices.keys()), palette)
+
+    if mode == "points":
+        from brainrender.actors import Points
+
+        coords = data[columns].to_numpy(dtype = np.float64) * scale # taken once, each group indexes these coordinates
+        kwargs = dict(dict(radius = 20, res = 16, alpha = 1), **kwargs)
+        actors = {}
+        for group, rows in indices.items():
+            actors[group] = scene.add(Points(coords[rows], name = group_name(group), colors = colors[group], **kwargs))
+        return actors
+
+    elif mode == "cloud":
+        # one code per cell: the position of its group in `indices` (-1 for cells in no rendered group)
+        codes = np.full(len(data), -1, dtype = np.int64)
+        for i, rows in enumerate(indices.values()):
+            codes[rows] = i
+        names = [group_name(g) for g in indices.keys()]
+
+        cloud = scene.add(CellCloud(data, columns = columns, scale = scale, **kwargs))
+        cloud.color_by(pd.Categorical.from_codes(codes, categories = names), palette = [colors[g] for g in indices.keys()])
+        return cloud
+
+    raise ValueError(f"Mode should be 'points' or 'cloud', not {mode}")
+
+
+# // UTILS //
+def _group_colors(groups, palette = None):
+    """
+    {group: color}, with colors from the palette and the default palette for groups without a color
+    """
+    if isinstance(palette, dict):
+        defaults = iter(_palette_colors(len(groups)))
+        return {g: palette[g] if g in palette else palette.get(group_name(g), next(defaults)) for g in groups}
+
+    palette = list(palette) if palette is not None else []
+    palette += _palette_colors(len(groups))[len(palette):]
+    return dict(zip(groups, palette))
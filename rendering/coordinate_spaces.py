@@ -0,0 +1,214 @@
+"""
+    Registry of the coordinate spaces used in this repository, and non-mutating conversions between them.
+
+    Cell coordinates come from Sharp-Track in voxels of the 10um Allen CCF, brainrender works in microns and atlas lookups
+    need voxels of the atlas being used (10, 25 or 50um, Allen or Kim). Instead of scaling the metadata columns in place
+    (`pag_data["CCF.AllenAP"] *= 10`, then `*= 0.04`, which compounds when a cell is run twice), each space is registered
+    once with its resolution and axis order, and conversions are affine matrices composed through microns.
+
+    `Coordinates` holds a single float32 (N, 3) buffer in its source space. Converted coordinates are computed the first
+    time they are requested and cached by target space. Buffers are read-only, so they can't be scaled in place by mistake.
+
+    All spaces here share the origin and axes of the Allen CCF. The axes are (AP, DV, ML) unless a space is registered with
+    another order, in which case conversions reorder the axes (e.g. for tools expecting (DV, AP, ML)).
+
+    Example:
+        from coordinate_spaces import Coordinates
+        coords = Coordinates.from_table(pag_data, ["CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"], space = "sharptrack")
+        coords.to("microns") # brainrender's space
+        coords.to("kim_unified_25um") # voxels of the 25um kim atlas
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+
+# // DEFAULT SETTINGS //
+AXES = ("AP", "DV", "ML") # axis order of the atlases, brainrender and Sharp-Track coordinates
+SHARPTRACK_RESOLUTION = 10 # Sharp-Track registers to the 10um Allen CCF
+ATLAS_RESOLUTIONS = dict(allen_mouse = [10, 25, 50], kim_mouse = [10, 25, 50], kim_unified = [25, 50]) # atlases registered as voxel spaces
+
+_spaces = {} # {name: CoordinateSpace}
+
+
+# // SPACES //
+class CoordinateSpace:
+    def __init__(self, name, resolution, axes = AXES, origin_um = (0, 0, 0)):
+        """
+        Coordinate space in the Allen CCF: coordinates are `resolution` microns per unit along `axes`, starting at `origin_um`
+
+        :param name: str, name of the space
+        :param resolution: float or 3-tuple, microns per unit along each axis (1 for brainrender)
+        :param axes: 3-tuple of "AP", "DV" and "ML", order of the axes of the coordinates
+        :param origin_um: 3-tuple, position (in microns, (AP, DV, ML)) of the space's origin in the CCF
+        """
+        if sorted(axes) != sorted(AXES):
+            raise ValueError(f"The axes of a space should be an order of {AXES}, not {axes}")
+
+        self.name = name
+        self.resolution = tuple(float(r) for r in np.broadcast_to(resolution, 3))
+        self.axes = tuple(axes)
+        self.origin_um = tuple(float(o) for o in origin_um)
+
+    def __repr__(self):
+        return f"CoordinateSpace {self.name}: {self.resolution}um along {self.axes}"
+
+    def to_microns(self):
+        """
+        4x4 affine matrix from this space to CCF microns along (AP, DV, ML)
+        """
+        matrix = np.zeros((4, 4))
+        for i, (axis, resolution) in enumerate(zip(self.axes, self.resolution)):
+            matrix[AXES.index(axis), i] = resolution
+        matrix[:3, 3] = self.origin_um
+        matrix[3, 3] = 1
+        return matrix
+
+
+def register_space(name, resolution, axes = AXES, origin_um = (0, 0, 0)):
+    """
+    Register a coordinate space (see CoordinateSpace). Returns the space.
+    """
+    _spaces[name] = CoordinateSpace(name, resolution, axes = axes, origin_um = origin_um)
+    _affine.cache_clear() # the space may replace one with the same name
+    return _spaces[name]
+
+
+def get_space(space):
+    """
+    Get a registered space by name. Atlases (e.g. BrainGlobeAtlas) are registered from their name and resolution the first time.
+
+    :param space: str (name of the space), CoordinateSpace or atlas
+    """
+    if isinstance(space, CoordinateSpace):
+        return space
+    if hasattr(space, "atlas_name") and hasattr(space, "resolution"):
+        resolution = tuple(float(r) for r in np.broadcast_to(space.resolution, 3))
+        name = space.atlas_name
+        if name in _spaces and _spaces[name].resolution != resolution: # e.g. a ResampledAtlas keeps the name of its source atlas
+            name = f"{name}_at_{'x'.join(f'{r:g}' for r in resolution)}um"
+        if name not in _spaces:
+            register_space(name, resolution)
+        return _spaces[name]
+    if space not in _spaces:
+        raise KeyError(f"Unknown coordinate space {space}. Registered spaces: {list(_spaces.keys())}")
+    return _spaces[space]
+
+
+def list_spaces():
+    """
+    Names of the registered spaces
+    """
+    return list(_spaces.keys())
+
+
+# // TRANSFORMS //
+@lru_cache(maxsize = None)
+def _affine(source, target):
+    return np.linalg.inv(get_space(target).to_microns()) @ get_space(source).to_microns()
+
+
+def affine(source, target):
+    """
+    4x4 affine matrix from a space to another (composed through CCF microns). Matrices are cached by source and target space.
+
+    :param source: str, CoordinateSpace or atlas
+    :param target: str, CoordinateSpace or atlas
+    """
+    return _affine(get_space(source).name, get_space(target).name)
+
+
+def transform(coords, source, target, dtype = np.float32):
+    """
+    Convert (N, 3) coordinates from a space to another. Returns a new array (the input is never modified),
+    or the input itself when both spaces are the same and it already has the right dtype.
+
+    :param coords: np.ndarray, (N, 3) array of coordinates in the source space
+    :param source: str, CoordinateSpace or atlas
+    :param target: str, CoordinateSpace or atlas
+    :param dtype: dtype of the result
+    """
+    coords = np.asarray(coords, dtype = dtype)
+    matrix = affine(source, target)
+    linear, offset = matrix[:3, :3], matrix[:3, 3]
+
+    if np.allclose(linear, np.eye(3)) and not offset.any():
+        return coords
+
+    # axes reordering (if any) is done by indexing columns, scaling and offset are done in place on the result
+    order = np.argmax(np.abs(linear), axis = 1)
+    if np.count_nonzero(linear) == 3 and len(set(order.tolist())) == 3:
+        result = coords[:, order] if np.any(order != np.arange(3)) else coords.copy()
+        scale = linear[np.arange(3), order].astype(dtype)
+        if np.any(scale != 1):
+            result *= scale
+        if offset.any():
+            result += offset.astype(dtype)
+        return result
+
+    return (coords @ linear.T.astype(dtype)) + offset.astype(dtype)
+
+
+# // COORDINATES //
+class Coordinates:
+    def __init__(self, coords, space, copy = True):
+        """
+        (N, 3) coordinates in a space, stored once as a read-only float32 buffer.
+        Coordinates in other spaces are computed when first requested and cached by space.
+
+        :param coords: np.ndarray, (N, 3) array of coordinates
+        :param space: str, CoordinateSpace or atlas, space of the coordinates
+        :param copy: bool, if false a float32 input array is used as the buffer (and made read-only) instead of being copied
+        """
+        self.space = get_space(space)
+        self.buffer = np.array(coords, dtype = np.float32) if copy else np.asarray(coords, dtype = np.float32)
+        if self.buffer.ndim != 2 or self.buffer.shape[1] != 3:
+            raise ValueError(f"Coordinates should be an (N, 3) array, not {self.buffer.shape}")
+        self.buffer.setflags(write = False)
+        self._converted = {self.space.name: self.buffer}
+
+    @classmethod
+    def from_table(cls, table, columns, space):
+        """
+        Coordinates from columns of a table (the table is not modified)
+
+        :param table: pd.DataFrame
+        :param columns: list of str, columns with the coordinates, in the order of the space's axes
+        :param space: str, CoordinateSpace or atlas, space of the coordinates
+        """
+        coords = table[list(columns)].to_numpy(dtype = np.float32, copy = True) # a single copy, never a view of the table
+        return cls(coords, space, copy = False)
+
+    def __repr__(self):
+        return f"{len(self)} coordinates in {self.space.name} (converted to: {list(self._converted.keys())})"
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def to(self, space):
+        """
+        Read-only (N, 3) float32 coordinates in another space
+
+        :param space: str, CoordinateSpace or atlas
+        """
+        name = get_space(space).name
+        if name not in self._converted:
+            converted = transform(self.buffer, self.space, space)
+            converted.setflags(write = False)
+            self._converted[name] = converted
+        return self._converted[name]
+
+    def clear_cache(self):
+        """
+        Forget the coordinates converted to other spaces
+        """
+        self._converted = {self.space.name: self.buffer}
+
+
+# // BUILT-IN SPACES //
+register_space("microns", 1) # brainrender
+register_space("sharptrack", SHARPTRACK_RESOLUTION) # Sharp-Track's CCF coordinates (voxels of the 10um Allen CCF)
+for _atlas, _resolutions in ATLAS_RESOLUTIONS.items():
+    for _resolution in _resolutions:
+        register_space(f"{_atlas}_{_resolution}um", _resolution) # atlas voxels
@@ -0,0 +1,212 @@
+"""
+    Gene expression statistics per brain region (e.g. the PAG, its subdivisions and neighbouring structures).
+
+    The atlas annotation is sampled once on the grid of the expression data (each grid voxel takes the label at its centre,
+    see `ResampledAtlas`). The voxels of each region (including its descendants) are gathered once, sorted by region, and
+    the grids of many experiments are stacked so that the number of voxels, mean and max of every region and experiment
+    are computed together with segmented reductions (`np.add.reduceat`, `np.maximum.reduceat`).
+    Quantiles are computed per region for all experiments at once. Voxels without data (negative values in the Allen grids) are ignored.
+
+    Genes are split in batches processed by a pool of worker processes, each computing the region voxels once.
+    The result is a tidy DataFrame with one row per gene, experiment and region.
+
+    Example:
+        from expression_stats import expression_stats
+        stats = expression_stats(["Cacna2d1", "Tac1", "Penk"], atlas_name = "allen_mouse_25um", regions = ["PAG", "DR", "SCm", "MRN"])
+        stats.pivot_table(index = "gene", columns = "region", values = "mean")
+"""
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+import numpy as np
+import pandas as pd
+
+from atlas_hierarchy import get_hierarchy_table
+from atlas_resolution import ResampledAtlas
+from atlas_roi import PAG_REGIONS
+from atlas_volumes import get_atlas
+from expression_store import ExpressionStore, EXPRESSION_STORE_FOLDER, VOXEL_SIZE
+
+
+# // DEFAULT SETTINGS //
+STATS_QUANTILES = [50, 90] # quantiles (0-100) of each region's expression added to the table
+BATCH_SIZE = 50 # number of genes given to a worker at once
+
+
+# // REGION VOXELS //
+class RegionVoxels:
+    def __init__(self, labels, atlas, regions):
+        """
+        Voxels of a label grid belonging to each region (a region's voxels include its descendants'), sorted by region
+        so that reductions over regions are segmented reductions over `self.voxels`.
+
+        :param labels: np.ndarray, 3D grid of structure IDs (e.g. the annotation sampled on an expression grid)
+        :param atlas: BrainGlobeAtlas, atlas of the labels
+        :param regions: list of str, acronyms of the regions
+        """
+        table = get_hierarchy_table(atlas)
+        labels = np.asarray(labels)
+        self.shape = labels.shape # shape of the label grid, `self.voxels` are flat indices into it
+        labels = labels.ravel()
+
+        # the region test is done once per distinct label, not per voxel
+        unique_labels, inverse = np.unique(labels, return_inverse = True)
+        voxels, counts, self.regions = [], [], []
+        for region in regions:
+            try:
+                table.row_of(region)
+            except KeyError:
+                print(f"The region {region} doesn't seem to belong to the atlas being used: {atlas.atlas_name}. Skipping")
+                continue
+            in_region = np.flatnonzero(table.is_within(unique_labels, region)[inverse])
+            voxels.append(in_region)
+            counts.append(len(in_region))
+            self.regions.append(region)
+
+        self.voxels = np.concatenate(voxels) if voxels else np.zeros(0, dtype = np.intp)
+        self.counts = np.asarray(counts, dtype = np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.intp)
+
+    def __repr__(self):
+        return f"RegionVoxels of {len(self.regions)} regions ({len(self.voxels)} voxels)"
+
+
+def labels_on_grid(atlas, grid_shape, voxel_size = VOXEL_SIZE):
+    """
+    Atlas annotation sampled on a grid of coarser voxels with the same origin and axes as the atlas (e.g. Allen expression grids)
+
+    :param atlas: BrainGlobeAtlas
+    :param grid_shape: 3-tuple, shape of the grid
+    :param voxel_size: float, size (in microns) of the grid's voxels
+    """
+    return ResampledAtlas(atlas, voxel_size, shape = grid_shape).annotation
+
+
+# // STATISTICS //
+def region_stats(grids, region_voxels, quantiles = STATS_QUANTILES):
+    """
+    Statistics of each region for a stack of expression grids. Returns {statistic: (n experiments, n regions) array}
+    with "n_voxels" (voxels with data), "mean", "max" and "q<quantile>". Regions without data get NaN.
+
+    :param grids: np.ndarray, (n experiments, *grid shape) stack of grids on the grid of `region_voxels`
+    :param region_voxels: RegionVoxels
+    :param quantiles: list of float, quantiles (0-100)
+    """
+    values = np.asarray(grids, dtype = np.float32).reshape(len(grids), -1)[:, region_voxels.voxels]
+    valid = values >= 0 # the Allen grids use -1 for voxels without data
+
+    stats = {}
+    nonempty = region_voxels.counts > 0
+    starts = region_voxels.starts[nonempty]
+    n_valid = np.zeros((len(values), len(region_voxels.regions)))
+    sums, maxs = np.zeros_like(n_valid), np.full_like(n_valid, -np.inf)
+    if len(starts):
+        n_valid[:, nonempty] = np.add.reduceat(valid, starts, axis = 1)
+        sums[:, nonempty] = np.add.reduceat(np.where(valid, values, 0), starts, axis = 1, dtype = np.float64)
+        maxs[:, nonempty] = np.maximum.reduceat(np.where(valid, values, -np.inf), starts, axis = 1)
+
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        stats["n_voxels"] = n_valid.astype(np.int64)
+        stats["mean"] = np.where(n_valid > 0, sums / n_valid, np.nan)
+        stats["max"] = np.where(n_valid > 0, maxs, np.nan)
+
+    # quantiles need each region's values sorted: done region by region, for all experiments at once
+    masked = np.where(valid, values, np.nan)
+    for q in quantiles:
+        stats[f"q{q:g}"] = np.full(n_valid.shape, np.nan)
+    for i, (start, count) in enumerate(zip(region_voxels.starts, region_voxels.counts)):
+        if count == 0:
+            continue
+        with warnings.catch_warnings(): # experiments without data in a region give NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            region_quantiles = np.nanpercentile(masked[:, start:start + count], quantiles, axis = 1)
+        for q, value in zip(quantiles, region_quantiles):
+            stats[f"q{q:g}"][:, i] = value
+
+    return stats
+
+
+def stats_table(stats, region_voxels, genes, exp_ids):
+    """
+    Tidy DataFrame (one row per experiment and region) from the output of `region_stats()`
+
+    :param stats: dict, output of `region_stats()`
+    :param region_voxels: RegionVoxels
+    :param genes: list of str, gene of each experiment
+    :param exp_ids: list of int, ID of each experiment
+    """
+    n_regions = len(region_voxels.regions)
+    table = pd.DataFrame(dict(
+        gene = np.repeat(genes, n_regions),
+        exp_id = np.repeat(exp_ids, n_regions),
+        region = np.tile(region_voxels.regions, len(exp_ids)),
+        ))
+    for name, values in stats.items():
+        table[name] = values.ravel()
+    return table
+
+
+# // GENE LISTS //
+def expression_stats(genes, atlas_name = "allen_mouse_25um", regions = PAG_REGIONS, quantiles = STATS_QUANTILES,
+    all_experiments = True, workers = None, batch_size = BATCH_SIZE, store_folder = EXPRESSION_STORE_FOLDER, local_folder = None):
+    """
+    Expression statistics per region for every experiment of a list of genes, as a tidy DataFrame with columns
+    gene, exp_id, region, n_voxels, mean, max and q<quantile>. Missing experiments are first fetched into the expression store.
+
+    :param genes: list of str, gene symbols
+    :param atlas_name: str, atlas whose annotation defines the regions
+    :param regions: list of str, acronyms of the regions (each includes its descendants)
+    :param quantiles: list of float, quantiles (0-100)
+    :param all_experiments: bool, if true use all experiments of each gene, otherwise only the first one
+    :param workers: int, number of worker processes (defaults to the number of cores)
+    :param batch_size: int, number of genes given to a worker at once
+    :param store_folder: str, Path. Folder of the expression store
+    :param local_folder: str, Path. Folder of `<gene>/<experiment id>.npy` grids used instead of the Allen API
+    """
+    store = ExpressionStore(store_folder, local_folder = local_folder)
+    experiments = store.fetch(genes, all_experiments = all_experiments)
+
+    batches = [genes[i:i + batch_size] for i in range(0, len(genes), batch_size)]
+    jobs = [({g: experiments[g] for g in batch if g in experiments}, atlas_name, list(regions), list(quantiles), str(store_folder))
+        for batch in batches]
+    workers = min(workers or cpu_count(), len(jobs)) if jobs else 1
+    if workers == 1:
+        tables = [_batch_stats(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            tables = list(pool.map(_batch_stats, *zip(*jobs)))
+
+    tables = [t for t in tables if len(t)]
+    if not tables:
+        return pd.DataFrame(columns = ["gene", "exp_id", "region", "n_voxels", "mean", "max"] + [f"q{q:g}" for q in quantiles])
+    return pd.concat(tables, ignore_index = True)
+
+
+_region_voxels = {} # {(atlas name, regions, grid shape): RegionVoxels} computed by this process
+
+
+def _batch_stats(experiments, atlas_name, regions, quantiles, store_folder):
+    """
+    Worker: statistics of a batch of genes. Grids of the same shape are stacked and reduced together.
+    """
+    store = ExpressionStore(store_folder)
+    exp_list = [(gene, eid) for gene, expids in experiments.items() for eid in expids]
+
+    by_shape = {}
+    for gene, eid in exp_list:
+        by_shape.setdefault(tuple(store.info(gene, eid)["shape"]), []).append((gene, eid))
+
+    tables = []
+    for shape, group in by_shape.items():
+        key = (atlas_name, tuple(regions), shape)
+        if key not in _region_voxels:
+            atlas = get_atlas(atlas_name)
+            _region_voxels[key] = RegionVoxels(labels_on_grid(atlas, shape), atlas, regions)
+
+        grids = np.stack([store.grid(gene, eid) for gene, eid in group])
+        stats = region_stats(grids, _region_voxels[key], quantiles = quantiles)
+        tables.append(stats_table(stats, _region_voxels[key], [g for g, _ in group], [e for _, e in group]))
+
+    return pd.concat(tables, ignore_index = True) if tables else pd.DataFrame()
@@ -0,0 +1,230 @@
+"""
+    Local store of Allen ISH gene expression grids (https://mouse.brain-map.org/) for screening many genes.
+
+    Each experiment's expression grid is downloaded once with brainrender's GeneExpressionAPI and stored as a float32 .npy
+    file (one file per experiment, so grids are read independently and served memory-mapped) next to a .json file with
+    its gene, shape, voxel size and precomputed quantiles (0 to 100), so thresholds like `min_quantile = 85` don't need
+    the grid. The experiments of each gene are also stored, and missing genes and experiments are fetched concurrently.
+
+    For offline use (or tests), a folder with grids saved as `<gene>/<experiment id>.npy` can stand in for the Allen API.
+
+    Example:
+        from expression_store import ExpressionStore
+        store = ExpressionStore()
+        store.fetch(["Cacna2d1", "Tac1", "Penk"], workers = 8) # only downloads what is missing
+        gene_actor = store.volume("Cacna2d1", min_quantile = 85, cmap = "inferno")
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+
+# // DEFAULT SETTINGS //
+EXPRESSION_STORE_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "gene_expression" # where expression grids are stored
+LOCAL_EXPRESSION_FOLDER = None # folder of `<gene>/<experiment id>.npy` grids used instead of the Allen API (offline use)
+FETCH_WORKERS = 8 # number of concurrent downloads
+VOXEL_SIZE = 200 # size (in microns) of the voxels of the Allen expression grids
+QUANTILES = np.arange(101) # quantiles precomputed for each grid
+
+
+# // STORE //
+class ExpressionStore:
+    def __init__(self, folder = EXPRESSION_STORE_FOLDER, local_folder = None):
+        """
+        Local store of gene expression grids
+
+        :param folder: str, Path. Where expression grids are stored
+        :param local_folder: str, Path. Folder of `<gene>/<experiment id>.npy` grids used instead of the Allen API. Defaults to LOCAL_EXPRESSION_FOLDER
+        """
+        self.folder = Path(folder)
+        self.local_folder = local_folder or LOCAL_EXPRESSION_FOLDER
+
+    def __repr__(self):
+        return f"ExpressionStore at {self.folder} ({len(self.cached_genes())} genes)"
+
+    # ------------------------------- experiments ------------------------------ #
+    def experiments(self, gene, update = False):
+        """
+        IDs of the ISH experiments of a gene, from the store or (the first time) from the Allen API
+
+        :param gene: str, gene symbol (e.g. "Cacna2d1")
+        :param update: bool, if true ask again instead of reading from the store
+        """
+        filepath = self.folder / "genes" / f"{gene}.json"
+        if filepath.exists() and not update:
+            with open(filepath) as f:
+                return json.load(f)
+
+        if self.local_folder is not None:
+            expids = sorted(int(f.stem) for f in (Path(self.local_folder) / gene).glob("*.npy"))
+        else:
+            from brainrender.atlas_specific import GeneExpressionAPI
+            expids = [int(eid) for eid in GeneExpressionAPI().get_gene_experiments(gene)]
+
+        _write_json(filepath, expids)
+        return expids
+
+    def cached_genes(self):
+        """
+        Genes whose experiments are known to the store
+        """
+        return sorted(f.stem for f in (self.folder / "genes").glob("*.json"))
+
+    def is_cached(self, exp_id):
+        """
+        Whether an experiment's grid is in the store
+
+        :param exp_id: int, experiment ID
+        """
+        return self._grid_filepath(exp_id).exists() and self._info_filepath(exp_id).exists()
+
+    # --------------------------------- fetching -------------------------------- #
+    def fetch(self, genes, workers = FETCH_WORKERS, all_experiments = False):
+        """
+        Make sure the grids of a list of genes are in the store, downloading the missing ones concurrently.
+        Returns {gene: [experiment IDs in the store]}. Genes and experiments that fail to download are logged and left out.
+
+        :param genes: str or list of str, gene symbols
+        :param workers: int, number of concurrent downloads
+        :param all_experiments: bool, if true fetch all experiments of each gene, otherwise only the first one (as in PAG_gene_expression.py)
+        """
+        genes = [genes] if isinstance(genes, str) else list(genes)
+
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            # experiments of each gene
+            futures = {pool.submit(self.experiments, gene): gene for gene in genes}
+            experiments = {}
+            for future in as_completed(futures):
+                gene = futures[future]
+                try:
+                    expids = future.result()
+                except Exception as e:
+                    logger.warning(f"EXPRESSION STORE: could not get the experiments of {gene}: {e}")
+                    continue
+                if not expids:
+                    print(f"The gene {gene} doesn't seem to have any ISH experiment. Skipping")
+                experiments[gene] = expids if all_experiments else expids[:1]
+
+            # grids of the missing experiments
+            missing = [(gene, eid) for gene, expids in experiments.items() for eid in expids if not self.is_cached(eid)]
+            futures = {pool.submit(self._fetch_experiment, gene, eid): (gene, eid) for gene, eid in missing}
+            for n, future in enumerate(as_completed(futures), start = 1):
+                gene, eid = futures[future]
+                try:
+                    future.result()
+                    logger.debug(f"EXPRESSION STORE: [{n}/{len(missing)}] stored {gene} ({eid})")
+                except Exception as e:
+                    logger.warning(f"EXPRESSION STORE: could not download {gene} ({eid}): {e}")
+
+        return {gene: [eid for eid in experiments[gene] if self.is_cached(eid)] for gene in genes if gene in experiments}
+
+    def _fetch_experiment(self, gene, exp_id):
+        """
+        Download an experiment's grid and store it with its precomputed quantiles
+        """
+        if self.local_folder is not None:
+            grid = np.load(Path(self.local_folder) / gene / f"{exp_id}.npy")
+        else:
+            from brainrender.atlas_specific import GeneExpressionAPI
+            grid = GeneExpressionAPI().get_gene_data(gene, exp_id)
+
+        grid = np.asarray(grid, dtype = np.float32)
+        info = dict(gene = gene, exp_id = int(exp_id), shape = list(grid.shape), voxel_size = VOXEL_SIZE,
+            quantiles = np.percentile(grid.ravel(), QUANTILES).tolist()) # same percentiles as brainrender's min_quantile
+
+        filepath = self._grid_filepath(exp_id)
+        filepath.parent.mkdir(parents = True, exist_ok = True)
+        tmp_file = filepath.with_name(filepath.name + ".tmp")
+        with open(tmp_file, "wb") as f:
+            np.save(f, grid)
+        tmp_file.replace(filepath)
+        _write_json(self._info_filepath(exp_id), info) # written last: an experiment is only cached once its info exists
+
+    # ---------------------------------- grids ---------------------------------- #
+    def grid(self, gene, exp_id = None):
+        """
+        Memory-mapped expression grid of an experiment (fetched if missing)
+
+        :param gene: str, gene symbol
+        :param exp_id: int, experiment ID. Defaults to the first experiment of the gene
+        """
+        exp_id = self._experiment(gene, exp_id)
+        return np.load(self._grid_filepath(exp_id), mmap_mode = "r")
+
+    def info(self, gene, exp_id = None):
+        """
+        Gene, shape, voxel size and quantiles of an experiment (fetched if missing)
+
+        :param gene: str, gene symbol
+        :param exp_id: int, experiment ID. Defaults to the first experiment of the gene
+        """
+        exp_id = self._experiment(gene, exp_id)
+        with open(self._info_filepath(exp_id)) as f:
+            return json.load(f)
+
+    def threshold(self, gene, min_quantile, exp_id = None):
+        """
+        Expression value at a quantile of an experiment's grid, read from the precomputed quantiles
+
+        :param gene: str, gene symbol
+        :param min_quantile: int, quantile (0-100)
+        :param exp_id: int, experiment ID. Defaults to the first experiment of the gene
+        """
+        quantiles = self.info(gene, exp_id)["quantiles"]
+        if float(min_quantile).is_integer():
+            return quantiles[int(min_quantile)]
+        return float(np.percentile(self.grid(gene, exp_id).ravel(), min_quantile)) # not precomputed
+
+    def volume(self, gene, exp_id = None, min_quantile = None, min_value = None, cmap = "bwr", **kwargs):
+        """
+        brainrender actor of an experiment's grid. Same as `GeneExpressionAPI.griddata_to_volume`, with quantiles read from the store
+
+        :param gene: str, gene symbol
+        :param exp_id: int, experiment ID. Defaults to the first experiment of the gene
+        :param min_quantile: int, only voxels above this quantile (0-100) are rendered
+        :param min_value: float, only voxels above this value are rendered
+        :param cmap: str, matplotlib (or custom) colormap
+        :param kwargs: keyword arguments passed to brainrender's Volume
+        """
+        from brainrender.actors import Volume
+
+        if min_quantile is not None and min_value is None:
+            min_value = self.threshold(gene, min_quantile, exp_id)
+        return Volume(np.array(self.grid(gene, exp_id)), voxel_size = VOXEL_SIZE, min_value = min_value, cmap = cmap, **kwargs)
+
+    # ---------------------------------- utils ---------------------------------- #
+    def _experiment(self, gene, exp_id):
+        """
+        Experiment ID defaulting to the gene's first experiment, fetching the grid if it's not in the store
+        """
+        if exp_id is None:
+            expids = self.experiments(gene)
+            if not expids:
+                raise ValueError(f"The gene {gene} doesn't have any ISH experiment")
+            exp_id = expids[0]
+        if not self.is_cached(exp_id):
+            self._fetch_experiment(gene, exp_id)
+        return exp_id
+
+    def _grid_filepath(self, exp_id):
+        return self.folder / "experiments" / f"{exp_id}.npy"
+
+    def _info_filepath(self, exp_id):
+        return self.folder / "experiments" / f"{exp_id}.json"
+
+
+# // UTILS //
+def _write_json(filepath, data):
+    """
+    Write a .json file (only complete files end up in the store)
+    """
+    filepath = Path(filepath)
+    filepath.parent.mkdir(parents = True, exist_ok = True)
+    tmp_file = filepath.with_name(filepath.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    tmp_file.replace(filepath)
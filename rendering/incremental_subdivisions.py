@@ -0,0 +1,174 @@
+"""
+    Incremental lookup of the structures of the cells, keeping the results of previous runs on disk.
+
+    Re-running the lookups of every cell against every atlas each time the metadata is updated (e.g. from `_200617`
+    to `_211018`) repeats work for all the cells that did not change. Here the results of each atlas are stored on disk,
+    keyed by `cell.id`, with a hash of the coordinates of each cell and the version of the atlas. On each run only cells
+    that are new, whose coordinates changed (re-registered cells) or whose atlas version changed are looked up again;
+    results of the others are read from the store. Each run returns the merged table (the same columns as
+    `structures_from_coords()`) and a change log, which is also appended to `changes.csv` in the store.
+
+    Example:
+        from incremental_subdivisions import update_subdivisions
+        area_dataframe_10, changes = update_subdivisions(dict(allen_atlas_10 = allen_atlas_10, kim_atlas_10 = kim_atlas_10),
+            pag_data["cell.id"], coordinates_10, microns = False)
+        changes[changes["changed"]] # cells whose structure changed since the last run
+"""
+
+import json
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from atlas_hierarchy import get_hierarchy_table
+from atlas_lookup import ids_from_coords, acronyms_from_ids
+from profiling import stage, cache_hit, cache_miss
+
+
+# // DEFAULT SETTINGS //
+SUBDIVISIONS_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "subdivisions" # where stores of lookup results are kept
+CHANGES_FILENAME = "changes.csv" # change log appended at each run, in the store folder
+STORE_VERSION = 1 # stores written with another version are recomputed
+
+
+# // INCREMENTAL LOOKUP //
+def update_subdivisions(atlases, cell_ids, coords, microns = False, as_acronym = True, hierarchy_lev = None, rounding = "floor",
+    store = "default", folder = SUBDIVISIONS_FOLDER):
+    """
+    Get the structure ID (and acronym) of every cell for every atlas, only looking up cells that are new or changed since the last run.
+    Returns a DataFrame with columns `areaID_<atlas name>` and `acronym_<atlas name>` (one row per cell, in the order of
+    `cell_ids`) and the change log of this run.
+
+    The change log has one row per cell looked up again (or removed) and per atlas, with the reason ("new", "moved" for
+    new coordinates, "atlas" for a new atlas version or lookup options, "removed" for cells no longer in the input),
+    the previous and new structures, and whether the structure changed.
+
+    :param atlases: dict of {name: BrainGlobeAtlas}
+    :param cell_ids: array-like, unique ID of each cell (e.g. pag_data["cell.id"])
+    :param coords: np.ndarray, (N, 3) array of coordinates
+    :param microns: bool, if true coordinates are interpreted in microns
+    :param as_acronym: bool, if true the acronym columns are added
+    :param hierarchy_lev: int or None, if specified the IDs are rolled up to their parent at this hierarchy level (see atlas_hierarchy.py)
+    :param rounding: str, "floor" or "nearest" (see `coords_to_voxels()`)
+    :param store: str, name of the store (e.g. one per dataset)
+    :param folder: str, Path. Where stores are kept
+    """
+    cell_ids = pd.Index(np.asarray(cell_ids), name = "cell.id")
+    if cell_ids.has_duplicates:
+        raise ValueError(f"Cell IDs should be unique, {cell_ids.duplicated().sum()} are duplicated")
+    coords = np.atleast_2d(np.asarray(coords, dtype = np.float64))
+    hashes = coordinate_hashes(coords)
+    store_folder = Path(folder) / store
+    store_folder.mkdir(parents = True, exist_ok = True)
+
+    columns, changes = {}, []
+    for name, atlas in atlases.items():
+        info = dict(store_version = STORE_VERSION, atlas_version = atlas_version(atlas), microns = microns,
+            rounding = rounding, hierarchy_lev = hierarchy_lev)
+        stored, up_to_date = _load_results(store_folder, name, info)
+
+        # cells looked up again: new cells, moved cells, or all of them when the atlas or the options changed
+        previous = stored.reindex(cell_ids)
+        known = cell_ids.isin(stored.index)
+        if up_to_date:
+            reasons = np.where(known, "moved", "new")
+            lookup = ~known
+            lookup[known] = stored.loc[cell_ids[known], "coord_hash"].values != hashes[known]
+        else:
+            reasons = np.where(known, "atlas", "new")
+            lookup = np.ones(len(cell_ids), dtype = bool)
+
+        results = pd.DataFrame(dict(coord_hash = hashes, areaID = previous["areaID"].values, acronym = previous["acronym"].values.astype(object)),
+            index = cell_ids)
+        cache_hit("subdivisions", int((~lookup).sum()))
+        cache_miss("subdivisions", int(lookup.sum()))
+        if lookup.any():
+            with stage("lookup", atlas = name, cells = int(lookup.sum())):
+                ids = ids_from_coords(atlas, coords[lookup], microns = microns, rounding = rounding)
+                if hierarchy_lev is not None:
+                    ids = get_hierarchy_table(atlas).at_level(ids, hierarchy_lev)
+                results.loc[lookup, "areaID"] = ids
+                results.loc[lookup, "acronym"] = acronyms_from_ids(atlas, ids)
+        results["areaID"] = results["areaID"].astype(np.int64)
+        _save_results(store_folder, name, info, results)
+        logger.debug(f"SUBDIVISIONS: {name} looked up {lookup.sum()} of {len(cell_ids)} cells ({len(stored)} stored)")
+
+        removed = stored.index[~stored.index.isin(cell_ids)]
+        changes.append(pd.DataFrame({
+            "cell.id": np.concatenate([cell_ids[lookup], removed]),
+            "atlas": name,
+            "change": np.concatenate([reasons[lookup], np.full(len(removed), "removed")]),
+            "previous_areaID": np.concatenate([previous["areaID"].values[lookup], stored.loc[removed, "areaID"].values]),
+            "previous_acronym": np.concatenate([previous["acronym"].values[lookup], stored.loc[removed, "acronym"].values]),
+            "areaID": np.concatenate([results["areaID"].values[lookup], np.full(len(removed), np.nan)]),
+            "acronym": np.concatenate([results["acronym"].values[lookup], np.full(len(removed), None)])}))
+
+        columns["areaID_" + name] = results["areaID"].values
+        if as_acronym:
+            columns["acronym_" + name] = results["acronym"].values
+
+    changes = pd.concat(changes, ignore_index = True)
+    changes["changed"] = changes["acronym"].values != changes["previous_acronym"].values
+    _log_changes(store_folder, changes)
+    return pd.DataFrame(columns), changes
+
+
+# // KEYS //
+def coordinate_hashes(coords):
+    """
+    64-bit hash of the coordinates of each cell (stable across runs and platforms)
+
+    :param coords: np.ndarray, (N, 3) array of coordinates
+    """
+    return pd.util.hash_pandas_object(pd.DataFrame(coords), index = False).values
+
+
+def atlas_version(atlas):
+    """
+    Name and version of an atlas (e.g. kim_mouse_10um_v1.0), or its name when the version is not known
+
+    :param atlas: BrainGlobeAtlas
+    """
+    return getattr(atlas, "local_full_name", None) or atlas.atlas_name
+
+
+# // STORE //
+def _load_results(store_folder, name, info):
+    """
+    Stored results of an atlas (empty if there are none) and whether they were computed with the same atlas version and options
+    """
+    filepath, info_path = store_folder / f"{name}.pkl", store_folder / f"{name}.json"
+    if not (filepath.exists() and info_path.exists()):
+        empty = pd.DataFrame(dict(coord_hash = np.zeros(0, np.uint64), areaID = np.zeros(0, np.int64), acronym = np.zeros(0, object)))
+        return empty.rename_axis("cell.id"), True
+    with open(info_path) as f:
+        stored_info = json.load(f)
+    return pd.read_pickle(filepath), stored_info == info
+
+
+def _save_results(store_folder, name, info, results):
+    """
+    Write the results of an atlas and the version and options they were computed with
+    """
+    filepath, info_path = store_folder / f"{name}.pkl", store_folder / f"{name}.json"
+    tmp_file = filepath.with_name(filepath.name + ".tmp")
+    results.to_pickle(tmp_file, compression = None)
+    tmp_file.replace(filepath)
+
+    tmp_file = info_path.with_name(info_path.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(info, f)
+    tmp_file.replace(info_path)
+
+
+def _log_changes(store_folder, changes):
+    """
+    Append the changes of a run, with its date and time, to the change log of the store
+    """
+    if len(changes) == 0:
+        return
+    filepath = store_folder / CHANGES_FILENAME
+    changes.assign(run = datetime.now().isoformat(timespec = "seconds")).to_csv(filepath, mode = "a", header = not filepath.exists(), index = False)
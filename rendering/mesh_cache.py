@@ -0,0 +1,186 @@
+"""
+    On-disk multi-LOD (level of detail) cache of brain region meshes for brainrender scenes.
+
+    The first time a region is requested, its .obj mesh is loaded from the atlas, cut to the requested hemisphere and
+    decimated at several levels of detail. All levels are stored as float32 vertices and int32 triangles in a single .npz
+    file per atlas, region and hemisphere, so later scenes skip parsing .obj files and only read the level they need.
+
+    `CachedScene` is a brainrender Scene whose `add_brain_region` (including the root mesh added when the scene is created)
+    reads meshes from this cache, so existing scripts only need to change the class used to create the scene.
+
+    Example:
+        from mesh_cache import CachedScene
+        scene = CachedScene(root = True, atlas_name = 'allen_mouse_10um', inset = False, quality = "medium")
+        pag = scene.add_brain_region("PAG", alpha = 0.4, color = "darkgoldenrod", silhouette = None, hemisphere = "both")
+"""
+
+from pathlib import Path
+
+import numpy as np
+from vedo import Mesh, load
+from loguru import logger
+
+from brainrender import Scene, settings
+from brainrender.actor import Actor
+from brainrender._utils import listify, return_list_smart
+
+from profiling import stage, cache_hit, cache_miss
+
+
+# // DEFAULT SETTINGS //
+MESH_QUALITY = "high" # render quality setting used to pick the level of detail: "high", "medium", "low" or "preview"
+LOD_FRACTIONS = dict(high = 1.0, medium = 0.5, low = 0.2, preview = 0.05) # fraction of the triangles kept at each level of detail
+MESH_CACHE_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "meshes" # where cached meshes are stored
+KEEP_IN_MEMORY = False # if true, meshes read from disk are also kept in memory (e.g. by batch rendering workers reusing them across scenes)
+
+_loaded = {} # {(filepath, quality): (points, faces)} of the meshes kept in memory
+
+
+# // MESH CACHE //
+def region_mesh(atlas, region, hemisphere = "both", quality = None, cache_folder = MESH_CACHE_FOLDER):
+    """
+    Get the mesh of a brain region at a level of detail, generating and caching all levels on a miss
+
+    :param atlas: BrainGlobeAtlas (e.g. scene.atlas)
+    :param region: str or int, acronym or ID of the region
+    :param hemisphere: str, "both", "left" or "right"
+    :param quality: str, level of detail (one of LOD_FRACTIONS). Defaults to MESH_QUALITY
+    :param cache_folder: str, Path. Where cached meshes are stored
+    """
+    quality = quality or MESH_QUALITY
+    if quality not in LOD_FRACTIONS:
+        raise ValueError(f"Mesh quality should be one of {list(LOD_FRACTIONS.keys())}, not {quality}")
+
+    filepath = mesh_filepath(atlas, region, hemisphere, cache_folder)
+    if not filepath.exists():
+        logger.debug(f"MESH CACHE: miss for {region} ({hemisphere}), generating {list(LOD_FRACTIONS.keys())}")
+        cache_miss("mesh")
+        with stage("mesh.generate", region = region, hemisphere = hemisphere):
+            save_lods(_make_mesh(atlas, region, hemisphere, cache_folder), filepath)
+    else:
+        cache_hit("mesh")
+
+    key = (str(filepath), quality)
+    if key in _loaded:
+        points, faces = _loaded[key]
+    else:
+        with np.load(filepath) as data:
+            points, faces = data[f"points_{quality}"], data[f"faces_{quality}"]
+        if KEEP_IN_MEMORY:
+            _loaded[key] = (points, faces)
+
+    return Mesh([points.copy(), faces])
+
+
+def mesh_filepath(atlas, region, hemisphere, cache_folder = MESH_CACHE_FOLDER):
+    """
+    Path of the cached levels of detail of a region
+
+    :param atlas: BrainGlobeAtlas
+    :param region: str or int, acronym or ID of the region
+    :param hemisphere: str, "both", "left" or "right"
+    :param cache_folder: str, Path. Where cached meshes are stored
+    """
+    atlas_name = getattr(atlas, "local_full_name", None) or atlas.atlas_name # includes the atlas version when available
+    region_id = atlas.structures[region]["id"]
+    return Path(cache_folder) / atlas_name / f"{region_id}_{hemisphere}.npz"
+
+
+def save_lods(mesh, filepath):
+    """
+    Decimate a mesh at every level of detail and save all levels to a single .npz file
+
+    :param mesh: vedo Mesh at full resolution
+    :param filepath: str, Path
+    """
+    arrays = {}
+    for quality, fraction in LOD_FRACTIONS.items():
+        lod = mesh.clone().triangulate()
+        if fraction < 1:
+            lod.decimate(fraction = fraction)
+        arrays[f"points_{quality}"] = np.asarray(lod.points(), dtype = np.float32)
+        arrays[f"faces_{quality}"] = np.asarray(lod.faces(), dtype = np.int32)
+
+    filepath = Path(filepath)
+    filepath.parent.mkdir(parents = True, exist_ok = True)
+    tmp_file = filepath.with_suffix(".tmp.npz")
+    np.savez(tmp_file, **arrays)
+    tmp_file.replace(filepath) # only complete files end up in the cache
+
+
+def _make_mesh(atlas, region, hemisphere, cache_folder):
+    """
+    Load a region's mesh from the atlas and keep only one hemisphere if requested.
+    Like brainrender, hemispheres are split by a sagittal plane through the root's center of mass.
+
+    :param atlas: BrainGlobeAtlas
+    :param region: str or int, acronym or ID of the region
+    :param hemisphere: str, "both", "left" or "right"
+    :param cache_folder: str, Path. Where cached meshes are stored
+    """
+    mesh = load(str(atlas.meshfile_from_structure(region)))
+    if hemisphere == "both":
+        return mesh
+    elif hemisphere not in ("left", "right"):
+        raise ValueError(f"Hemisphere should be 'both', 'left' or 'right', not {hemisphere}")
+
+    root_center = region_mesh(atlas, "root", hemisphere = "both", quality = "high", cache_folder = cache_folder).centerOfMass()
+    mesh.cutWithPlane(origin = root_center, normal = (0, 0, 1) if hemisphere == "right" else (0, 0, -1))
+    return mesh.cap()
+
+
+# // SCENE //
+class CachedScene(Scene):
+    def __init__(self, *args, quality = None, **kwargs):
+        """
+        brainrender Scene whose brain regions (including the root) are read from the mesh cache.
+        Takes the same arguments as brainrender's Scene, plus:
+
+        :param quality: str, level of detail of the regions meshes (one of LOD_FRACTIONS). Defaults to MESH_QUALITY
+        """
+        self.quality = quality or MESH_QUALITY
+        Scene.__init__(self, *args, **kwargs)
+
+    def add_brain_region(self, *regions, alpha = 1, color = None, silhouette = None, hemisphere = "both", force = False, quality = None):
+        """
+        Same as brainrender's `Scene.add_brain_region`, with meshes read from the cache
+
+        :param regions: str. String of regions names
+        :param alpha: float
+        :param color: str. If None the atlas default color is used
+        :param silhouette: bool. If true regions Actors will have a silhouette
+        :param hemisphere: str, "both", "left" or "right"
+        :param force: force adding of region even if already rendered
+        :param quality: str, level of detail of the meshes. Defaults to the scene's quality
+        """
+        if silhouette is None:
+            silhouette = settings.SHADER_STYLE == "cartoon"
+
+        # avoid adding regions already rendered
+        if not force:
+            already_in = [r.name for r in self.get_actors(br_class = "brain region")]
+            regions = [r for r in regions if r not in already_in]
+
+        actors = []
+        for region in regions:
+            if region not in self.atlas.lookup_df.acronym.values and region not in self.atlas.lookup_df["id"].values:
+                print(f"The region {region} doesn't seem to belong to the atlas being used: {self.atlas.atlas_name}. Skipping")
+                continue
+
+            mesh = region_mesh(self.atlas, region, hemisphere = hemisphere, quality = quality or self.quality)
+            region_color = color if color is not None else [x / 255 for x in self.atlas._get_from_structure(region, "rgb_triplet")]
+
+            actor = Actor(mesh, name = region, br_class = "brain region")
+            actor.c(region_color).alpha(alpha)
+            actors.append(actor)
+
+        if not actors: # they were all already rendered
+            return None
+
+        actors = listify(self.add(*actors))
+
+        # make silhouettes
+        if silhouette and alpha:
+            self.add_silhouette(*actors)
+
+        return return_list_smart(actors)
@@ -0,0 +1,289 @@
+"""
+    Typed columnar cache of the scRNA-seq metadata CSV, read column by column.
+
+    `pd.read_csv` parses every column of the metadata (as object or float64) each time a script or notebook starts, while
+    only a handful of columns are used (cell.id, cell.type, PAG.area, PAG.hemisphere, a cluster column and the CCF coordinates).
+    The CSV is converted once, in chunks (so files larger than memory can be converted), into one binary file per column:
+    string columns are stored as categoricals (int32 codes, and their categories in a file of their own so they are only
+    read with their column), CCF coordinates as float32, boolean columns
+    as bool and other numerical columns as float64 (cast back to int64 when they only hold integers). The type of each column
+    is guessed from the first rows; a column that turns out to hold other values further down is converted again as categories.
+
+    The cache is rebuilt when the CSV changes: its size and modification time are checked on every load and, if the
+    modification time changed but not the size, its hash is compared to the hash of the converted file. Later loads only
+    read the files of the requested columns, and `iter_metadata` streams a table in chunks of rows.
+
+    Example:
+        from metadata_cache import load_metadata
+        pag_data = load_metadata("PAG_scRNAseq_metadata_211018.csv", columns = ["cell.id", "cell.type", "PAG.area", "CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"])
+"""
+
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from profiling import stage, cache_hit, cache_miss
+
+
+# // DEFAULT SETTINGS //
+METADATA_CACHE_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "metadata" # where converted CSVs are stored
+COORDINATE_PREFIXES = ("CCF.",) # columns starting with these are stored as float32 (e.g. CCF.AllenAP)
+CONVERT_CHUNKSIZE = 200000 # number of rows of the CSV parsed at once when converting it
+SNIFF_ROWS = 10000 # number of rows used to decide the type of each column
+CACHE_VERSION = 3 # caches written with another version are converted again
+
+
+# // LOADING //
+def load_metadata(csv_path, columns = None, cache_folder = METADATA_CACHE_FOLDER, **read_csv_kwargs):
+    """
+    Metadata table from the columnar cache of a CSV (converting the CSV the first time, or when it has changed).
+    Only the requested columns are read.
+
+    :param csv_path: str, Path. Metadata CSV
+    :param columns: list of str, columns to load (defaults to all columns, in the order of the CSV)
+    :param cache_folder: str, Path. Where converted CSVs are stored
+    :param read_csv_kwargs: keyword arguments passed to pd.read_csv when converting the CSV (e.g. sep)
+    """
+    folder, manifest = _cached(csv_path, cache_folder, read_csv_kwargs)
+    return pd.DataFrame({name: _read_column(folder, manifest, name) for name in _columns(manifest, columns)})
+
+
+def iter_metadata(csv_path, columns = None, chunksize = CONVERT_CHUNKSIZE, cache_folder = METADATA_CACHE_FOLDER, **read_csv_kwargs):
+    """
+    Metadata table from the columnar cache of a CSV in chunks of rows (columns are memory-mapped, only a chunk is in memory at a time).
+    Chunks keep the row positions of the full table as index.
+
+    :param csv_path: str, Path. Metadata CSV
+    :param columns: list of str, columns to load (defaults to all columns, in the order of the CSV)
+    :param chunksize: int, number of rows per chunk
+    :param cache_folder: str, Path. Where converted CSVs are stored
+    :param read_csv_kwargs: keyword arguments passed to pd.read_csv when converting the CSV (e.g. sep)
+    """
+    folder, manifest = _cached(csv_path, cache_folder, read_csv_kwargs)
+    columns = _columns(manifest, columns)
+    arrays = {name: _read_column(folder, manifest, name, mmap = True) for name in columns}
+    categories = {name: _read_categories(folder, spec) for name, spec in manifest["columns"].items() if name in columns and spec["kind"] == "category"}
+
+    for start in range(0, manifest["n_rows"], chunksize):
+        rows = slice(start, min(start + chunksize, manifest["n_rows"]))
+        chunk = {}
+        for name in columns:
+            spec = manifest["columns"][name]
+            if spec["kind"] == "category":
+                chunk[name] = pd.Categorical.from_codes(np.array(arrays[name][rows]), categories = categories[name])
+            else:
+                chunk[name] = np.array(arrays[name][rows]).astype(spec["dtype"], copy = False)
+        yield pd.DataFrame(chunk, index = pd.RangeIndex(rows.start, rows.stop))
+
+
+def metadata_columns(csv_path, cache_folder = METADATA_CACHE_FOLDER, **read_csv_kwargs):
+    """
+    Columns of a metadata CSV and how they are stored ({column: "category", "float32", "float64" or "int64"})
+
+    :param csv_path: str, Path. Metadata CSV
+    :param cache_folder: str, Path. Where converted CSVs are stored
+    """
+    _, manifest = _cached(csv_path, cache_folder, read_csv_kwargs)
+    return {name: spec["kind"] if spec["kind"] == "category" else spec["dtype"] for name, spec in manifest["columns"].items()}
+
+
+# // CACHE //
+def _cached(csv_path, cache_folder, read_csv_kwargs):
+    """
+    Folder and manifest of the cache of a CSV, converting the CSV if the cache is missing or out of date
+    """
+    csv_path = Path(csv_path).resolve()
+    folder = Path(cache_folder) / f"{csv_path.stem}-{hashlib.sha1(str(csv_path).encode()).hexdigest()[:12]}"
+    stat = csv_path.stat()
+    options = json.dumps(read_csv_kwargs, sort_keys = True, default = str)
+
+    manifest_file = folder / "manifest.json"
+    if manifest_file.exists():
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get("version") == CACHE_VERSION and manifest["options"] == options and manifest["size"] == stat.st_size:
+            if manifest["mtime_ns"] == stat.st_mtime_ns:
+                cache_hit("metadata")
+                return folder, manifest
+            if manifest["sha1"] == _file_hash(csv_path): # touched or copied, but not changed
+                manifest["mtime_ns"] = stat.st_mtime_ns
+                _write_manifest(folder, manifest)
+                logger.debug(f"METADATA CACHE: {csv_path.name} has a new modification time but the same content")
+                cache_hit("metadata")
+                return folder, manifest
+        logger.debug(f"METADATA CACHE: {csv_path.name} has changed, converting it again")
+
+    cache_miss("metadata")
+    with stage("metadata.convert", csv = csv_path.name):
+        return folder, _convert(csv_path, folder, read_csv_kwargs, options)
+
+
+def _convert(csv_path, folder, read_csv_kwargs, options):
+    """
+    Convert a CSV into one binary file per column, in chunks of rows. The cache is replaced once it's complete.
+    """
+    logger.debug(f"METADATA CACHE: converting {csv_path.name}")
+    stat = csv_path.stat()
+    sha1 = _file_hash(csv_path)
+
+    # the type of each column is guessed from the first rows, then checked on every chunk
+    sample = pd.read_csv(csv_path, nrows = SNIFF_ROWS, **read_csv_kwargs)
+    specs = {}
+    for i, name in enumerate(sample.columns):
+        if pd.api.types.is_bool_dtype(sample[name]):
+            specs[name] = dict(file = f"{i}.bin", kind = "bool", stored = "bool", dtype = "bool")
+        elif pd.api.types.is_numeric_dtype(sample[name]):
+            coordinate = str(name).startswith(COORDINATE_PREFIXES)
+            specs[name] = dict(file = f"{i}.bin", kind = "number", stored = "float32" if coordinate else "float64",
+                dtype = "float32" if coordinate else "float64", integer = pd.api.types.is_integer_dtype(sample[name]))
+        else:
+            specs[name] = _category_spec(f"{i}.bin")
+
+    tmp_folder = folder.with_name(folder.name + ".tmp")
+    while True:
+        n_rows, failed = _write_columns(csv_path, tmp_folder, specs, read_csv_kwargs)
+        if failed is None:
+            break
+        # e.g. a string after SNIFF_ROWS numbers, or a missing value in a boolean column: convert again with the column as categories
+        logger.debug(f"METADATA CACHE: {failed} has values that are not {specs[failed]['kind']}s after the first rows, storing it as categories")
+        specs[failed] = _category_spec(specs[failed]["file"])
+
+    # categories are sorted (as with `astype("category")`) and the codes renumbered accordingly
+    for name, spec in specs.items():
+        if spec["kind"] == "category":
+            categories = sorted(spec["categories"], key = lambda c: spec["categories"][c])
+            order = np.argsort(np.array(categories, dtype = object), kind = "stable") if categories else np.zeros(0, dtype = np.intp)
+            renumber = np.empty(len(categories) + 1, dtype = np.int32)
+            renumber[order] = np.arange(len(categories), dtype = np.int32)
+            renumber[-1] = -1
+            codes = np.memmap(tmp_folder / spec["file"], dtype = np.int32, mode = "r+") if n_rows else np.zeros(0, dtype = np.int32)
+            for start in range(0, n_rows, CONVERT_CHUNKSIZE):
+                codes[start:start + CONVERT_CHUNKSIZE] = renumber[codes[start:start + CONVERT_CHUNKSIZE]]
+            if n_rows:
+                codes.flush()
+            del codes
+            with open(tmp_folder / spec["categories_file"], "w") as f:
+                json.dump([categories[i] for i in order], f)
+            del spec["categories"] # only kept in the manifest while converting
+        elif spec["kind"] == "number" and spec.pop("integer"):
+            spec["dtype"] = "int64"
+
+    manifest = dict(version = CACHE_VERSION, source = str(csv_path), size = stat.st_size, mtime_ns = stat.st_mtime_ns,
+        sha1 = sha1, options = options, n_rows = n_rows, columns = specs)
+    _write_manifest(tmp_folder, manifest) # written last: a cache is only used once its manifest exists
+    shutil.rmtree(folder, ignore_errors = True)
+    tmp_folder.replace(folder)
+    logger.debug(f"METADATA CACHE: converted {csv_path.name} ({n_rows} rows, {len(specs)} columns)")
+    return manifest
+
+
+def _write_columns(csv_path, tmp_folder, specs, read_csv_kwargs):
+    """
+    Parse the CSV in chunks of rows and write one binary file per column. Returns the number of rows and the first column
+    whose values don't match its type (None if all of them do), in which case the files are incomplete.
+    """
+    shutil.rmtree(tmp_folder, ignore_errors = True)
+    tmp_folder.mkdir(parents = True)
+    dtypes = {name: str for name, spec in specs.items() if spec["kind"] == "category"} # other columns are parsed by pandas and checked
+    files = {name: open(tmp_folder / spec["file"], "wb") for name, spec in specs.items()}
+    n_rows = 0
+    try:
+        for chunk in pd.read_csv(csv_path, dtype = dtypes, chunksize = CONVERT_CHUNKSIZE, **read_csv_kwargs):
+            for name, spec in specs.items():
+                values = chunk[name]
+                if spec["kind"] == "category":
+                    # codes of the chunk's values in the categories found so far (new values get the next codes)
+                    local_codes, uniques = pd.factorize(values)
+                    mapping = np.array([spec["categories"].setdefault(u, len(spec["categories"])) for u in uniques] + [-1], dtype = np.int32)
+                    mapping[local_codes].tofile(files[name]) # code -1 (missing value) takes the last entry of the mapping
+                elif spec["kind"] == "bool":
+                    if not pd.api.types.is_bool_dtype(values):
+                        return n_rows, name
+                    values.to_numpy(dtype = bool).tofile(files[name])
+                else:
+                    try:
+                        values = pd.to_numeric(values).to_numpy(dtype = np.float64)
+                    except (ValueError, TypeError):
+                        return n_rows, name
+                    if spec["integer"]:
+                        spec["integer"] = bool(np.all(np.isfinite(values)) and np.all(values == np.round(values)))
+                    values.astype(spec["stored"]).tofile(files[name])
+            n_rows += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+    return n_rows, None
+
+
+def _category_spec(file):
+    """
+    How a column of strings is stored: int32 codes in `file`, and its categories (in the order of their codes) in a .json file next to it
+    """
+    return dict(file = file, categories_file = file.replace(".bin", ".categories.json"), kind = "category", stored = "int32",
+        dtype = "category", categories = {})
+
+
+def _read_column(folder, manifest, name, mmap = False):
+    """
+    A column of the cache: a pd.Categorical for string columns, an array otherwise (memory-mapped codes or values if mmap)
+    """
+    spec = manifest["columns"][name]
+    filepath = folder / spec["file"]
+    if mmap:
+        if manifest["n_rows"] == 0:
+            return np.zeros(0, dtype = spec["stored"])
+        return np.memmap(filepath, dtype = spec["stored"], mode = "r", shape = (manifest["n_rows"],))
+
+    values = np.fromfile(filepath, dtype = spec["stored"])
+    if spec["kind"] == "category":
+        return pd.Categorical.from_codes(values, categories = _read_categories(folder, spec))
+    return values.astype(spec["dtype"], copy = False)
+
+
+def _read_categories(folder, spec):
+    """
+    Categories of a string column of the cache
+    """
+    with open(folder / spec["categories_file"]) as f:
+        return json.load(f)
+
+
+def _columns(manifest, columns):
+    """
+    Requested columns (all columns if None), checking that they are in the CSV
+    """
+    if columns is None:
+        return list(manifest["columns"].keys())
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    missing = [c for c in columns if c not in manifest["columns"]]
+    if missing:
+        raise KeyError(f"Columns {missing} are not in {Path(manifest['source']).name}. Available columns: {list(manifest['columns'].keys())}")
+    return columns
+
+
+# // UTILS //
+def _file_hash(filepath, block_size = 2 ** 20):
+    """
+    sha1 of a file, read in blocks
+    """
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _write_manifest(folder, manifest):
+    """
+    Write the manifest of a cache (only complete files end up in the cache)
+    """
+    filepath = Path(folder) / "manifest.json"
+    tmp_file = filepath.with_name(filepath.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    tmp_file.replace(filepath)
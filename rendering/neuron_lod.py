@@ -0,0 +1,256 @@
+"""
+    Level-of-detail (LOD) rendering of neuron morphologies under a triangle budget.
+
+    Full tubes (NEURON_RESOLUTION = 16 sides) turn an axonal arbor into hundreds of thousands of triangles, so a scene with
+    dozens of neurons can't be rotated smoothly. Each neurite (the axon or the dendrites of a neuron) is given three
+    representations: plain polylines (no triangles), low resolution tubes and full tubes. Before every render the
+    camera is checked and, if it moved, neurites are ranked by their apparent size (bounding radius over distance to the
+    camera): the largest on screen get low resolution tubes, then full tubes, as long as the total number of triangles
+    stays within the budget. The others are drawn as polylines. Somata are always drawn as spheres.
+
+    Switching happens in a callback of the renderer, so it applies to interactive rendering as well as to screenshots
+    and videos made with brainrender's VideoMaker and Animation.
+
+    Example:
+        from neuron_store import NeuronStore
+        from neuron_lod import NeuronLOD
+        lod = NeuronLOD(NeuronStore(), neuron_ids, color = dict(soma = "blackboard", dendrites = "olivedrab", axon = "lightgreen"))
+        lod.add_to(scene) # then scene.render() as usual
+"""
+
+import argparse
+import time
+
+import numpy as np
+from loguru import logger
+
+from neuron_store import NeuronStore, mesh_actor, _neuron_colors, NEURON_RESOLUTION, NEURITE_RADIUS, SOMA_RADIUS, AXON, DENDRITE
+
+
+# // DEFAULT SETTINGS //
+TRIANGLE_BUDGET = 2000000 # maximum number of neurite triangles rendered at once
+LOW_RESOLUTION = 4 # number of sides of the low resolution tubes
+LEVELS = ("lines", "low", "full") # representations of each neurite, from the cheapest
+LINE_WIDTH = 1 # width (in pixels) of the polylines
+
+
+# // LEVEL OF DETAIL //
+def choose_levels(sizes, triangles, budget = TRIANGLE_BUDGET):
+    """
+    Level (index in LEVELS) of each neurite: neurites are upgraded in order of apparent size, first all to low resolution
+    tubes, then to full tubes, skipping those that would exceed the budget.
+
+    :param sizes: np.ndarray, apparent size of each neurite (larger first)
+    :param triangles: np.ndarray, (n neurites, n levels) number of triangles of each neurite at each level
+    :param budget: int, maximum total number of triangles
+    """
+    triangles = np.asarray(triangles, dtype = np.int64)
+    levels = np.zeros(len(triangles), dtype = np.intp)
+    total = int(triangles[:, 0].sum())
+    order = np.argsort(-np.asarray(sizes), kind = "stable")
+    for level in range(1, triangles.shape[1]):
+        for i in order:
+            extra = int(triangles[i, level] - triangles[i, levels[i]])
+            if total + extra <= budget:
+                levels[i] = level
+                total += extra
+    return levels
+
+
+class NeuronLOD:
+    def __init__(self, store, neuron_ids, color = "salmon", alpha = 0.8, triangle_budget = TRIANGLE_BUDGET, low_resolution = LOW_RESOLUTION,
+        resolution = NEURON_RESOLUTION, neurite_radius = NEURITE_RADIUS, soma_radius = SOMA_RADIUS, workers = None):
+        """
+        Actors of neurons of a NeuronStore at three levels of detail, only one of which is visible for each neurite
+
+        :param store: NeuronStore
+        :param neuron_ids: list of str
+        :param color: str (a color or a matplotlib colormap), list of colors (one per neuron) or dict {component: color}
+        :param alpha: float
+        :param triangle_budget: int, maximum number of neurite triangles rendered at once (None for no limit)
+        :param low_resolution: int, number of sides of the low resolution tubes
+        :param resolution: int, number of sides of the full tubes (and of the somata)
+        :param neurite_radius: float, radius (in microns) of the axon and dendrites
+        :param soma_radius: float, radius (in microns) of the somata
+        :param workers: int, number of worker processes building missing meshes
+        """
+        neuron_ids = [neuron_ids] if isinstance(neuron_ids, str) else list(neuron_ids)
+        self.triangle_budget = np.inf if triangle_budget is None else triangle_budget
+        low = store.meshes(neuron_ids, resolution = low_resolution, neurite_radius = neurite_radius, soma_radius = soma_radius, workers = workers)
+        full = store.meshes(neuron_ids, resolution = resolution, neurite_radius = neurite_radius, soma_radius = soma_radius, workers = workers)
+
+        self.somata, self.neurites = [], [] # soma actors and {"name", "actors" (one per level), "triangles"} of each neurite
+        for nid, neuron_color in zip(neuron_ids, _neuron_colors(color, len(neuron_ids))):
+            colors = neuron_color if isinstance(neuron_color, dict) else dict(soma = neuron_color, axon = neuron_color, dendrites = neuron_color)
+            if "soma" in full[nid]:
+                self.somata.append(mesh_actor(*full[nid]["soma"], name = f"{nid} soma", color = colors["soma"], alpha = alpha))
+
+            morphology = store.morphology(nid)
+            for component, node_type in (("axon", AXON), ("dendrites", DENDRITE)):
+                if component not in full[nid]:
+                    continue
+                name = f"{nid} {component}"
+                nodes = np.flatnonzero(morphology["types"] == node_type)
+                actors = [
+                    lines_actor(morphology["points"], morphology["parents"], nodes = nodes, name = f"{name} (lines)", color = colors[component], alpha = alpha),
+                    mesh_actor(*low[nid][component], name = f"{name} (low)", color = colors[component], alpha = alpha),
+                    mesh_actor(*full[nid][component], name = name, color = colors[component], alpha = alpha),
+                    ]
+                triangles = [0, len(low[nid][component][1]), len(full[nid][component][1])]
+                self.neurites.append(dict(name = name, actors = actors, triangles = triangles))
+
+        self.triangles = np.array([n["triangles"] for n in self.neurites], dtype = np.int64).reshape(-1, len(LEVELS))
+        self.levels = np.zeros(len(self.neurites), dtype = np.intp)
+        self._spheres = None # bounding sphere (center, radius) of each neurite, in the space of the rendered actors
+        self._camera = None # camera state of the last update
+
+    def __repr__(self):
+        return f"NeuronLOD of {len(self.neurites)} neurites: {self.level_counts()} ({self.n_triangles()} triangles, budget {self.triangle_budget})"
+
+    @property
+    def actors(self):
+        return self.somata + [actor for neurite in self.neurites for actor in neurite["actors"]]
+
+    def add_to(self, scene):
+        """
+        Add all actors to a scene and update the levels of detail before each render of the scene
+
+        :param scene: Scene
+        """
+        for actor in self.actors:
+            scene.add(actor)
+        self.show_levels(np.full(len(self.neurites), LEVELS.index("low")))
+
+        renderer = scene.plotter.renderer
+        renderer.AddObserver("StartEvent", lambda *args: self.update(renderer.GetActiveCamera()))
+        return self
+
+    def update(self, camera, force = False):
+        """
+        Choose the level of detail of each neurite for a camera (only if the camera moved since the last update)
+
+        :param camera: vtkCamera
+        :param force: bool, if true update even if the camera didn't move
+        """
+        state = camera.GetPosition() + camera.GetFocalPoint() + (camera.GetViewAngle(),)
+        if state == self._camera and not force:
+            return self.levels
+        self._camera = state
+
+        if self._spheres is None: # bounds are read once the actors have been placed in the scene by brainrender
+            bounds = np.array([n["actors"][0].mesh.GetBounds() for n in self.neurites]).reshape(-1, 3, 2)
+            self._spheres = (bounds.mean(axis = 2), np.linalg.norm(bounds[:, :, 1] - bounds[:, :, 0], axis = 1) / 2)
+        centers, radii = self._spheres
+        distances = np.maximum(np.linalg.norm(centers - np.asarray(camera.GetPosition()), axis = 1), 1e-6)
+
+        levels = choose_levels(radii / distances, self.triangles, self.triangle_budget)
+        if np.any(levels != self.levels):
+            self.show_levels(levels)
+            logger.debug(f"NEURON LOD: {self.level_counts()} ({self.n_triangles()} triangles)")
+        return self.levels
+
+    def show_levels(self, levels):
+        """
+        Show each neurite at a level of detail (index in LEVELS) and hide its other representations
+
+        :param levels: np.ndarray, level of each neurite
+        """
+        for neurite, level in zip(self.neurites, levels):
+            for i, actor in enumerate(neurite["actors"]):
+                actor.mesh.SetVisibility(i == level)
+        self.levels = np.asarray(levels, dtype = np.intp)
+
+    def n_triangles(self):
+        """
+        Number of neurite triangles currently rendered
+        """
+        return int(self.triangles[np.arange(len(self.levels)), self.levels].sum())
+
+    def level_counts(self):
+        return {name: int(np.sum(self.levels == i)) for i, name in enumerate(LEVELS)}
+
+
+def lines_actor(points, parents, nodes = None, name = "neurite", color = "salmon", alpha = 1, lw = LINE_WIDTH):
+    """
+    brainrender actor with a line per segment of a tree (a node and its parent)
+
+    :param points: np.ndarray, (N, 3) coordinates of the nodes
+    :param parents: np.ndarray, (N,) index of the parent of each node (-1 for roots)
+    :param nodes: np.ndarray, only use the segments ending at these nodes (defaults to all nodes)
+    :param name: str, name of the actor
+    :param color: str
+    :param alpha: float
+    :param lw: float, width of the lines (in pixels)
+    """
+    import vtk
+    from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray
+    from vedo import Mesh
+    from brainrender.actor import Actor
+
+    parents = np.asarray(parents)
+    children = np.flatnonzero(parents >= 0) if nodes is None else np.asarray(nodes)[parents[nodes] >= 0]
+
+    polydata = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(np.ascontiguousarray(points, dtype = np.float32), deep = True))
+    polydata.SetPoints(vtk_points)
+    cells = np.column_stack([np.full(len(children), 2, dtype = np.int64), parents[children], children]).ravel() # [2, parent, child, 2, ...]
+    lines = vtk.vtkCellArray()
+    lines.SetCells(len(children), numpy_to_vtkIdTypeArray(cells, deep = True))
+    polydata.SetLines(lines)
+
+    actor = Actor(Mesh(polydata), name = name, br_class = "Neuron")
+    actor.c(color).alpha(alpha).lw(lw)
+    return actor
+
+
+# // BENCHMARK //
+def benchmark(neuron_ids, store = None, budgets = (None, TRIANGLE_BUDGET), n_frames = 60, azimuth = 3, **kwargs):
+    """
+    Rotate the camera around a scene with neurons and report the number of triangles and the time per frame for several budgets
+
+    :param neuron_ids: list of str, neurons of the store
+    :param store: NeuronStore (defaults to the default store)
+    :param budgets: list of int, triangle budgets to test (None for full tubes everywhere)
+    :param n_frames: int, number of frames rendered
+    :param azimuth: float, rotation in degrees per frame
+    :param kwargs: keyword arguments passed to NeuronLOD (e.g. color, low_resolution)
+    """
+    from brainrender import Scene, settings
+
+    settings.OFFSCREEN = True
+    store = store or NeuronStore()
+    results = []
+    for budget in budgets:
+        scene = Scene(root = True, inset = False)
+        lod = NeuronLOD(store, neuron_ids, triangle_budget = budget, **kwargs).add_to(scene)
+        scene.render(interactive = False, camera = "sagittal", zoom = 1)
+
+        window, camera = scene.plotter.window, scene.plotter.renderer.GetActiveCamera()
+        triangles, times = [], []
+        for _ in range(n_frames):
+            camera.Azimuth(azimuth)
+            start = time.perf_counter()
+            window.Render()
+            times.append(time.perf_counter() - start)
+            triangles.append(lod.n_triangles())
+        scene.close()
+
+        frame_time = float(np.mean(times))
+        results.append(dict(budget = budget, neurites = len(lod.neurites), triangles = float(np.mean(triangles)),
+            max_triangles = int(lod.triangles[:, -1].sum()), frame_time = frame_time, fps = 1 / frame_time))
+        print(f"budget: {str(budget):>10} | triangles: {np.mean(triangles):12,.0f} / {lod.triangles[:, -1].sum():12,d} | "
+            f"frame: {1000 * frame_time:7.1f}ms | {1 / frame_time:6.1f} frames/s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark neuron rendering with and without levels of detail")
+    parser.add_argument("neurons", nargs = "+", help = "IDs of neurons in the neuron store")
+    parser.add_argument("--budgets", type = int, nargs = "+", default = [TRIANGLE_BUDGET], help = "triangle budgets to test (full tubes are always tested)")
+    parser.add_argument("--frames", type = int, default = 60, help = "number of frames rendered")
+    parser.add_argument("--local-folder", default = None, help = "folder of .json or .swc reconstructions used instead of the MouseLight API")
+    args = parser.parse_args()
+
+    store = NeuronStore(local_folder = args.local_folder)
+    benchmark(store.fetch(args.neurons), store = store, budgets = [None] + args.budgets, n_frames = args.frames)
@@ -0,0 +1,397 @@
+"""
+    Local store of MouseLight neuron reconstructions (https://ml-neuronbrowser.janelia.org/) and of their meshes.
+
+    `MouseLightAPI.download_neurons` downloads neurons one after the other, and brainrender then builds the tubes of every
+    neuron serially each time a scene is created. Here neurons are downloaded concurrently (retrying failed downloads)
+    and each reconstruction is stored as a small .npz file: float32 node coordinates (AP, DV, ML in microns), int32
+    parent index and int8 node type (1 soma, 2 axon, 3 dendrite). Neurons already in the store are skipped, so an
+    interrupted download resumes where it stopped.
+
+    Soma, axon and dendrite meshes are built with numpy in a pool of worker processes (one cylinder per segment of the
+    reconstruction, a sphere for the soma) and cached by neuron ID, resolution, neurite radius and soma radius.
+    Later scenes only read float32 vertices and int32 triangles from disk. Worker processes re-import the main module where
+    processes are spawned (Windows, macOS), so scripts building meshes in parallel must run under `if __name__ == "__main__":`,
+    otherwise pass `workers = 1` to build them in the calling process.
+
+    For offline use (or tests), a folder with reconstructions saved as `<neuron id>.json` (neuronbrowser format) or
+    `<neuron id>.swc` can stand in for the MouseLight API. MouseLight's .swc files are (ML, DV, AP), like its .json files,
+    and are reordered to (AP, DV, ML) when they are downloaded (set LOCAL_SWC_INVERT_DIMS for local files in that order).
+
+    Example:
+        from neuron_store import NeuronStore
+        store = NeuronStore()
+        neuron_ids = store.fetch(mlapi.fetch_neurons_metadata(filterby = "soma", filter_regions = ["PAG"]), workers = 8)
+        actors = store.add_neurons(scene, neuron_ids, color = dict(soma = "blackboard", dendrites = "olivedrab", axon = "lightgreen"))
+"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+from profiling import stage, cache_hit, cache_miss
+
+
+# // DEFAULT SETTINGS //
+NEURON_STORE_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "neurons" # where reconstructions and meshes are stored
+LOCAL_NEURONS_FOLDER = None # folder of `<neuron id>.json` or `.swc` reconstructions used instead of the MouseLight API (offline use)
+FETCH_WORKERS = 8 # number of concurrent downloads
+RETRIES = 3 # number of attempts for each download
+RETRY_DELAY = 1 # seconds before retrying a download (doubled at each attempt)
+NEURON_RESOLUTION = 16 # number of sides of the neurites' tubes (and of the soma's sphere)
+NEURITE_RADIUS = 8 # radius (in microns) of the axon and dendrites
+SOMA_RADIUS = 40 # radius (in microns) of the soma
+COMPONENTS = ("soma", "axon", "dendrites") # meshes built for each neuron
+SOMA, AXON, DENDRITE = 1, 2, 3 # node types (as in SWC files, apical dendrites are stored as dendrites)
+LOCAL_SWC_INVERT_DIMS = False # if true, local .swc files are (ML, DV, AP) like MouseLight's and are reordered to (AP, DV, ML)
+STORE_VERSION = 2 # reconstructions and meshes stored with another version are downloaded and built again
+
+
+# // STORE //
+class NeuronStore:
+    def __init__(self, folder = NEURON_STORE_FOLDER, local_folder = None):
+        """
+        Local store of neuron reconstructions and meshes
+
+        :param folder: str, Path. Where reconstructions and meshes are stored
+        :param local_folder: str, Path. Folder of `<neuron id>.json` or `.swc` reconstructions used instead of the MouseLight API. Defaults to LOCAL_NEURONS_FOLDER
+        """
+        self.folder = Path(folder)
+        self.local_folder = local_folder or LOCAL_NEURONS_FOLDER
+
+    def __repr__(self):
+        return f"NeuronStore at {self.folder} ({len(self.cached_neurons())} neurons)"
+
+    def cached_neurons(self):
+        """
+        IDs of the neurons in the store
+        """
+        return sorted(f.stem for f in self._morphology_filepath("*").parent.glob("*.npz"))
+
+    def is_cached(self, neuron_id):
+        return self._morphology_filepath(neuron_id).exists()
+
+    # --------------------------------- fetching -------------------------------- #
+    def fetch(self, neurons, workers = FETCH_WORKERS, retries = RETRIES):
+        """
+        Make sure neurons are in the store, downloading the missing ones concurrently. Returns the IDs of the neurons in the store
+        (in the order given). Neurons that fail to download after all retries are logged and left out; fetching again resumes with them.
+
+        :param neurons: list of str (neuron IDs, e.g. "AA0001") or of neurons metadata from `MouseLightAPI.fetch_neurons_metadata()`
+        :param workers: int, number of concurrent downloads
+        :param retries: int, number of attempts for each download
+        """
+        neurons = {_neuron_id(n): n for n in neurons}
+        missing = [nid for nid in neurons if not self.is_cached(nid)]
+        cache_hit("neuron", len(neurons) - len(missing))
+        cache_miss("neuron", len(missing))
+        if missing:
+            logger.debug(f"NEURONS: {len(neurons) - len(missing)} neurons in the store, downloading {len(missing)}")
+
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            futures = {pool.submit(self._fetch_neuron, neurons[nid], retries): nid for nid in missing}
+            for n, future in enumerate(as_completed(futures), start = 1):
+                nid = futures[future]
+                try:
+                    future.result()
+                    logger.debug(f"NEURONS: [{n}/{len(missing)}] stored {nid}")
+                except Exception as e:
+                    logger.warning(f"NEURONS: could not download {nid}: {e}")
+
+        return [nid for nid in neurons if self.is_cached(nid)]
+
+    def _fetch_neuron(self, neuron, retries = RETRIES):
+        """
+        Download a neuron (retrying with increasing delays) and store its reconstruction
+        """
+        for attempt in range(retries):
+            try:
+                with stage("download.neuron", neuron = _neuron_id(neuron), attempt = attempt):
+                    morphology = self._download(neuron)
+                break
+            except Exception:
+                if attempt == retries - 1:
+                    raise
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+
+        _save_npz(self._morphology_filepath(_neuron_id(neuron)), **morphology)
+
+    def _download(self, neuron):
+        """
+        Reconstruction of a neuron from the local folder or the MouseLight API, as arrays
+        """
+        nid = _neuron_id(neuron)
+        if self.local_folder is not None:
+            filepath = Path(self.local_folder) / f"{nid}.json"
+            return read_morphology(filepath if filepath.exists() else filepath.with_suffix(".swc"), invert_dims = LOCAL_SWC_INVERT_DIMS)
+
+        from morphapi.api.mouselight import MouseLightAPI
+
+        if isinstance(neuron, str):
+            raise ValueError(f"Downloading {nid} from MouseLight needs its metadata (from MouseLightAPI.fetch_neurons_metadata)")
+        downloaded = MouseLightAPI().download_neurons([neuron])[0]
+        return read_morphology(downloaded.data_file, invert_dims = True) # MouseLight's .swc files are (ML, DV, AP)
+
+    # ------------------------------- morphologies ------------------------------ #
+    def morphology(self, neuron_id):
+        """
+        Reconstruction of a neuron in the store: {"points": (N, 3) float32 (AP, DV, ML microns), "parents": (N,) int32 (-1 for roots),
+        "types": (N,) int8 (SOMA, AXON or DENDRITE)}
+
+        :param neuron_id: str
+        """
+        with np.load(self._morphology_filepath(neuron_id)) as data:
+            return {key: data[key] for key in data.files}
+
+    # ---------------------------------- meshes --------------------------------- #
+    def meshes(self, neuron_ids, resolution = NEURON_RESOLUTION, neurite_radius = NEURITE_RADIUS, soma_radius = SOMA_RADIUS, workers = None):
+        """
+        Soma, axon and dendrite meshes of neurons in the store, as {neuron id: {component: (points, faces)}}. Missing meshes
+        are built in a pool of worker processes and cached. Components without nodes (e.g. neurons without dendrites) are left out.
+
+        :param neuron_ids: list of str
+        :param resolution: int, number of sides of the neurites' tubes
+        :param neurite_radius: float, radius (in microns) of the axon and dendrites
+        :param soma_radius: float, radius (in microns) of the soma
+        :param workers: int, number of worker processes (defaults to the number of cores). Use 1 in scripts without a main guard
+        """
+        neuron_ids = [neuron_ids] if isinstance(neuron_ids, str) else list(neuron_ids)
+        params = (resolution, neurite_radius, soma_radius)
+        missing = [nid for nid in neuron_ids if not self._mesh_filepath(nid, *params).exists()]
+        cache_hit("neuron_mesh", len(neuron_ids) - len(missing))
+        cache_miss("neuron_mesh", len(missing))
+
+        if missing:
+            logger.debug(f"NEURONS: building the meshes of {len(missing)} neurons")
+            jobs = [(str(self._morphology_filepath(nid)), str(self._mesh_filepath(nid, *params)), *params) for nid in missing]
+            workers = min(workers or cpu_count(), len(jobs))
+            with stage("neuron.meshes", neurons = len(missing), workers = workers):
+                if workers == 1:
+                    for job in jobs:
+                        _build_meshes(*job)
+                else:
+                    with ProcessPoolExecutor(max_workers = workers) as pool:
+                        list(pool.map(_build_meshes, *zip(*jobs)))
+
+        meshes = {}
+        for nid in neuron_ids:
+            with np.load(self._mesh_filepath(nid, *params)) as data:
+                meshes[nid] = {c: (data[f"{c}_points"], data[f"{c}_faces"]) for c in COMPONENTS if f"{c}_points" in data.files}
+        return meshes
+
+    def add_neurons(self, scene, neuron_ids, color = "salmon", alpha = 0.8, display_axon = True, display_dendrites = True,
+        resolution = NEURON_RESOLUTION, neurite_radius = NEURITE_RADIUS, soma_radius = SOMA_RADIUS, workers = None):
+        """
+        Add neurons of the store to a scene (one actor per neuron and component). Returns the list of actors.
+
+        :param scene: Scene
+        :param neuron_ids: list of str
+        :param color: str (a color or a matplotlib colormap), list of colors (one per neuron) or dict {component: color}
+        :param alpha: float
+        :param display_axon: bool
+        :param display_dendrites: bool
+        :param resolution: int, number of sides of the neurites' tubes
+        :param neurite_radius: float, radius (in microns) of the axon and dendrites
+        :param soma_radius: float, radius (in microns) of the soma
+        :param workers: int, number of worker processes building missing meshes (see `meshes()`)
+        """
+        neuron_ids = [neuron_ids] if isinstance(neuron_ids, str) else list(neuron_ids)
+        meshes = self.meshes(neuron_ids, resolution = resolution, neurite_radius = neurite_radius, soma_radius = soma_radius, workers = workers)
+        colors = _neuron_colors(color, len(neuron_ids))
+        shown = dict(soma = True, axon = display_axon, dendrites = display_dendrites)
+
+        actors = []
+        for nid, neuron_color in zip(neuron_ids, colors):
+            for component, (points, faces) in meshes[nid].items():
+                if not shown[component]:
+                    continue
+                c = neuron_color[component] if isinstance(neuron_color, dict) else neuron_color
+                actors.append(scene.add(mesh_actor(points, faces, name = f"{nid} {component}", color = c, alpha = alpha)))
+        return actors
+
+    # ---------------------------------- utils ---------------------------------- #
+    def _morphology_filepath(self, neuron_id):
+        return self.folder / f"morphologies_v{STORE_VERSION}" / f"{neuron_id}.npz"
+
+    def _mesh_filepath(self, neuron_id, resolution, neurite_radius, soma_radius):
+        return self.folder / f"meshes_v{STORE_VERSION}" / f"{neuron_id}_res{resolution}_neurite{neurite_radius:g}_soma{soma_radius:g}.npz"
+
+
+# // RECONSTRUCTIONS //
+def read_morphology(filepath, invert_dims = False):
+    """
+    Read a reconstruction from a neuronbrowser .json file or a .swc file into arrays (see `NeuronStore.morphology()`).
+    neuronbrowser coordinates are (ML, DV, AP) and are reordered to (AP, DV, ML) like brainrender; .swc files are read as
+    (AP, DV, ML), or as (ML, DV, AP) with invert_dims (e.g. MouseLight's .swc files, as with morphapi's `invert_dims`).
+
+    :param filepath: str, Path
+    :param invert_dims: bool, if true the coordinates of a .swc file are reordered from (ML, DV, AP) to (AP, DV, ML)
+    """
+    filepath = Path(filepath)
+    if filepath.suffix == ".swc":
+        data = np.loadtxt(filepath, comments = "#", ndmin = 2) # id, type, x, y, z, radius, parent
+        rows = {int(sample): i for i, sample in enumerate(data[:, 0])}
+        types = data[:, 1].astype(np.int8)
+        types[types > DENDRITE] = DENDRITE # apical dendrites
+        return dict(
+            points = (data[:, 4:1:-1] if invert_dims else data[:, 2:5]).astype(np.float32),
+            parents = np.array([rows.get(int(p), -1) for p in data[:, 6]], dtype = np.int32),
+            types = types,
+            )
+
+    with open(filepath) as f:
+        neuron = json.load(f)
+    neuron = neuron["neurons"][0] if "neurons" in neuron else neuron
+
+    # the axon and dendrite trees both start from the soma: they are stored one after the other, sharing one soma node
+    points, parents, types = [[neuron["soma"][k] for k in "zyx"]], [-1], [SOMA]
+    for tree, node_type in (("axon", AXON), ("dendrite", DENDRITE)):
+        nodes = [n for n in neuron.get(tree, []) if n["parentNumber"] != -1] # the tree's root is the soma
+        rows = {n["sampleNumber"]: len(points) + i for i, n in enumerate(nodes)}
+        points += [[n[k] for k in "zyx"] for n in nodes]
+        parents += [rows.get(n["parentNumber"], 0) for n in nodes]
+        types += [node_type] * len(nodes)
+    return dict(points = np.array(points, dtype = np.float32), parents = np.array(parents, dtype = np.int32), types = np.array(types, dtype = np.int8))
+
+
+# // MESHES //
+def tube_mesh(points, parents, radius = NEURITE_RADIUS, resolution = NEURON_RESOLUTION, nodes = None):
+    """
+    Tubes along the segments of a tree (one open cylinder per node and its parent), as float32 points and int32 triangles
+
+    :param points: np.ndarray, (N, 3) coordinates of the nodes
+    :param parents: np.ndarray, (N,) index of the parent of each node (-1 for roots)
+    :param radius: float, radius of the tubes
+    :param resolution: int, number of sides of the tubes
+    :param nodes: np.ndarray, only use the segments ending at these nodes (defaults to all nodes)
+    """
+    points, parents = np.asarray(points, dtype = np.float64), np.asarray(parents)
+    children = np.flatnonzero(parents >= 0) if nodes is None else np.asarray(nodes)[parents[nodes] >= 0]
+    start, end = points[parents[children]], points[children]
+    direction = end - start
+    length = np.linalg.norm(direction, axis = 1)
+    start, end, direction = start[length > 0], end[length > 0], direction[length > 0] / length[length > 0, None]
+
+    # a ring of `resolution` points around each end of each segment, perpendicular to the segment
+    reference = np.where(np.abs(direction[:, :1]) < 0.9, [[1, 0, 0]], [[0, 1, 0]])
+    e1 = np.cross(direction, reference)
+    e1 /= np.linalg.norm(e1, axis = 1, keepdims = True)
+    e2 = np.cross(direction, e1)
+    angles = 2 * np.pi * np.arange(resolution) / resolution
+    ring = radius * (np.cos(angles)[None, :, None] * e1[:, None] + np.sin(angles)[None, :, None] * e2[:, None])
+    tube_points = np.stack([start[:, None] + ring, end[:, None] + ring], axis = 1).reshape(-1, 3)
+
+    # two triangles per side of each cylinder
+    k = np.arange(resolution)
+    a, b = k, (k + 1) % resolution
+    quad = np.stack([np.column_stack([a, b, b + resolution]), np.column_stack([a, b + resolution, a + resolution])], axis = 1).reshape(-1, 3)
+    faces = (quad[None] + (2 * resolution * np.arange(len(start)))[:, None, None]).reshape(-1, 3)
+    return tube_points.astype(np.float32), faces.astype(np.int32)
+
+
+def sphere_mesh(center, radius = SOMA_RADIUS, resolution = NEURON_RESOLUTION):
+    """
+    UV sphere as float32 points and int32 triangles
+
+    :param center: 3-tuple
+    :param radius: float
+    :param resolution: int, number of points around the equator
+    """
+    n_lat, n_lon = max(resolution // 2, 2), resolution
+    theta = np.linspace(0, np.pi, n_lat + 1)[:, None]
+    phi = 2 * np.pi * np.arange(n_lon)[None] / n_lon
+    points = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta) * np.ones_like(phi)], axis = -1)
+    points = np.asarray(center, dtype = np.float64) + radius * points.reshape(-1, 3)
+
+    i, j = np.meshgrid(np.arange(n_lat), np.arange(n_lon), indexing = "ij")
+    a, b = i * n_lon + j, i * n_lon + (j + 1) % n_lon
+    faces = np.concatenate([np.stack([a, a + n_lon, b], -1).reshape(-1, 3), np.stack([b, a + n_lon, b + n_lon], -1).reshape(-1, 3)])
+    return points.astype(np.float32), faces.astype(np.int32)
+
+
+def mesh_actor(points, faces, name, color = "salmon", alpha = 1):
+    """
+    brainrender actor of a triangle mesh given as arrays
+
+    :param points: np.ndarray, (N, 3) vertices
+    :param faces: np.ndarray, (M, 3) triangles
+    :param name: str, name of the actor
+    :param color: str
+    :param alpha: float
+    """
+    import vtk
+    from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray
+    from vedo import Mesh
+    from brainrender.actor import Actor
+
+    polydata = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(np.ascontiguousarray(points, dtype = np.float32), deep = True))
+    polydata.SetPoints(vtk_points)
+    cells = np.column_stack([np.full(len(faces), 3, dtype = np.int64), faces]).ravel() # legacy layout [3, a, b, c, 3, ...]
+    polys = vtk.vtkCellArray()
+    polys.SetCells(len(faces), numpy_to_vtkIdTypeArray(cells, deep = True))
+    polydata.SetPolys(polys)
+
+    actor = Actor(Mesh(polydata), name = name, br_class = "Neuron")
+    actor.c(color).alpha(alpha)
+    return actor
+
+
+def _build_meshes(morphology_file, mesh_file, resolution, neurite_radius, soma_radius):
+    """
+    Worker: build and cache the soma, axon and dendrite meshes of a neuron
+    """
+    with np.load(morphology_file) as data:
+        points, parents, types = data["points"], data["parents"], data["types"]
+
+    arrays = {}
+    soma = np.flatnonzero(types == SOMA)
+    if len(soma):
+        arrays["soma_points"], arrays["soma_faces"] = sphere_mesh(points[soma].mean(axis = 0), soma_radius, resolution)
+    for component, node_type in (("axon", AXON), ("dendrites", DENDRITE)):
+        nodes = np.flatnonzero(types == node_type)
+        if len(nodes):
+            arrays[f"{component}_points"], arrays[f"{component}_faces"] = tube_mesh(points, parents, neurite_radius, resolution, nodes = nodes)
+    _save_npz(Path(mesh_file), **arrays)
+
+
+# // UTILS //
+def _neuron_id(neuron):
+    """
+    ID of a neuron given as an ID or as metadata from MouseLightAPI (its "idString", e.g. "AA0001")
+    """
+    return neuron if isinstance(neuron, str) else neuron["idString"]
+
+
+def _neuron_colors(color, n_neurons):
+    """
+    Color of each neuron: a color, a dict {component: color}, or one color per neuron from a list or a matplotlib colormap
+    """
+    if isinstance(color, (dict, tuple)): # a dict of components or an RGB tuple
+        return [color] * n_neurons
+    if isinstance(color, str):
+        from matplotlib import colormaps
+
+        if color not in colormaps: # not a colormap
+            return [color] * n_neurons
+        cmap = colormaps[color]
+        return [tuple(cmap(x)[:3]) for x in np.linspace(0.2, 1, n_neurons)]
+    color = list(color)
+    if len(color) < n_neurons:
+        raise ValueError(f"{len(color)} colors were given for {n_neurons} neurons")
+    return color[:n_neurons]
+
+
+def _save_npz(filepath, **arrays):
+    """
+    Save arrays to an .npz file (only complete files end up in the store)
+    """
+    filepath.parent.mkdir(parents = True, exist_ok = True)
+    tmp_file = filepath.with_name(filepath.name + ".tmp.npz")
+    np.savez(tmp_file, **arrays)
+    tmp_file.replace(filepath)
@@ -0,0 +1,241 @@
+"""
+    Render VideoMaker-style rotations and Animation-style keyframe videos in parallel across offscreen worker processes.
+
+    The frame range is split into contiguous slices. Each worker rebuilds the scene once from a scene spec (see scene_specs.py),
+    renders its slice of frames to .png files and a single ffmpeg call stitches all frames into the video.
+    The camera of every frame is computed from the frame number alone (the rotations of VideoMaker are accumulated from the
+    initial camera, and Animation keyframes are interpolated with brainrender's own code), so a frame is the same whichever
+    worker renders it and the output is identical to rendering all frames in a single process (workers = 1).
+
+    Usage:
+        from parallel_video import make_video, make_animation
+        make_video("specs/PAG_area_overview.json", save_folder, "PAG_video_areas_overview", duration = 10, fps = 60, azimuth = 1, workers = 16)
+        make_animation("specs/PAG_area_overview.json", save_folder, "PAG_animation", keyframes = [dict(time = 1, camera = "top", zoom = 1.3)], duration = 3)
+
+    Benchmark (frames per second against number of workers):
+        python parallel_video.py specs/PAG_area_overview.json --workers 1 2 4 8 16 --duration 2 --fps 30
+"""
+
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+from pathlib import Path
+
+import numpy as np
+
+
+# // DEFAULT SETTINGS //
+VIDEO_SIZE = "1620x1050" # size of video's frames in pixels (same default as brainrender's VideoMaker)
+FFMPEG_FORMAT = "-vcodec libx264 -crf 28 -pix_fmt yuv420p" # same encoding as brainrender's Video
+
+
+# // PUBLIC API //
+def make_video(spec, save_fld, name, duration = 10, fps = 30, azimuth = 0, elevation = 0, roll = 0, size = VIDEO_SIZE, workers = None):
+    """
+    Parallel version of `VideoMaker.make_video`: rotate the camera by azimuth/elevation/roll degrees at every frame.
+
+    :param spec: dict or str/Path, scene spec or path to a .json spec
+    :param save_fld: str, Path. Where the video will be saved
+    :param name: str, name of the video
+    :param duration: float, video duration in seconds
+    :param fps: int, frame rate
+    :param azimuth, elevation, roll: float, rotation in degrees per frame on the relative axis
+    :param size: str, size of video's frames in pixels
+    :param workers: int, number of worker processes (defaults to the number of cores)
+    """
+    motion = dict(kind = "rotation", azimuth = azimuth, elevation = elevation, roll = roll)
+    return _make(spec, motion, save_fld, name, duration, fps, size, workers)
+
+
+def make_animation(spec, save_fld, name, keyframes, duration = 10, fps = 30, size = VIDEO_SIZE, workers = None):
+    """
+    Parallel version of `Animation.make_video`: interpolate the camera between keyframes.
+    Keyframes without a camera use the scene's camera at the start of the video. Callbacks are not supported.
+
+    :param spec: dict or str/Path, scene spec or path to a .json spec
+    :param save_fld: str, Path. Where the video will be saved
+    :param name: str, name of the video
+    :param keyframes: list of dict, keyword arguments of `Animation.add_keyframe` (time, duration, camera, zoom, interpol)
+    :param duration: float, video duration in seconds
+    :param fps: int, frame rate
+    :param size: str, size of video's frames in pixels
+    :param workers: int, number of worker processes (defaults to the number of cores)
+    """
+    motion = dict(kind = "animation", keyframes = keyframes)
+    return _make(spec, motion, save_fld, name, duration, fps, size, workers)
+
+
+# // FRAMES //
+def _make(spec, motion, save_fld, name, duration, fps, size, workers):
+    """
+    Render all frames across the workers and stitch them into a video. Returns the video's path.
+    """
+    from scene_specs import load_spec
+
+    spec = spec if isinstance(spec, dict) else load_spec(spec)
+    nframes = int(fps * duration)
+    workers = min(workers or cpu_count(), nframes)
+    bounds = np.linspace(0, nframes, workers + 1).astype(int)
+
+    save_fld = Path(save_fld)
+    save_fld.mkdir(parents = True, exist_ok = True)
+    frames_dir = Path(tempfile.mkdtemp(prefix = f"{name}_frames_", dir = save_fld))
+    try:
+        jobs = [(spec, motion, start, stop, nframes, fps, size, str(frames_dir)) for start, stop in zip(bounds[:-1], bounds[1:])]
+        if workers == 1:
+            for job in jobs:
+                _render_frames(*job)
+        else:
+            with ProcessPoolExecutor(max_workers = workers) as pool:
+                list(pool.map(_render_frames, *zip(*jobs)))
+
+        return stitch_frames(frames_dir, save_fld / f"{name}.mp4", fps, size)
+    finally:
+        shutil.rmtree(frames_dir, ignore_errors = True)
+
+
+def _render_frames(spec, motion, start, stop, nframes, fps, size, frames_dir):
+    """
+    Worker: build the scene once and render frames [start, stop) to `<frames_dir>/<frame number>.png`
+    """
+    from brainrender.camera import get_camera_params
+    from scene_specs import build_scene
+
+    spec = dict(spec)
+    spec["settings"] = dict(spec.get("settings", {}), OFFSCREEN = True, INTERACTIVE = False)
+    scene = build_scene(spec)
+
+    width, height = (int(x) for x in size.split("x"))
+    scene.plotter.window.SetSize(width, height)
+    scene.render(interactive = False, camera = spec.get("camera"), zoom = spec.get("zoom"))
+    initial_camera = get_camera_params(scene)
+    initial_view_angle = scene.plotter.camera.GetViewAngle()
+
+    if motion["kind"] == "rotation":
+        for frame in range(start, stop):
+            camera = rotated_camera(initial_camera, frame + 1, motion["azimuth"], motion["elevation"], motion["roll"])
+            _render_frame(scene, camera, initial_view_angle, Path(frames_dir) / f"{frame}.png")
+    else:
+        animation = _make_animation(scene, motion["keyframes"], initial_camera, fps, nframes)
+
+        # brainrender applies each frame's zoom on top of the previous ones, so the zoom of a frame is the product of all zooms so far
+        zooms = np.cumprod([animation.get_frame_params(frame)["zoom"] or scene.atlas.zoom for frame in range(stop)])
+        for frame in range(start, stop):
+            camera = dict(animation.get_frame_params(frame)["camera"])
+            _render_frame(scene, camera, initial_view_angle / zooms[frame], Path(frames_dir) / f"{frame}.png")
+
+    scene.close()
+    return stop - start
+
+
+def _render_frame(scene, camera, view_angle, filepath):
+    """
+    Render a frame with a given camera and view angle (i.e. zoom) and save it to a .png file
+    """
+    scene.plotter.camera.SetViewAngle(view_angle)
+    scene.render(interactive = False, camera = camera, zoom = 1) # zoom is already set through the view angle
+    scene.plotter.screenshot(str(filepath))
+
+
+def rotated_camera(initial_camera, n_steps, azimuth = 0, elevation = 0, roll = 0):
+    """
+    Camera parameters after `n_steps` rotations of VideoMaker's default frame function, applied to the initial camera.
+    Only camera maths is done (no rendering), so any frame can be computed directly from its number.
+
+    :param initial_camera: dict of camera parameters
+    :param n_steps: int, number of rotations
+    :param azimuth, elevation, roll: float, rotation in degrees per step on the relative axis
+    """
+    import vtk
+    from brainrender.camera import set_camera_params
+
+    camera = vtk.vtkCamera()
+    set_camera_params(camera, initial_camera)
+    for _ in range(n_steps):
+        camera.Elevation(elevation)
+        camera.Azimuth(azimuth)
+        camera.Roll(roll)
+
+    return dict(
+        pos = camera.GetPosition(),
+        focalPoint = camera.GetFocalPoint(),
+        viewup = camera.GetViewUp(),
+        distance = camera.GetDistance(),
+        clippingRange = camera.GetClippingRange(),
+        )
+
+
+def _make_animation(scene, keyframes, initial_camera, fps, nframes):
+    """
+    brainrender Animation with the keyframes set, used only to interpolate the camera at each frame
+    """
+    from brainrender import Animation
+
+    animation = Animation(scene, tempfile.gettempdir(), "unused")
+    animation.keyframes[0]["camera"] = initial_camera
+    for keyframe in keyframes:
+        keyframe = dict(keyframe)
+        if keyframe.get("camera") is None:
+            keyframe["camera"] = initial_camera
+        animation.add_keyframe(keyframe.pop("time"), **keyframe)
+
+    animation.get_keyframe_framenumber(fps)
+    animation.nframes = nframes
+    animation.last_keyframe = max(animation.keyframes_numbers)
+    return animation
+
+
+def stitch_frames(frames_dir, video_path, fps, size = VIDEO_SIZE):
+    """
+    Stitch numbered .png frames into a video with ffmpeg. Returns the video's path.
+
+    :param frames_dir: str, Path. Folder with frames named 0.png, 1.png, ...
+    :param video_path: str, Path. Video file to create
+    :param fps: int, frame rate
+    :param size: str, size of video's frames in pixels
+    """
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-r", str(int(fps)), "-start_number", "0",
+        "-i", str(Path(frames_dir) / "%d.png"), *FFMPEG_FORMAT.split(), "-s", size, str(video_path)]
+    subprocess.run(command, check = True)
+    print(f"Saved video at: {video_path}")
+    return str(video_path)
+
+
+# // BENCHMARK //
+def benchmark(spec, worker_counts, duration = 2, fps = 30, azimuth = 1, size = VIDEO_SIZE):
+    """
+    Render the same rotation video with different numbers of workers and report frames per second
+
+    :param spec: dict or str/Path, scene spec or path to a .json spec
+    :param worker_counts: list of int, numbers of workers to test
+    :param duration: float, video duration in seconds
+    :param fps: int, frame rate
+    :param azimuth: float, rotation in degrees per frame
+    :param size: str, size of video's frames in pixels
+    """
+    nframes = int(fps * duration)
+    results = []
+    with tempfile.TemporaryDirectory() as save_fld:
+        for workers in worker_counts:
+            start = time.perf_counter()
+            make_video(spec, save_fld, f"benchmark_{workers}", duration = duration, fps = fps, azimuth = azimuth, size = size, workers = workers)
+            elapsed = time.perf_counter() - start
+            results.append(dict(workers = workers, frames = nframes, seconds = elapsed, fps = nframes / elapsed))
+            print(f"workers: {workers:3d} | frames: {nframes} | time: {elapsed:7.1f}s | {nframes / elapsed:6.2f} frames/s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark parallel video rendering against the number of workers")
+    parser.add_argument("spec", help = "path to a .json scene spec")
+    parser.add_argument("--workers", type = int, nargs = "+", default = [1, 2, 4, 8], help = "numbers of workers to test")
+    parser.add_argument("--duration", type = float, default = 2, help = "video duration in seconds")
+    parser.add_argument("--fps", type = int, default = 30, help = "frame rate")
+    parser.add_argument("--size", default = VIDEO_SIZE, help = "size of video's frames in pixels")
+    args = parser.parse_args()
+
+    benchmark(args.spec, args.workers, duration = args.duration, fps = args.fps, size = args.size)
@@ -0,0 +1,340 @@
+"""
+    Opt-in timing and memory instrumentation of the stages of a figure: atlas loading, meshes, actors, lookups, downloads and rendering.
+
+    When profiling is enabled, every stage records its wall time, the resident memory (RSS) of the process and its peak,
+    the cache hits and misses that happened during the stage and, for brainrender scenes, the number of actors and
+    triangles in the scene after the stage. brainrender's Scene methods (`__init__`, which loads the atlas, `add_*`,
+    `slice`, `render` and `screenshot`), Atlas loading and the actors of `brainrender.actors` are wrapped automatically;
+    the helper modules of this folder record their lookups, downloads and cache hits/misses.
+
+    At the end of the run a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev) is written to
+    PROFILES_FOLDER, with the per-stage summary in its "otherData", and the summary is printed. When profiling is
+    not enabled, stages and counters do nothing.
+
+    Profiling is enabled by calling `enable_profiling()` at the top of a script, or by setting the PAG_BRAINRENDER_PROFILE
+    environment variable to 1 before starting Python.
+
+    Example:
+        from profiling import enable_profiling, stage
+        enable_profiling() # before creating the scene
+        scene = CachedScene(root = True, atlas_name = 'allen_mouse_10um')
+        with stage("cells"):
+            scene.add(Points(coordinates, radius = 30))
+        scene.render(interactive = False) # the trace and the summary are written when Python exits
+"""
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+
+# // DEFAULT SETTINGS //
+PROFILES_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "profiles" # where traces are written
+PROFILE_VARIABLE = "PAG_BRAINRENDER_PROFILE" # environment variable enabling profiling when set to 1
+SCENE_METHODS = ("__init__", "add", "add_brain_region", "slice", "render", "screenshot") # Scene methods recorded as stages (plus all add_* methods)
+
+_state = dict(enabled = False, start = None, trace_file = None, patched = False)
+_records = [] # one dict per finished stage
+_counters = {} # {(stage name, cache name): [hits, misses]}
+_local = threading.local() # stack of the open stages of each thread
+_lock = threading.Lock()
+
+
+# // SWITCH //
+def enable_profiling(trace_file = None, summary = True, instrument_brainrender = True):
+    """
+    Start recording stages. The trace and the summary are written when Python exits (or with `write_trace()` / `print_summary()`)
+
+    :param trace_file: str, Path. Chrome trace written at exit (defaults to PROFILES_FOLDER/<script>_<date and time>.json)
+    :param summary: bool, if true the summary is printed at exit
+    :param instrument_brainrender: bool, if true brainrender's Scene, Atlas and actors are wrapped in stages
+    """
+    if _state["enabled"]:
+        return
+    script = Path(sys.argv[0]).stem if sys.argv and sys.argv[0] else "interactive"
+    _state.update(enabled = True, start = time.perf_counter(),
+        trace_file = Path(trace_file) if trace_file else PROFILES_FOLDER / f"{script}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    if instrument_brainrender:
+        _instrument_brainrender()
+    atexit.register(_at_exit, summary)
+
+
+def profiling_enabled():
+    return _state["enabled"]
+
+
+# // STAGES //
+@contextmanager
+def stage(name, scene = None, **args):
+    """
+    Record a stage: wall time, memory, cache hits and misses and (if a scene is given) its actors and triangles at the end
+
+    :param name: str, name of the stage (stages with the same name are summed in the summary)
+    :param scene: brainrender Scene, counted at the end of the stage
+    :param args: extra values stored in the trace (e.g. the region or the number of cells)
+    """
+    if not _state["enabled"]:
+        yield
+        return
+
+    stack = _stack()
+    stack.append(name)
+    rss, peak = _memory()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        stack.pop()
+        rss_end, peak_end = _memory()
+        record = dict(name = name, start = start, end = end, depth = len(stack), thread = threading.get_ident(),
+            rss_start = rss, rss_end = rss_end, peak_start = peak, peak_end = peak_end, args = args)
+        if scene is not None:
+            record.update(scene_counts(scene))
+        with _lock:
+            _records.append(record)
+
+
+def profiled(name = None):
+    """
+    Decorator recording each call of a function as a stage
+
+    :param name: str, name of the stage (defaults to the qualified name of the function)
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__qualname__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def cache_hit(cache, n = 1):
+    """
+    Count hits of a cache (e.g. "mesh", "roi") in the current stage
+
+    :param cache: str, name of the cache
+    :param n: int, number of hits
+    """
+    if _state["enabled"]:
+        _count(cache, 0, n)
+
+
+def cache_miss(cache, n = 1):
+    """
+    Count misses of a cache in the current stage
+
+    :param cache: str, name of the cache
+    :param n: int, number of misses
+    """
+    if _state["enabled"]:
+        _count(cache, 1, n)
+
+
+def scene_counts(scene):
+    """
+    Number of actors of a brainrender scene and total number of triangles (polygons) of their meshes
+
+    :param scene: brainrender Scene
+    """
+    actors = list(getattr(scene, "actors", []))
+    triangles = 0
+    for actor in actors:
+        try:
+            triangles += getattr(actor, "mesh", actor).polydata(False).GetNumberOfPolys()
+        except AttributeError:
+            pass
+    return dict(actors = len(actors), triangles = triangles)
+
+
+# // OUTPUTS //
+def summary():
+    """
+    Per-stage summary as a DataFrame: number of calls, total and maximum wall time, memory, scene counts and cache hits/misses
+    """
+    columns = ["calls", "total_s", "max_s", "rss_change_mb", "peak_rss_mb", "actors", "triangles", "cache_hits", "cache_misses"]
+    with _lock:
+        records, counters = list(_records), dict(_counters)
+    if not records and not counters:
+        return pd.DataFrame(columns = columns)
+
+    rows = {}
+    for record in records:
+        row = rows.setdefault(record["name"], dict(calls = 0, total_s = 0.0, max_s = 0.0, rss_change_mb = 0.0, peak_rss_mb = None,
+            actors = None, triangles = None, cache_hits = 0, cache_misses = 0))
+        duration = record["end"] - record["start"]
+        row["calls"] += 1
+        row["total_s"] += duration
+        row["max_s"] = max(row["max_s"], duration)
+        if record["rss_start"] is not None and record["rss_end"] is not None:
+            row["rss_change_mb"] += (record["rss_end"] - record["rss_start"]) / 1024 ** 2
+        if record["peak_end"] is not None:
+            row["peak_rss_mb"] = max(row["peak_rss_mb"] or 0, record["peak_end"] / 1024 ** 2)
+        if "actors" in record: # scene after the last call
+            row["actors"], row["triangles"] = record["actors"], record["triangles"]
+    for (name, _), (hits, misses) in counters.items():
+        row = rows.setdefault(name, dict(calls = 0, total_s = 0.0, max_s = 0.0, cache_hits = 0, cache_misses = 0))
+        row["cache_hits"] += hits
+        row["cache_misses"] += misses
+    return pd.DataFrame.from_dict(rows, orient = "index", columns = columns).astype(dict(actors = "Int64", triangles = "Int64")) \
+        .rename_axis("stage").sort_values("total_s", ascending = False)
+
+
+def print_summary():
+    """
+    Print the per-stage summary and the hits and misses of each cache
+    """
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200, "display.float_format", "{:.3f}".format):
+        print(summary())
+        with _lock:
+            caches = pd.DataFrame([dict(stage = s, cache = c, hits = h, misses = m) for (s, c), (h, m) in _counters.items()])
+        if len(caches):
+            print(caches.groupby("cache")[["hits", "misses"]].sum())
+
+
+def write_trace(filepath = None):
+    """
+    Write the stages as a Chrome trace (complete events, plus memory counters), with the summary in "otherData"
+
+    :param filepath: str, Path. Defaults to the trace file chosen when profiling was enabled
+    """
+    filepath = Path(filepath or _state["trace_file"])
+    pid = os.getpid()
+    to_us = lambda t: round((t - _state["start"]) * 1e6, 1)
+    with _lock:
+        records = list(_records)
+
+    events = []
+    for record in sorted(records, key = lambda r: r["start"]):
+        args = {key: value for key, value in record["args"].items()}
+        args.update({key: record[key] for key in ("actors", "triangles") if key in record})
+        if record["rss_end"] is not None:
+            args["rss_mb"] = round(record["rss_end"] / 1024 ** 2, 1)
+        if record["peak_end"] is not None:
+            args["peak_rss_mb"] = round(record["peak_end"] / 1024 ** 2, 1)
+        events.append(dict(name = record["name"], ph = "X", pid = pid, tid = record["thread"], ts = to_us(record["start"]),
+            dur = round((record["end"] - record["start"]) * 1e6, 1), args = json.loads(json.dumps(args, default = str))))
+        if record["rss_end"] is not None:
+            events.append(dict(name = "memory", ph = "C", pid = pid, ts = to_us(record["end"]), args = dict(rss_mb = args["rss_mb"])))
+
+    table = summary().reset_index()
+    other = dict(script = sys.argv[0] if sys.argv else None, summary = json.loads(table.to_json(orient = "records")))
+    filepath.parent.mkdir(parents = True, exist_ok = True)
+    tmp_file = filepath.with_name(filepath.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(dict(traceEvents = events, displayTimeUnit = "ms", otherData = other), f)
+    tmp_file.replace(filepath)
+    return filepath
+
+
+# // BRAINRENDER //
+def _instrument_brainrender():
+    """
+    Wrap the Scene methods (including those of its subclasses), Atlas loading and the actors of brainrender in stages
+    """
+    if _state["patched"]:
+        return
+    try:
+        import brainrender.actors as actors
+        from brainrender import Scene
+        from brainrender.atlas import Atlas
+        from brainrender.actor import Actor
+    except ImportError:
+        return
+    _state["patched"] = True
+
+    for cls in [Scene] + _subclasses(Scene):
+        _instrument_scene_class(cls)
+    Scene.__init_subclass__ = classmethod(lambda cls, **kwargs: _instrument_scene_class(cls)) # e.g. CachedScene defined later
+    Atlas.__init__ = _stage_method(Atlas.__init__, "Atlas.__init__")
+    for cls in vars(actors).values():
+        if isinstance(cls, type) and issubclass(cls, Actor) and cls is not Actor and "__init__" in vars(cls):
+            cls.__init__ = _stage_method(cls.__init__, f"actor.{cls.__name__}")
+
+
+def _instrument_scene_class(cls):
+    names = set(SCENE_METHODS) | {n for n in vars(cls) if n.startswith("add_")}
+    for method_name in names & set(vars(cls)):
+        setattr(cls, method_name, _scene_stage(vars(cls)[method_name], f"Scene.{method_name}"))
+
+
+def _scene_stage(method, name):
+    """
+    Wrap a Scene method in a stage counting the scene's actors at the end (calls from a subclass to the same method are not nested)
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not _state["enabled"] or (_stack() and _stack()[-1] == name):
+            return method(self, *args, **kwargs)
+        with stage(name, scene = self):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _stage_method(method, name):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+# // UTILS //
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _count(cache, column, n):
+    stack = _stack()
+    key = (stack[-1] if stack else "(no stage)", cache)
+    with _lock:
+        _counters.setdefault(key, [0, 0])[column] += n
+
+
+def _subclasses(cls):
+    return [c for sub in cls.__subclasses__() for c in [sub] + _subclasses(sub)]
+
+
+def _memory():
+    """
+    Resident memory and peak resident memory of the process, in bytes (None when they cannot be read)
+    """
+    rss = peak = None
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024) # kB on Linux
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (ImportError, OSError, ValueError):
+        try:
+            import psutil # e.g. on Windows
+            info = psutil.Process().memory_info()
+            rss, peak = info.rss, peak or getattr(info, "peak_wset", None)
+        except ImportError:
+            pass
+    return rss, peak
+
+
+def _at_exit(print_at_exit):
+    if not _records and not _counters:
+        return
+    filepath = write_trace()
+    if print_at_exit:
+        print_summary()
+        print(f"Profile written to {filepath}")
+
+
+if os.environ.get(PROFILE_VARIABLE) == "1":
+    enable_profiling()
@@ -0,0 +1,193 @@
+"""
+    Declarative scene specs: build and screenshot the brainrender scenes of this repository from a .json file instead of editing a script.
+
+    A spec covers the settings the rendering scripts set by hand: brainrender and vedo settings, the scene (atlas, root, title),
+    brain regions, points (e.g. registered cells from the metadata csv), streamlines, slices, camera and screenshot.
+    All the keys are optional except "name". See specs/PAG_area_overview.json for an example:
+
+    {
+        "name": "PAG_area_overview",                      # used for the screenshot file name
+        "output_folder": "D:/.../output",                 # where screenshots are saved
+        "settings": {"SHADER_STYLE": "cartoon", ...},     # brainrender.settings.*
+        "vedo_settings": {"useFXAA": false, ...},         # vedo.settings.*
+        "scene": {"atlas_name": "allen_mouse_10um", "root": true, "title": null, "quality": "high"},
+        "regions": [{"region": "PAG", "alpha": 0.4, "color": "darkgoldenrod", "hemisphere": "both"}],
+        "points": [{"csv": "cells.csv", "columns": ["CCF.AllenAP", "CCF.AllenDV", "CCF.AllenML"], "scale": 10,
+                    "query": "`PAG.hemisphere` == 'right'", "colors": "salmon", "radius": 20, "res": 16}],
+        "streamlines": [{"region": "PAG", "max_experiments": 2, "merged": true, "color": "salmon", "alpha": 0.5}],
+        "slices": [{"plane": "frontal", "actors": ["PAG"], "close_actors": true}, {"pos": [...], "norm": [1, 0, 0]}],
+        "camera": "sagittal",                             # camera name or dict of camera parameters
+        "zoom": 1,
+        "screenshot": {"scale": 1}
+    }
+"""
+
+import json
+from pathlib import Path
+
+import pandas as pd
+import brainrender
+from brainrender.actors import Points
+from vedo import settings as vsettings
+
+from mesh_cache import CachedScene
+
+
+# // DEFAULT SETTINGS //
+# Settings are restored to these values before each spec is applied, so specs rendered by the same process don't leak into each other
+_DEFAULT_SETTINGS = {k: getattr(brainrender.settings, k) for k in dir(brainrender.settings) if k.isupper()}
+_DEFAULT_VEDO_SETTINGS = {}
+
+
+# // LOAD SPECS //
+def load_spec(filepath):
+    """
+    Load a scene spec from a .json file. Relative paths in the spec are interpreted relative to the spec's folder.
+
+    :param filepath: str, Path
+    """
+    filepath = Path(filepath)
+    with open(filepath) as f:
+        spec = json.load(f)
+
+    if "name" not in spec:
+        raise ValueError(f"The scene spec {filepath} doesn't have a name")
+    spec["_folder"] = str(filepath.parent)
+    return spec
+
+
+def find_specs(folder):
+    """
+    List the .json scene specs in a folder
+
+    :param folder: str, Path
+    """
+    return sorted(Path(folder).glob("*.json"))
+
+
+# // BUILD SCENES //
+def apply_settings(spec):
+    """
+    Set brainrender and vedo settings from a spec (on top of brainrender's defaults)
+
+    :param spec: dict, scene spec
+    """
+    for key, value in _DEFAULT_SETTINGS.items():
+        setattr(brainrender.settings, key, value)
+    for key, value in _DEFAULT_VEDO_SETTINGS.items():
+        setattr(vsettings, key, value)
+
+    for key, value in spec.get("settings", {}).items():
+        setattr(brainrender.settings, key, value)
+    for key, value in spec.get("vedo_settings", {}).items():
+        _DEFAULT_VEDO_SETTINGS.setdefault(key, getattr(vsettings, key))
+        setattr(vsettings, key, value)
+
+
+def build_scene(spec):
+    """
+    Create a scene and add the regions, points, streamlines and slices of a spec
+
+    :param spec: dict, scene spec
+    """
+    apply_settings(spec)
+
+    scene = CachedScene(screenshots_folder = spec.get("output_folder"), **spec.get("scene", {}))
+
+    for region in spec.get("regions", []):
+        region = dict(region)
+        scene.add_brain_region(region.pop("region"), **region)
+
+    for points in spec.get("points", []):
+        scene.add(_make_points(points, spec.get("_folder", ".")))
+
+    for streamlines in spec.get("streamlines", []):
+        _add_streamlines(scene, streamlines)
+
+    for plane in spec.get("slices", []):
+        _slice(scene, plane)
+
+    return scene
+
+
+def render_spec(spec):
+    """
+    Build a scene from a spec, render it offscreen and save a screenshot. Returns the screenshot's path.
+
+    :param spec: dict or str/Path, scene spec or path to a .json spec
+    """
+    spec = dict(spec) if isinstance(spec, dict) else load_spec(spec)
+    spec["settings"] = dict(spec.get("settings", {}), OFFSCREEN = True, INTERACTIVE = False)
+
+    scene = build_scene(spec)
+    scene.render(interactive = False, camera = spec.get("camera"), zoom = spec.get("zoom"))
+    screenshot = scene.screenshot(name = spec["name"], **spec.get("screenshot", {}))
+    scene.close()
+    return screenshot
+
+
+# // UTILS //
+def _make_points(points, folder):
+    """
+    Create a Points actor from a spec entry. Coordinates come from a .npy file or from columns of a .csv file
+
+    :param points: dict, points spec
+    :param folder: str, folder of the spec (relative paths are interpreted from here)
+    """
+    points = dict(points)
+    if "npy" in points:
+        data = str(Path(folder) / points.pop("npy"))
+    else:
+        table = pd.read_csv(Path(folder) / points.pop("csv"))
+        query = points.pop("query", None)
+        if query is not None:
+            table = table.query(query)
+        data = table[points.pop("columns")].values * points.pop("scale", 1)
+
+    return Points(data, **points)
+
+
+def _add_streamlines(scene, streamlines):
+    """
+    Add the streamlines for injections in a region to the scene (read from the local streamlines cache).
+    With "merged": true all experiments are drawn as a single actor.
+
+    :param scene: Scene
+    :param streamlines: dict, streamlines spec
+    """
+    from brainrender.actors.streamlines import make_streamlines
+    from streamline_cache import load_streamlines, streamlines_actor
+
+    streamlines = dict(streamlines)
+    data = load_streamlines(streamlines.pop("region"), max_experiments = streamlines.pop("max_experiments", None),
+        local_folder = streamlines.pop("local_folder", None))
+    if streamlines.pop("merged", False):
+        scene.add(streamlines_actor(data, **streamlines))
+    else:
+        scene.add(*make_streamlines(*[_streamlines_dataframe(points, offsets) for points, offsets in data.values()], **streamlines))
+
+
+def _streamlines_dataframe(points, offsets):
+    """
+    Streamlines arrays in the layout of brainrender's Streamlines actor
+    """
+    lines = [[dict(x = x, y = y, z = z) for x, y, z in points[start:end].tolist()] for start, end in zip(offsets[:-1], offsets[1:])]
+    return pd.DataFrame(dict(lines = [lines], injection_sites = [[]]))
+
+
+def _slice(scene, plane):
+    """
+    Slice actors of the scene with a named plane or a plane through `pos` with normal `norm`
+
+    :param scene: Scene
+    :param plane: dict, slice spec
+    """
+    if "plane" in plane:
+        cut = plane["plane"]
+    else:
+        cut = scene.atlas.get_plane(pos = plane["pos"], norm = plane["norm"])
+
+    actors = plane.get("actors")
+    if actors is not None:
+        actors = [scene.root if a == "root" else scene.get_actors(name = a)[0] for a in actors]
+    scene.slice(cut, actors = actors, close_actors = plane.get("close_actors", False))
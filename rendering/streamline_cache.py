@@ -0,0 +1,250 @@
+"""
+    Local cache of Allen mouse connectivity streamlines, and a merged single-actor rendering of many experiments.
+
+    `get_streamlines_for_region` asks the Allen API for the experiments injected in a region every time it is called. Here the
+    list of experiments of a region and the streamlines of each experiment are stored in a local compressed cache
+    (a .json index per region and an .npz file per experiment with float32 points and line offsets), so later runs only read from disk.
+    For offline use, a folder of streamline .json files named `<experiment id>.json` (as downloaded by brainrender) can stand in
+    for the remote service.
+
+    `streamlines_actor` merges all lines of all experiments into one polydata turned into tubes by a single vtk filter, with the
+    experiment ID of each line kept as cell data for coloring and picking, so a whole efferent set is drawn by one actor.
+
+    Example:
+        from streamline_cache import load_streamlines, streamlines_actor
+        streams = load_streamlines("PAG") # {experiment id: (points, offsets)}
+        actor = scene.add(streamlines_actor(streams, color = "salmon", alpha = 0.5))
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray, vtk_to_numpy
+from vedo import Mesh, getColor
+from loguru import logger
+
+from brainrender.actor import Actor
+
+from profiling import stage, cache_hit, cache_miss
+
+
+# // DEFAULT SETTINGS //
+STREAMLINES_CACHE_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "streamlines" # where cached streamlines are stored
+LOCAL_STREAMLINES_FOLDER = None # folder of `<experiment id>.json` streamline files used instead of the Allen API (offline use)
+EXPERIMENT_ID_ARRAY = "experiment_id" # name of the cell data array with the experiment ID of each line
+STREAMLINES_RESOLUTION = 6 # number of sides of the tubes
+
+
+# // CACHE //
+def load_streamlines(region, max_experiments = None, force_download = False, cache_folder = STREAMLINES_CACHE_FOLDER, local_folder = None):
+    """
+    Streamlines of the experiments with injections in a region, as {experiment id: (points, offsets)}.
+    `points` is an (N, 3) float32 array of the vertices of all lines and line i is points[offsets[i]:offsets[i + 1]].
+
+    :param region: str, acronym of the injected region (e.g. "PAG")
+    :param max_experiments: int, only load the first experiments (e.g. for quick previews)
+    :param force_download: bool, if true download again instead of reading from the cache
+    :param cache_folder: str, Path. Where cached streamlines are stored
+    :param local_folder: str, Path. Folder of `<experiment id>.json` files used instead of the Allen API. Defaults to LOCAL_STREAMLINES_FOLDER
+    """
+    cache_folder = Path(cache_folder)
+    local_folder = local_folder or LOCAL_STREAMLINES_FOLDER
+
+    experiments = experiment_ids(region, force_download = force_download, cache_folder = cache_folder, local_folder = local_folder)
+    streamlines = {}
+    for eid in experiments[:max_experiments]:
+        filepath = cache_folder / "experiments" / f"{eid}.npz"
+        if force_download or not filepath.exists():
+            cache_miss("streamlines")
+            points, offsets = _lines_to_arrays(_fetch_lines(eid, local_folder))
+            _save_npz(filepath, points = points, offsets = offsets)
+        else:
+            cache_hit("streamlines")
+            with np.load(filepath) as data:
+                points, offsets = data["points"], data["offsets"]
+        streamlines[eid] = (points, offsets)
+    return streamlines
+
+
+def experiment_ids(region, force_download = False, cache_folder = STREAMLINES_CACHE_FOLDER, local_folder = None):
+    """
+    IDs of the experiments with injections in a region. Read from the cache, the local folder or the Allen API (in this order).
+
+    :param region: str, acronym of the injected region
+    :param force_download: bool, if true ask the Allen API again instead of reading from the cache
+    :param cache_folder: str, Path. Where cached streamlines are stored
+    :param local_folder: str, Path. Folder of `<experiment id>.json` files used instead of the Allen API
+    """
+    filepath = Path(cache_folder) / "regions" / f"{region}.json"
+    if filepath.exists() and not force_download:
+        with open(filepath) as f:
+            return json.load(f)
+
+    if local_folder is not None:
+        logger.debug(f"STREAMLINES: using the experiments in {local_folder} for {region}")
+        experiments = sorted(int(f.stem) for f in Path(local_folder).glob("*.json") if f.stem.isdigit())
+        return experiments # a local folder is not specific to a region, so it is not added to the regions index
+
+    from brainrender.atlas_specific.allen.streamlines import experiments_source_search
+
+    logger.debug(f"STREAMLINES: asking the Allen API for the experiments injected in {region}")
+    search = experiments_source_search(region)
+    experiments = [] if search is None else [int(eid) for eid in search.id.values]
+
+    filepath.parent.mkdir(parents = True, exist_ok = True)
+    tmp_file = filepath.with_suffix(".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(experiments, f)
+    tmp_file.replace(filepath)
+    return experiments
+
+
+# // ACTORS //
+def streamlines_actor(streamlines, radius = 10, color = "salmon", alpha = 1, res = STREAMLINES_RESOLUTION, name = "streamlines"):
+    """
+    Single actor with the streamlines of all experiments. Each line's experiment ID is stored in the cell data array EXPERIMENT_ID_ARRAY.
+
+    :param streamlines: dict, {experiment id: (points, offsets)} as returned by `load_streamlines()`
+    :param radius: float, radius of the tubes
+    :param color: str, color of all streamlines, or a list of colors (one per experiment) or a dict {experiment id: color}
+    :param alpha: float
+    :param res: int, number of sides of the tubes
+    :param name: str, name of the actor
+    """
+    if not streamlines:
+        raise ValueError("No streamlines to render")
+
+    # concatenate the lines of all experiments, shifting each experiment's offsets by the number of points before it
+    experiments = list(streamlines.keys())
+    sizes = [len(points) for points, _ in streamlines.values()]
+    shifts = np.cumsum([0] + sizes[:-1])
+    points = np.concatenate([points for points, _ in streamlines.values()]).astype(np.float32)
+    offsets = np.append(np.concatenate([o[:-1] + shift for (_, o), shift in zip(streamlines.values(), shifts)]), len(points))
+    line_experiments = np.concatenate([np.full(len(o) - 1, eid, dtype = np.int64) for eid, (_, o) in streamlines.items()])
+
+    polydata = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(points, deep = True))
+    polydata.SetPoints(vtk_points)
+    polydata.SetLines(_cell_array(offsets))
+
+    ids = numpy_to_vtk(line_experiments, deep = True, array_type = vtk.VTK_ID_TYPE)
+    ids.SetName(EXPERIMENT_ID_ARRAY)
+    polydata.GetCellData().AddArray(ids)
+
+    tubes = vtk.vtkTubeFilter() # the tubes of all lines in one go, cell data is passed to the tubes' cells
+    tubes.SetInputData(polydata)
+    tubes.SetRadius(radius)
+    tubes.SetNumberOfSides(res)
+    tubes.Update()
+
+    actor = Actor(Mesh(tubes.GetOutput()), name = name, br_class = "Streamlines")
+    actor.alpha(alpha)
+    if isinstance(color, str):
+        actor.c(color)
+    else:
+        colors = color if isinstance(color, dict) else dict(zip(experiments, color))
+        color_by_experiment(actor, colors)
+    return actor
+
+
+def color_by_experiment(actor, colors, default = "lightgray"):
+    """
+    Color the streamlines of a merged actor by experiment
+
+    :param actor: actor created by `streamlines_actor()`
+    :param colors: dict, {experiment id: color}
+    :param default: str, color of the experiments missing from `colors`
+    """
+    mesh = getattr(actor, "mesh", actor)
+    cell_data = mesh.polydata(False).GetCellData()
+    line_experiments = vtk_to_numpy(cell_data.GetArray(EXPERIMENT_ID_ARRAY))
+
+    # lookup table of one color per experiment, indexed by the position of each cell's experiment in the table
+    experiments = np.unique(line_experiments)
+    lut = np.array([getColor(colors.get(eid, default)) for eid in experiments.tolist()]) * 255
+    cell_colors = lut.round().astype(np.uint8)[np.searchsorted(experiments, line_experiments)]
+
+    array = numpy_to_vtk(cell_colors, deep = True, array_type = vtk.VTK_UNSIGNED_CHAR)
+    array.SetName("ExperimentColors")
+    cell_data.AddArray(array)
+    cell_data.SetActiveScalars("ExperimentColors")
+
+    mapper = mesh.GetMapper()
+    mapper.SetScalarModeToUseCellData()
+    mapper.SetColorModeToDirectScalars()
+    mapper.ScalarVisibilityOn()
+    return actor
+
+
+def experiment_at_cell(actor, cell_id):
+    """
+    Experiment ID of a cell of a merged actor (e.g. the cell returned when picking)
+
+    :param actor: actor created by `streamlines_actor()`
+    :param cell_id: int
+    """
+    mesh = getattr(actor, "mesh", actor)
+    return int(mesh.polydata(False).GetCellData().GetArray(EXPERIMENT_ID_ARRAY).GetValue(cell_id))
+
+
+# // UTILS //
+def _fetch_lines(eid, local_folder = None):
+    """
+    Lines of an experiment from the local folder or the Allen API, as a list of lists of {"x", "y", "z"} points
+    """
+    if local_folder is not None:
+        with open(Path(local_folder) / f"{eid}.json") as f:
+            data = json.load(f)
+    else:
+        from brainrender.atlas_specific.allen.streamlines import get_streamlines_data
+
+        logger.debug(f"STREAMLINES: downloading experiment {eid}")
+        with stage("download.streamlines", experiment = eid):
+            data = get_streamlines_data([eid])[0]
+
+    # same layout handling as brainrender's Streamlines actor
+    lines = data["lines"]
+    if len(lines) == 1:
+        try:
+            lines = lines[0]
+        except KeyError:
+            lines = lines["0"]
+    return lines
+
+
+def _lines_to_arrays(lines):
+    """
+    Points (float32) and offsets of a list of lines of {"x", "y", "z"} points
+    """
+    points = np.array([[p["x"], p["y"], p["z"]] for line in lines for p in line], dtype = np.float32).reshape(-1, 3)
+    offsets = np.concatenate([[0], np.cumsum([len(line) for line in lines])]).astype(np.int64)
+    return points, offsets
+
+
+def _cell_array(offsets):
+    """
+    vtkCellArray of polylines from line offsets, built with NumPy (legacy layout: [n points, point ids..., n points, ...])
+    """
+    counts = np.diff(offsets)
+    n_lines, n_points = len(counts), int(offsets[-1])
+    connectivity = np.empty(n_points + n_lines, dtype = np.int64)
+    connectivity[offsets[:-1] + np.arange(n_lines)] = counts
+    connectivity[np.arange(n_points) + np.repeat(np.arange(1, n_lines + 1), counts)] = np.arange(n_points)
+
+    cells = vtk.vtkCellArray()
+    cells.SetCells(n_lines, numpy_to_vtkIdTypeArray(connectivity, deep = True))
+    return cells
+
+
+def _save_npz(filepath, **arrays):
+    """
+    Save arrays to a compressed .npz file (only complete files end up in the cache)
+    """
+    filepath = Path(filepath)
+    filepath.parent.mkdir(parents = True, exist_ok = True)
+    tmp_file = filepath.with_suffix(".tmp.npz")
+    np.savez_compressed(tmp_file, **arrays)
+    tmp_file.replace(filepath)
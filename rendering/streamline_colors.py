@@ -0,0 +1,215 @@
+"""
+    Vectorized color gradients for streamline (and other mesh) actors.
+
+    Instead of building a palette with one color per vertex (`makePalette(len(scals), ...)`) and passing it to `pointColors`,
+    a small lookup table is built once per color pair and vertices are colored with a single NumPy indexing operation.
+    The resulting RGB array is set directly as the actor's vertex colors, so recoloring a full streamline set is fast
+    enough to iterate on palettes interactively.
+    Merged actors made by `streamline_cache.streamlines_actor()` are split by experiment, each experiment getting its own color pair.
+
+    Example:
+        from streamline_colors import color_by_gradient
+        streamlines = scene.add(streamlines_actor(streams, alpha = 0.5))
+        color_by_gradient(streamlines, [["darkblue", "powderblue"], ["deeppink", "lightpink"]], scalars = "x")
+"""
+
+from functools import lru_cache
+from itertools import cycle
+
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+from vedo import getColor
+
+from streamline_cache import EXPERIMENT_ID_ARRAY
+
+
+# // DEFAULT SETTINGS //
+LUT_SIZE = 256 # number of colors in each gradient lookup table
+AXES = dict(x = 0, y = 1, z = 2) # scalars that can be picked by name: the vertices' coordinate along each axis
+COLORS_ARRAY_NAME = "GradientColors" # name of the vertex colors array added to the actors
+
+
+# // LOOKUP TABLES //
+@lru_cache(maxsize = None)
+def gradient_lut(color_from, color_to, n = LUT_SIZE):
+    """
+    Lookup table of `n` RGB colors (uint8) going linearly from one color to another. Tables are cached by color pair.
+
+    :param color_from: str or 3-tuple, color of the lowest scalar value
+    :param color_to: str or 3-tuple, color of the highest scalar value
+    :param n: int, number of colors in the table
+    """
+    start, end = np.asarray(getColor(color_from)), np.asarray(getColor(color_to))
+    steps = np.linspace(0, 1, n)[:, None]
+    lut = np.round((start + (end - start) * steps) * 255).astype(np.uint8)
+    lut.setflags(write = False) # shared between calls
+    return lut
+
+
+def gradient_colors(scalars, color_from, color_to, vmin = None, vmax = None, n = LUT_SIZE):
+    """
+    Map scalar values to RGB colors (uint8 array of shape (N, 3)) through a gradient lookup table
+
+    :param scalars: np.ndarray, (N,) scalar values
+    :param color_from: str or 3-tuple, color of `vmin`
+    :param color_to: str or 3-tuple, color of `vmax`
+    :param vmin, vmax: float, range of scalars mapped to the gradient (defaults to the scalars' range)
+    :param n: int, number of colors in the lookup table
+    """
+    scalars = np.asarray(scalars, dtype = np.float64)
+    vmin = scalars.min() if vmin is None else vmin
+    vmax = scalars.max() if vmax is None else vmax
+
+    lut = gradient_lut(_hashable(color_from), _hashable(color_to), n)
+    span = (vmax - vmin) or 1 # all scalars equal: use the first color
+    index = np.clip((scalars - vmin) * ((n - 1) / span), 0, n - 1).astype(np.intp)
+    return lut[index]
+
+
+def grouped_gradient_colors(scalars, groups, color_pairs, vmin = None, vmax = None, n = LUT_SIZE):
+    """
+    Map scalar values to RGB colors (uint8 array of shape (N, 3)) with one gradient per group of values, in a single pass
+
+    :param scalars: np.ndarray, (N,) scalar values
+    :param groups: np.ndarray, (N,) index in `color_pairs` of the gradient of each value (e.g. the experiment of each vertex)
+    :param color_pairs: list of (color_from, color_to) pairs, one per group
+    :param vmin, vmax: float, range of scalars mapped to the gradients (defaults to each group's own range)
+    :param n: int, number of colors in the lookup tables
+    """
+    scalars, groups = np.asarray(scalars, dtype = np.float64), np.asarray(groups, dtype = np.intp)
+    n_groups = len(color_pairs)
+    low, high = np.full(n_groups, np.inf), np.full(n_groups, -np.inf)
+    if vmin is None or vmax is None:
+        np.minimum.at(low, groups, scalars)
+        np.maximum.at(high, groups, scalars)
+    low = np.where(np.isfinite(low), low, 0) if vmin is None else np.full(n_groups, vmin, dtype = np.float64)
+    high = np.where(np.isfinite(high), high, 0) if vmax is None else np.full(n_groups, vmax, dtype = np.float64)
+    span = high - low
+    span[span == 0] = 1 # all scalars of a group equal: use the first color
+
+    # row of each value in the stacked lookup tables of all groups (in place, as values can be tens of millions of vertices)
+    luts = np.concatenate([gradient_lut(_hashable(color_from), _hashable(color_to), n) for color_from, color_to in color_pairs])
+    position = scalars - np.take(low, groups)
+    position *= np.take((n - 1) / span, groups)
+    np.clip(position, 0, n - 1, out = position)
+    index = position.astype(np.intp)
+    index += groups * n
+    return np.take(luts, index, axis = 0)
+
+
+# // ACTORS //
+def vertex_scalars(actor, scalars = "x"):
+    """
+    Scalar value of each vertex of an actor
+
+    :param actor: brainrender Actor or vedo Mesh
+    :param scalars: "x", "y", "z" (coordinate along an axis), a function of the (N, 3) vertices' coordinates or an array of values
+    """
+    if isinstance(scalars, str):
+        if scalars not in AXES:
+            raise ValueError(f"Scalars should be one of {list(AXES.keys())}, a function or an array, not {scalars}")
+        return actor.points()[:, AXES[scalars]]
+    elif callable(scalars):
+        return scalars(actor.points())
+    return np.asarray(scalars)
+
+
+def vertex_experiments(actor):
+    """
+    Experiment ID of each vertex of a merged streamlines actor, or None if the actor has no experiment IDs
+
+    :param actor: brainrender Actor or vedo Mesh (e.g. made by `streamlines_actor()`)
+    """
+    mesh = getattr(actor, "mesh", actor)
+    polydata = mesh.polydata(False)
+    if polydata.GetCellData().GetArray(EXPERIMENT_ID_ARRAY) is None:
+        return None
+
+    # each tube only shares vertices with the cells of its own line, so the cell values passed to the vertices are exact
+    to_points = vtk.vtkCellDataToPointData()
+    to_points.SetInputData(polydata)
+    to_points.ProcessAllArraysOff()
+    to_points.AddCellDataArray(EXPERIMENT_ID_ARRAY)
+    to_points.Update()
+    return vtk_to_numpy(to_points.GetOutput().GetPointData().GetArray(EXPERIMENT_ID_ARRAY)).astype(np.int64)
+
+
+def set_vertex_colors(actor, colors):
+    """
+    Set the color of each vertex of an actor from an (N, 3) uint8 RGB array
+
+    :param actor: brainrender Actor or vedo Mesh
+    :param colors: np.ndarray, (N, 3) uint8 array with one color per vertex
+    """
+    mesh = getattr(actor, "mesh", actor) # brainrender actors wrap a vedo mesh
+    array = numpy_to_vtk(np.ascontiguousarray(colors, dtype = np.uint8), deep = True, array_type = vtk.VTK_UNSIGNED_CHAR)
+    array.SetName(COLORS_ARRAY_NAME)
+
+    point_data = mesh.polydata(False).GetPointData()
+    point_data.AddArray(array)
+    point_data.SetActiveScalars(COLORS_ARRAY_NAME)
+
+    mapper = mesh.GetMapper()
+    mapper.SetScalarModeToUsePointData()
+    mapper.SetColorModeToDirectScalars() # use the colors as they are, without a vtk lookup table
+    mapper.ScalarVisibilityOn()
+    return actor
+
+
+def color_by_gradient(actors, color_combos, scalars = "x", shared_range = False, n = LUT_SIZE):
+    """
+    Color the vertices of each actor with a gradient between two colors, based on a scalar value per vertex.
+    The experiments of a merged streamlines actor (`streamlines_actor()`) are colored as if they were separate actors.
+
+    :param actors: list of brainrender Actors or vedo Meshes (e.g. streamlines), or a merged streamlines actor
+    :param color_combos: pair of colors used for all actors, or list of pairs (reused in turn if there are fewer pairs than actors or experiments)
+    :param scalars: "x", "y", "z" (coordinate along an axis), a function of the (N, 3) vertices' coordinates or a list of arrays (one per actor)
+    :param shared_range: bool, if true the gradient spans the scalars' range across all actors instead of each actor's (or experiment's) own range
+    :param n: int, number of colors in the lookup tables
+    """
+    actors = actors if isinstance(actors, (list, tuple)) else [actors]
+    if isinstance(color_combos[0], str):
+        color_combos = [color_combos]
+
+    if isinstance(scalars, (str, type(None))) or callable(scalars):
+        values = [vertex_scalars(actor, scalars or "x") for actor in actors]
+    else:
+        values = [np.asarray(s) for s in scalars]
+
+    vmin = vmax = None
+    if shared_range:
+        vmin, vmax = min(v.min() for v in values), max(v.max() for v in values)
+
+    combos = cycle(color_combos)
+    for actor, scals in zip(actors, values):
+        # one color pair for the whole actor, or one per experiment in the order they were added
+        experiments = vertex_experiments(actor)
+        if experiments is None:
+            groups, n_groups = np.zeros(len(scals), dtype = np.intp), 1
+        else:
+            groups, n_groups = _groups_in_order(experiments)
+        pairs = [next(combos) for _ in range(n_groups)]
+        set_vertex_colors(actor, grouped_gradient_colors(scals, groups, pairs, vmin = vmin, vmax = vmax, n = n))
+    return actors
+
+
+# // UTILS //
+def _groups_in_order(labels):
+    """
+    Index of each label's group, groups being numbered in order of first appearance, and number of groups.
+    The labels of a merged actor come in long runs (the vertices of each experiment are contiguous), so only the runs are sorted.
+    """
+    starts = np.flatnonzero(np.concatenate([[True], labels[1:] != labels[:-1]]))
+    run_labels = labels[starts]
+    _, first, run_groups = np.unique(run_labels, return_index = True, return_inverse = True)
+    rank = np.empty(len(first), dtype = np.intp)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return np.repeat(rank[run_groups.ravel()], np.diff(np.append(starts, len(labels)))), len(first)
+
+
+def _hashable(color):
+    """
+    Colors given as lists or arrays are turned into tuples, so they can be used as keys of the lookup tables cache
+    """
+    return color if isinstance(color, str) else tuple(float(c) for c in color)
@@ -0,0 +1,257 @@
+"""
+    Synthetic stand-in for a BrainGlobe atlas (labelled ellipsoids and a small ontology) and synthetic cells, streamlines and neurons.
+
+    The helpers of this folder only use a few attributes of BrainGlobeAtlas (`atlas_name`, `resolution`, `shape`,
+    `annotation`, `reference`, `structures`, `lookup_df`, `meshfile_from_structure()`), so `SyntheticAtlas` provides
+    them from volumes generated on the fly: a brain-sized ellipsoid (root) containing a midbrain, a PAG around an
+    aqueduct split into dmpag, dlpag, lpag and vlpag by angle, with SCm above and DR below. Region meshes are made
+    from the annotation with vedo the first time they are requested. Nothing is downloaded, so benchmarks and
+    examples run offline and give the same volumes on every machine.
+
+    Example:
+        from synthetic_atlas import SyntheticAtlas, synthetic_cells
+        atlas = SyntheticAtlas(resolution = 25)
+        area_dataframe = structures_from_coords(dict(synthetic = atlas), synthetic_cells(atlas, 100000), microns = True)
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# // DEFAULT SETTINGS //
+SYNTHETIC_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "synthetic" # where meshes of synthetic atlases are written
+SYNTHETIC_VERSION = "1" # bump when the volumes change, so caches keyed by atlas version are not reused
+BRAIN_SIZE_UM = (13200, 8000, 11400) # size (in microns) of the volumes along AP, DV and ML, as in the Allen mouse atlas
+SLAB_SIZE = 16 # number of AP planes generated at once
+
+# acronym: (id, parent acronym, rgb) of the structures of the ontology
+ONTOLOGY = {
+    "root": (997, None, (255, 255, 255)),
+    "grey": (8, "root", (191, 218, 227)),
+    "MB": (313, "grey", (255, 100, 255)),
+    "PAG": (795, "MB", (255, 144, 255)),
+    "dmpag": (50001, "PAG", (255, 166, 255)),
+    "dlpag": (50002, "PAG", (255, 155, 255)),
+    "lpag": (50003, "PAG", (255, 133, 255)),
+    "vlpag": (50004, "PAG", (255, 122, 255)),
+    "SCm": (294, "MB", (255, 122, 255)),
+    "DR": (872, "MB", (255, 166, 255)),
+}
+
+# ellipsoids as (centre, radii) in fractions of BRAIN_SIZE_UM along AP, DV and ML
+BRAIN = ((0.5, 0.5, 0.5), (0.45, 0.42, 0.45))
+MIDBRAIN = ((0.6, 0.42, 0.5), (0.1, 0.16, 0.14))
+PAG_OUTER = ((0.6, 0.4, 0.5), (0.08, 0.06, 0.05))
+AQUEDUCT = ((0.6, 0.4, 0.5), (0.08, 0.015, 0.008))
+SUPERIOR_COLLICULUS = ((0.6, 0.3, 0.5), (0.07, 0.035, 0.1))
+DORSAL_RAPHE = ((0.6, 0.5, 0.5), (0.05, 0.03, 0.015))
+PAG_ANGLES = (("dmpag", 30), ("dlpag", 70), ("lpag", 115), ("vlpag", 180)) # upper bound of the angle (in degrees) from the dorsal direction
+
+
+# // ATLAS //
+class SyntheticAtlas:
+    def __init__(self, resolution = 50, folder = SYNTHETIC_FOLDER):
+        """
+        Atlas with the attributes of a BrainGlobeAtlas used in this folder, generated from labelled ellipsoids
+
+        :param resolution: float, size (in microns) of the voxels
+        :param folder: str, Path. Where region meshes are written
+        """
+        self.atlas_name = f"synthetic_mouse_{resolution:g}um"
+        self.local_full_name = f"{self.atlas_name}_v{SYNTHETIC_VERSION}"
+        self.resolution = (float(resolution),) * 3
+        self.shape = tuple(int(round(size / resolution)) for size in BRAIN_SIZE_UM)
+        self.folder = Path(folder) / self.local_full_name
+        self.structures = _Structures()
+        for acronym, (structure_id, parent, rgb) in ONTOLOGY.items():
+            path = (list(self.structures[parent]["structure_id_path"]) if parent else []) + [structure_id]
+            self.structures[structure_id] = dict(acronym = acronym, id = structure_id, name = acronym, structure_id_path = path,
+                rgb_triplet = list(rgb))
+        self.lookup_df = pd.DataFrame([dict(acronym = s["acronym"], id = s["id"], name = s["name"]) for s in self.structures.values()])
+        self._annotation = self._reference = None
+
+    def __repr__(self):
+        return f"SyntheticAtlas {self.atlas_name} of shape {self.shape}"
+
+    @property
+    def annotation(self):
+        if self._annotation is None:
+            self._generate()
+        return self._annotation
+
+    @property
+    def reference(self):
+        if self._reference is None:
+            self._generate()
+        return self._reference
+
+    def _get_from_structure(self, structure, key):
+        return self.structures[structure][key]
+
+    def meshfile_from_structure(self, structure):
+        """
+        Path of the .obj mesh of a structure (and its descendants), made from the annotation the first time
+
+        :param structure: str or int, acronym or ID
+        """
+        structure_id = self.structures[structure]["id"]
+        filepath = self.folder / "meshes" / f"{structure_id}.obj"
+        if not filepath.exists():
+            from vedo import Volume
+
+            ids = [s["id"] for s in self.structures.values() if structure_id in s["structure_id_path"]]
+            mask = np.isin(self.annotation, ids).astype(np.uint8)
+            mesh = Volume(mask, spacing = self.resolution).isosurface(0.5)
+            filepath.parent.mkdir(parents = True, exist_ok = True)
+            tmp_file = filepath.with_name(filepath.stem + ".tmp.obj")
+            mesh.write(str(tmp_file))
+            tmp_file.replace(filepath)
+        return filepath
+
+    def _generate(self):
+        """
+        Label the voxels, in slabs of AP planes to bound the memory used by the coordinate grids
+        """
+        annotation = np.zeros(self.shape, dtype = np.uint32)
+        reference = np.zeros(self.shape, dtype = np.uint16)
+        ids = {acronym: structure_id for acronym, (structure_id, _, _) in ONTOLOGY.items()}
+        size = np.asarray(BRAIN_SIZE_UM, dtype = np.float64)
+
+        dv, ml = np.ogrid[:self.shape[1], :self.shape[2]]
+        dv_um, ml_um = (dv + 0.5) * self.resolution[1], (ml + 0.5) * self.resolution[2]
+        for start in range(0, self.shape[0], SLAB_SIZE):
+            ap_um = (np.arange(start, min(start + SLAB_SIZE, self.shape[0]))[:, None, None] + 0.5) * self.resolution[0]
+            inside = lambda ellipsoid: _ellipsoid_distance(ap_um, dv_um, ml_um, ellipsoid, size) < 1
+
+            labels = np.zeros(np.broadcast_shapes(ap_um.shape, dv_um.shape, ml_um.shape), dtype = np.uint32)
+            brain = _ellipsoid_distance(ap_um, dv_um, ml_um, BRAIN, size)
+            labels[brain < 1] = ids["root"]
+            labels[inside(MIDBRAIN)] = ids["MB"]
+            labels[inside(SUPERIOR_COLLICULUS)] = ids["SCm"]
+            labels[inside(DORSAL_RAPHE)] = ids["DR"]
+
+            # the PAG surrounds the aqueduct and is split by the angle around it, from dorsal (0) to ventral (180 degrees)
+            pag = inside(PAG_OUTER) & ~inside(AQUEDUCT)
+            angle = np.degrees(np.arctan2(np.abs(ml_um - PAG_OUTER[0][2] * size[2]), PAG_OUTER[0][1] * size[1] - dv_um))
+            angle = np.broadcast_to(angle, labels.shape)
+            lower = 0
+            for acronym, upper in PAG_ANGLES:
+                labels[pag & (angle >= lower) & (angle <= upper)] = ids[acronym]
+                lower = upper
+
+            annotation[start:start + len(ap_um)] = labels
+            reference[start:start + len(ap_um)] = np.where(brain < 1, 1000 + 200 * (labels % 7) + 400 * (1 - brain), 0).astype(np.uint16)
+        self._annotation, self._reference = annotation, reference
+
+
+class _Structures(dict):
+    """
+    {id: structure} that can also be indexed by acronym, like brainglobe's StructuresDict
+    """
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            for structure in self.values():
+                if structure["acronym"] == key:
+                    return structure
+            raise KeyError(key)
+        return dict.__getitem__(self, int(key))
+
+
+# // SYNTHETIC DATA //
+def synthetic_cells(atlas, n_cells, region = "PAG", seed = 0):
+    """
+    Coordinates (in microns, AP, DV, ML) of cells scattered around the centre of a region
+
+    :param atlas: SyntheticAtlas
+    :param n_cells: int
+    :param region: str, acronym of the region (one of ONTOLOGY)
+    :param seed: int
+    """
+    centre, radii = _region_ellipsoid(region)
+    rng = np.random.default_rng(seed)
+    return (centre + rng.normal(0, 0.5, (n_cells, 3)) * radii).astype(np.float32)
+
+
+def synthetic_metadata(atlas, n_cells, seed = 0):
+    """
+    Metadata table of synthetic cells, with CCF coordinates (in Sharp-Track voxels of 10um) and a cell type
+
+    :param atlas: SyntheticAtlas
+    :param n_cells: int
+    :param seed: int
+    """
+    coords = synthetic_cells(atlas, n_cells, seed = seed) / 10
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "cell.id": [f"cell_{i}" for i in range(n_cells)],
+        "cell.type": pd.Categorical(rng.choice(["VGAT", "VGluT2"], n_cells)),
+        "CCF.AllenAP": coords[:, 0], "CCF.AllenDV": coords[:, 1], "CCF.AllenML": coords[:, 2]})
+
+
+def synthetic_streamlines(atlas, n_experiments = 20, lines_per_experiment = 50, points_per_line = 100, step = 40, seed = 0):
+    """
+    Random-walk streamlines starting in the PAG, as {experiment id: (points, offsets)} like `streamline_cache.load_streamlines()`
+
+    :param atlas: SyntheticAtlas
+    :param n_experiments: int
+    :param lines_per_experiment: int
+    :param points_per_line: int
+    :param step: float, length (in microns) of each step
+    :param seed: int
+    """
+    rng = np.random.default_rng(seed)
+    streamlines = {}
+    for eid in range(1, n_experiments + 1):
+        start = synthetic_cells(atlas, 1, seed = seed + eid)[0]
+        direction = rng.normal(0, 1, (lines_per_experiment, 1, 3)) # each line drifts away from the injection
+        steps = rng.normal(0, 1, (lines_per_experiment, points_per_line, 3)) + direction
+        steps *= step / np.linalg.norm(steps, axis = 2, keepdims = True)
+        points = (start + np.cumsum(steps, axis = 1)).reshape(-1, 3).astype(np.float32)
+        streamlines[eid * 1000] = (points, np.arange(0, len(points) + 1, points_per_line, dtype = np.int64))
+    return streamlines
+
+
+def synthetic_neuron(atlas, n_nodes = 20000, branch_probability = 0.02, step = 15, seed = 0):
+    """
+    Random branching tree starting in the PAG, as node coordinates and parent indices (-1 for the soma), like `neuron_store.read_morphology()`
+
+    :param atlas: SyntheticAtlas
+    :param n_nodes: int
+    :param branch_probability: float, probability of a node starting a new branch from a random earlier node
+    :param step: float, length (in microns) of each segment
+    :param seed: int
+    """
+    rng = np.random.default_rng(seed)
+    parents = np.arange(-1, n_nodes - 1)
+    branches = np.flatnonzero(rng.random(n_nodes) < branch_probability)
+    branches = branches[branches > 1]
+    parents[branches] = (rng.random(len(branches)) * (branches - 1)).astype(np.int64)
+
+    steps = rng.normal(0, 1, (n_nodes, 3))
+    steps *= step / np.linalg.norm(steps, axis = 1, keepdims = True)
+    points = np.zeros((n_nodes, 3))
+    points[0] = synthetic_cells(atlas, 1, seed = seed)[0]
+    for node in range(1, n_nodes): # parents always come before their children
+        points[node] = points[parents[node]] + steps[node]
+    return points, parents
+
+
+# // UTILS //
+def _ellipsoid_distance(ap_um, dv_um, ml_um, ellipsoid, size):
+    """
+    Normalised distance to the centre of an ellipsoid (< 1 inside)
+    """
+    (c_ap, c_dv, c_ml), (r_ap, r_dv, r_ml) = (np.asarray(x) * size for x in ellipsoid)
+    return np.sqrt(((ap_um - c_ap) / r_ap) ** 2 + ((dv_um - c_dv) / r_dv) ** 2 + ((ml_um - c_ml) / r_ml) ** 2)
+
+
+def _region_ellipsoid(region):
+    """
+    Centre and radii (in microns) of the ellipsoid of a region
+    """
+    ellipsoids = dict(root = BRAIN, grey = BRAIN, MB = MIDBRAIN, SCm = SUPERIOR_COLLICULUS, DR = DORSAL_RAPHE)
+    centre, radii = ellipsoids.get(region, PAG_OUTER)
+    size = np.asarray(BRAIN_SIZE_UM, dtype = np.float64)
+    return np.asarray(centre) * size, np.asarray(radii) * size
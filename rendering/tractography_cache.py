@@ -0,0 +1,338 @@
+"""
+    Local cache of Allen mouse connectivity tractography, with a spatial index for target-centred queries.
+
+    `ABA().get_projection_tracts_to_target(p0)` asks the Allen API (target spatial search) for the tracts reaching a single
+    point every time a script runs. Here the tracts found for a set of seed points (e.g. points in every PAG subdivision)
+    are fetched once, concurrently, and stored as one .json file per seed point. All cached tracts are then gathered in
+    a `TractIndex`: float32 vertices of all paths with the tract of each vertex, injection coordinates and injected
+    structures, and KD-trees (scipy) over the vertices and injection sites.
+
+    Questions like "tracts passing within X um of these points / of this region", "tracts injected in these regions"
+    or "tracts injected in VIP regions" are then answered locally, so targets can be swept over all PAG subdivisions.
+    Selected tracts are returned in the Allen format, as expected by `scene.add_tractography`.
+
+    For offline use (or tests), a folder of `<x>_<y>_<z>.json` files (the Allen API's answer for each seed point, in microns)
+    can stand in for the remote service.
+
+    Example:
+        from tractography_cache import fetch_tracts, region_seeds, TractIndex
+        fetch_tracts(region_seeds(scene.atlas, ["PAG"]))
+        index = TractIndex.from_cache()
+        tracts = index.tracts(index.near_region(scene.atlas, "PAG", radius = 100) & index.injected_in(scene.atlas, ["SCm"]))
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+from atlas_hierarchy import get_hierarchy_table
+from atlas_lookup import ids_from_coords
+from atlas_roi import get_roi
+from profiling import stage, cache_hit, cache_miss
+
+
+# // DEFAULT SETTINGS //
+TRACTOGRAPHY_CACHE_FOLDER = Path.home() / ".brainglobe" / "PAG_brainrender" / "tractography" # where the tracts of each seed point are stored
+LOCAL_TRACTOGRAPHY_FOLDER = None # folder of `<x>_<y>_<z>.json` query results used instead of the Allen API (offline use)
+TARGET_SPATIAL_SEARCH = "http://api.brain-map.org/api/v2/data/query.json?criteria=service::mouse_connectivity_target_spatial[seed_point$eq{},{},{}]"
+FETCH_WORKERS = 8 # number of concurrent queries
+SEEDS_PER_REGION = 5 # number of seed points in each region (its centre of mass and random voxels)
+VERTEX_TREE_POINTS = 1000 # queries with up to this many points use the tree of the tract vertices, larger ones a tree of the points
+
+
+# // CACHE //
+def fetch_tracts(seeds, workers = FETCH_WORKERS, force_download = False, cache_folder = TRACTOGRAPHY_CACHE_FOLDER, local_folder = None):
+    """
+    Make sure the tracts reaching each seed point are cached, querying the missing seed points concurrently.
+    Returns the number of tracts of each seed point ({seed key: n tracts}).
+
+    :param seeds: np.ndarray, (N, 3) seed points in microns (AP, DV, ML)
+    :param workers: int, number of concurrent queries
+    :param force_download: bool, if true query again the seed points already cached
+    :param cache_folder: str, Path. Where the tracts of each seed point are stored
+    :param local_folder: str, Path. Folder of `<x>_<y>_<z>.json` query results used instead of the Allen API. Defaults to LOCAL_TRACTOGRAPHY_FOLDER
+    """
+    cache_folder = Path(cache_folder)
+    local_folder = local_folder or LOCAL_TRACTOGRAPHY_FOLDER
+    seeds = {seed_key(s): s for s in np.atleast_2d(seeds)}
+    missing = [key for key in seeds if force_download or not (cache_folder / "seeds" / f"{key}.json").exists()]
+    cache_hit("tracts", len(seeds) - len(missing))
+    cache_miss("tracts", len(missing))
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = {pool.submit(_query_tracts, seeds[key], local_folder): key for key in missing}
+        for n, future in enumerate(as_completed(futures), start = 1):
+            key = futures[future]
+            try:
+                tracts = future.result()
+            except Exception as e:
+                logger.warning(f"TRACTOGRAPHY: could not get the tracts to {key}: {e}")
+                continue
+            _write_json(cache_folder / "seeds" / f"{key}.json", tracts)
+            counts[key] = len(tracts)
+            logger.debug(f"TRACTOGRAPHY: [{n}/{len(missing)}] {len(tracts)} tracts to {key}")
+
+    for key in seeds:
+        if key not in counts and (cache_folder / "seeds" / f"{key}.json").exists():
+            with open(cache_folder / "seeds" / f"{key}.json") as f:
+                counts[key] = len(json.load(f))
+    return counts
+
+
+def seed_key(point):
+    """
+    Name of a seed point in the cache (microns, rounded): "<x>_<y>_<z>"
+    """
+    return "_".join(str(int(round(float(c)))) for c in point)
+
+
+def region_seeds(atlas, regions, n_seeds = SEEDS_PER_REGION, seed = 0):
+    """
+    Seed points (in microns) in some regions: the centre of mass of each region and random voxels of the region
+
+    :param atlas: BrainGlobeAtlas
+    :param regions: list of str, acronyms of the regions (each includes its descendants)
+    :param n_seeds: int, number of seed points per region (including its centre of mass)
+    :param seed: int, seed of the random voxels
+    """
+    rng = np.random.default_rng(seed)
+    points = []
+    for region in regions:
+        roi = get_roi(atlas, regions = [region])
+        voxels = np.argwhere(roi.region_mask(region))
+        if not len(voxels):
+            continue
+        chosen = voxels[rng.choice(len(voxels), size = min(n_seeds - 1, len(voxels)), replace = False)]
+        centers = np.vstack([voxels.mean(axis = 0), chosen]) + 0.5 # voxel centres
+        points.append((centers + roi.offset) * np.asarray(atlas.resolution, dtype = np.float64))
+    return np.vstack(points) if points else np.zeros((0, 3))
+
+
+# // INDEX //
+class TractIndex:
+    def __init__(self, tracts, seeds = None):
+        """
+        Spatial index of tracts in the Allen format (dicts with "path", "injection-coordinates", "injection-structures", ...)
+
+        :param tracts: list of dict, tracts as returned by the Allen target spatial search
+        :param seeds: list of str, seed key of each tract
+        """
+        self.raw = list(tracts)
+        self.seeds = np.array(seeds if seeds is not None else [""] * len(self.raw))
+        self.experiment_ids = np.array([t.get("id", -1) for t in self.raw], dtype = np.int64)
+
+        # vertices of all paths, line i is vertices[offsets[i]:offsets[i + 1]]
+        paths = [np.array([p["coord"] for p in t["path"]], dtype = np.float32).reshape(-1, 3) for t in self.raw]
+        self.offsets = np.concatenate([[0], np.cumsum([len(p) for p in paths])]).astype(np.int64)
+        self.vertices = np.concatenate(paths) if paths else np.zeros((0, 3), dtype = np.float32)
+        self.tract_of_vertex = np.repeat(np.arange(len(self.raw)), np.diff(self.offsets))
+
+        self.injections = np.array([t["injection-coordinates"] for t in self.raw], dtype = np.float32).reshape(-1, 3)
+        self.injection_volumes = np.array([t.get("injection-volume", np.nan) for t in self.raw], dtype = np.float32)
+        self.injection_structures = [[s["id"] for s in t.get("injection-structures", [])] for t in self.raw]
+        self.injection_acronyms = [[s["abbreviation"] for s in t.get("injection-structures", [])] for t in self.raw]
+
+        self._vertex_tree, self._injection_tree = None, None
+
+    @classmethod
+    def from_cache(cls, seeds = None, cache_folder = TRACTOGRAPHY_CACHE_FOLDER, unique = True):
+        """
+        Index of the cached tracts
+
+        :param seeds: np.ndarray, (N, 3) seed points in microns, or list of seed keys (defaults to all cached seed points)
+        :param cache_folder: str, Path. Where the tracts of each seed point are stored
+        :param unique: bool, if true keep a single tract per experiment (the same experiment can reach several seed points)
+        """
+        folder = Path(cache_folder) / "seeds"
+        if seeds is None:
+            keys = sorted(f.stem for f in folder.glob("*.json"))
+        else:
+            keys = [s if isinstance(s, str) else seed_key(s) for s in (seeds if isinstance(seeds, list) else np.atleast_2d(seeds))]
+
+        tracts, tract_seeds, experiments = [], [], set()
+        for key in keys:
+            with open(folder / f"{key}.json") as f:
+                for tract in json.load(f):
+                    if unique and tract.get("id") in experiments:
+                        continue
+                    experiments.add(tract.get("id"))
+                    tracts.append(tract)
+                    tract_seeds.append(key)
+        return cls(tracts, seeds = tract_seeds)
+
+    def __repr__(self):
+        return f"TractIndex of {len(self)} tracts ({len(self.vertices)} vertices)"
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def vertex_tree(self):
+        if self._vertex_tree is None:
+            from scipy.spatial import cKDTree
+            self._vertex_tree = cKDTree(self.vertices)
+        return self._vertex_tree
+
+    @property
+    def injection_tree(self):
+        if self._injection_tree is None:
+            from scipy.spatial import cKDTree
+            self._injection_tree = cKDTree(self.injections)
+        return self._injection_tree
+
+    # --------------------------------- queries --------------------------------- #
+    def near_points(self, points, radius):
+        """
+        Boolean mask of the tracts passing within `radius` microns of any of the points
+
+        :param points: np.ndarray, (N, 3) points in microns
+        :param radius: float, distance in microns
+        """
+        from scipy.spatial import cKDTree
+
+        points = np.atleast_2d(np.asarray(points, dtype = np.float64))
+        mask = np.zeros(len(self), dtype = bool)
+        if not len(points) or not len(self.vertices):
+            return mask
+
+        if len(points) <= VERTEX_TREE_POINTS: # a few points are queried against the tree of the vertices
+            vertices = [i for found in self.vertex_tree.query_ball_point(points, radius) for i in found]
+            mask[np.unique(self.tract_of_vertex[np.asarray(vertices, dtype = np.int64)])] = True
+            return mask
+
+        # many points (e.g. a region's boundary): the vertices are queried against a tree of the points, bounded by the radius
+        distances, _ = cKDTree(points).query(self.vertices, distance_upper_bound = radius)
+        mask[np.unique(self.tract_of_vertex[np.isfinite(distances)])] = True
+        return mask
+
+    def near_region(self, atlas, region, radius = 0):
+        """
+        Boolean mask of the tracts passing through a region (and its descendants) or within `radius` microns of it
+
+        :param atlas: BrainGlobeAtlas
+        :param region: str, acronym of the region
+        :param radius: float, distance in microns (0 for tracts with a vertex in the region)
+        """
+        mask = np.zeros(len(self), dtype = bool)
+        inside = get_hierarchy_table(atlas).is_within(ids_from_coords(atlas, self.vertices, microns = True), region)
+        mask[np.unique(self.tract_of_vertex[inside])] = True
+        if radius > 0: # vertices outside the region are tested against the region's boundary voxels
+            mask |= self.near_points(region_boundary(atlas, region), radius)
+        return mask
+
+    def injections_near(self, points, radius):
+        """
+        Boolean mask of the tracts whose injection site is within `radius` microns of any of the points
+
+        :param points: np.ndarray, (N, 3) points in microns
+        :param radius: float, distance in microns
+        """
+        from scipy.spatial import cKDTree
+
+        mask = np.zeros(len(self), dtype = bool)
+        neighbours = cKDTree(np.atleast_2d(points)).query_ball_tree(self.injection_tree, radius)
+        found = [i for n in neighbours for i in n]
+        mask[np.unique(np.asarray(found, dtype = np.int64))] = True
+        return mask
+
+    def injected_in(self, atlas, regions, primary_only = False):
+        """
+        Boolean mask of the tracts injected in any of the regions (or their descendants), e.g. VIP regions
+
+        :param atlas: BrainGlobeAtlas
+        :param regions: list of str, acronyms of the regions
+        :param primary_only: bool, if true only the first injected structure of each tract is tested (as `include_all_inj_regions = False`)
+        """
+        regions = [regions] if isinstance(regions, str) else list(regions)
+        table = get_hierarchy_table(atlas)
+        structures = [s[:1] if primary_only else s for s in self.injection_structures]
+        tract_of_structure = np.repeat(np.arange(len(self)), [len(s) for s in structures])
+        ids = np.array([i for s in structures for i in s], dtype = np.int64)
+
+        mask = np.zeros(len(self), dtype = bool)
+        for region in regions:
+            try:
+                mask[tract_of_structure[table.is_within(ids, region)]] = True
+            except KeyError:
+                print(f"The region {region} doesn't seem to belong to the atlas being used: {atlas.atlas_name}. Skipping")
+        return mask
+
+    def tracts_by_target(self, atlas, targets, radius = 0):
+        """
+        Tracts reaching each target region, as {region: indices of the tracts}
+
+        :param atlas: BrainGlobeAtlas
+        :param targets: list of str, acronyms of the target regions (e.g. the PAG subdivisions)
+        :param radius: float, distance in microns (see `near_region()`)
+        """
+        return {region: np.flatnonzero(self.near_region(atlas, region, radius = radius)) for region in targets}
+
+    def tracts(self, selection = None):
+        """
+        Tracts in the Allen format (e.g. for `scene.add_tractography`)
+
+        :param selection: boolean mask or indices of tracts (defaults to all tracts)
+        """
+        if selection is None:
+            return list(self.raw)
+        selection = np.asarray(selection)
+        indices = np.flatnonzero(selection) if selection.dtype == bool else selection
+        return [self.raw[i] for i in indices]
+
+    def path(self, i):
+        """
+        (N, 3) vertices of a tract
+        """
+        return self.vertices[self.offsets[i]:self.offsets[i + 1]]
+
+
+# // UTILS //
+def region_boundary(atlas, region):
+    """
+    Centres (in microns) of the voxels of a region (and its descendants) on its boundary
+
+    :param atlas: BrainGlobeAtlas
+    :param region: str, acronym of the region
+    """
+    roi = get_roi(atlas, regions = [region])
+    mask = np.pad(roi.region_mask(region), 1)
+    interior = mask.copy()
+    for axis in range(3):
+        interior[1:-1, 1:-1, 1:-1] &= np.roll(mask, 1, axis)[1:-1, 1:-1, 1:-1] & np.roll(mask, -1, axis)[1:-1, 1:-1, 1:-1]
+    voxels = np.argwhere((mask & ~interior)[1:-1, 1:-1, 1:-1])
+    return (voxels + 0.5 + roi.offset) * np.asarray(atlas.resolution, dtype = np.float64)
+
+
+def _query_tracts(point, local_folder = None):
+    """
+    Tracts reaching a seed point, from the local folder or the Allen target spatial search
+    """
+    if local_folder is not None:
+        with open(Path(local_folder) / f"{seed_key(point)}.json") as f:
+            return json.load(f)
+
+    import requests
+
+    with stage("download.tracts", seed = seed_key(point)):
+        response = requests.get(TARGET_SPATIAL_SEARCH.format(*[int(round(float(c))) for c in point]), timeout = 120)
+    response.raise_for_status()
+    data = response.json()
+    if not data.get("success", True):
+        raise ValueError(data.get("msg", "the query failed"))
+    return data["msg"]
+
+
+def _write_json(filepath, data):
+    """
+    Write a .json file (only complete files end up in the cache)
+    """
+    filepath = Path(filepath)
+    filepath.parent.mkdir(parents = True, exist_ok = True)
+    tmp_file = filepath.with_name(filepath.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    tmp_file.replace(filepath)
@@ -0,0 +1,375 @@
+"""
+    Series of virtual sections (thin slabs) cut directly from the annotation volume of an atlas, with region contours and cells.
+
+    Slicing a scene cuts every mesh with two planes per section (`scene.slice()`), so a series of 100 sections through the
+    PAG means hundreds of mesh cuts. Here a whole stack of sections, perpendicular to an axis or to any oblique normal, is
+    sampled from the annotation (and optionally the reference) volume: the microns coordinates of every pixel of a batch
+    of sections are computed at once and looked up with a single fancy-index of the volume (see atlas_lookup.py).
+
+    Each section is a 2D label image. Region contours are polylines traced on the label images (marching squares on the
+    region masks of all sections at once), and registered cells are assigned to the slab that contains them and projected
+    onto it, so manual subdivisions can be compared with the atlas section by section.
+
+    Example:
+        from atlas_roi import get_roi
+        from virtual_sections import section_stack, plot_sections
+        sections = section_stack(get_roi(get_atlas("kim_mouse_10um"), with_reference = True), normal = "AP", thickness = 25, with_reference = True)
+        fig = plot_sections(sections, regions = ["dmpag", "dlpag", "lpag", "vlpag"], cells = coordinates.to("microns"))
+"""
+
+from collections import deque
+
+import numpy as np
+
+from atlas_hierarchy import get_hierarchy_table
+from atlas_lookup import ids_from_coords, coords_to_voxels
+from atlas_roi import PAG_REGIONS, _descendant_ids, _bounding_box
+
+
+# // DEFAULT SETTINGS //
+AXES = ("AP", "DV", "ML") # axes of the atlas space (microns in brainrender)
+SECTION_THICKNESS = 25 # thickness (in microns) of each section
+SECTION_MARGIN = 200 # margin (in microns) added around the regions framed by the sections
+BATCH_SIZE = 16 # number of sections sampled at once
+CELL_COLOR = "salmon" # color of the cells drawn on sections
+
+
+# // SECTIONS //
+class SectionStack:
+    def __init__(self, atlas, labels, positions, origin_um, normal, u, v, pixel_size, thickness, reference = None):
+        """
+        Stack of parallel sections sampled from an atlas. Pixel (row, col) of section i is centred at
+        `origin_um + positions[i] * normal + (col + 0.5) * pixel_size * u + (row + 0.5) * pixel_size * v` (microns).
+
+        :param atlas: BrainGlobeAtlas or RegionOfInterest the sections were sampled from
+        :param labels: np.ndarray, (n sections, rows, cols) structure IDs (sampled at the middle of each slab)
+        :param positions: np.ndarray, position (in microns along the normal) of the middle of each slab
+        :param origin_um: np.ndarray, position (in microns) of the corner of the sections at position 0
+        :param normal, u, v: np.ndarray, unit vectors: normal of the sections and directions of their columns and rows
+        :param pixel_size: float, size (in microns) of the pixels
+        :param thickness: float, thickness (in microns) of each slab
+        :param reference: np.ndarray or None, (n sections, rows, cols) reference intensities averaged across each slab
+        """
+        self.atlas = atlas
+        self.labels = labels
+        self.reference = reference
+        self.positions = np.asarray(positions, dtype = np.float64)
+        self.origin_um = np.asarray(origin_um, dtype = np.float64)
+        self.normal, self.u, self.v = (np.asarray(a, dtype = np.float64) for a in (normal, u, v))
+        self.pixel_size = float(pixel_size)
+        self.thickness = float(thickness)
+
+    def __repr__(self):
+        return f"SectionStack of {len(self)} sections of {self.thickness:g}um ({self.labels.shape[1]}x{self.labels.shape[2]} pixels of {self.pixel_size:g}um)"
+
+    def __len__(self):
+        return len(self.positions)
+
+    # ------------------------------- coordinates ------------------------------- #
+    def to_microns(self, section, pixels):
+        """
+        Position (in microns) of points of a section given in pixels
+
+        :param section: int, index of the section
+        :param pixels: np.ndarray, (N, 2) array of (col, row) pixel coordinates (e.g. contours)
+        """
+        pixels = np.atleast_2d(np.asarray(pixels, dtype = np.float64))
+        return (self.origin_um + self.positions[section] * self.normal
+            + np.outer((pixels[:, 0] + 0.5) * self.pixel_size, self.u) + np.outer((pixels[:, 1] + 0.5) * self.pixel_size, self.v))
+
+    def to_sections(self, coords):
+        """
+        Section containing each point (-1 for points in no slab) and its (col, row) pixel coordinates on the section
+
+        :param coords: np.ndarray, (N, 3) array of coordinates in microns (e.g. `Coordinates.to("microns")`)
+        """
+        offsets = np.atleast_2d(np.asarray(coords, dtype = np.float64)) - self.origin_um
+        depth = offsets @ self.normal
+        pixels = np.column_stack([offsets @ self.u, offsets @ self.v]) / self.pixel_size - 0.5
+
+        # nearest slab middle, then check that the point is within half a slab of it
+        order = np.argsort(self.positions)
+        sorted_positions = self.positions[order]
+        after = np.clip(np.searchsorted(sorted_positions, depth), 0, len(order) - 1)
+        before = np.clip(after - 1, 0, len(order) - 1)
+        nearest = np.where(np.abs(depth - sorted_positions[before]) < np.abs(depth - sorted_positions[after]), before, after)
+        inside = np.abs(depth - sorted_positions[nearest]) <= self.thickness / 2
+        inside &= np.all((pixels > -0.5) & (pixels < np.array(self.labels.shape[:0:-1]) - 0.5), axis = 1)
+        return np.where(inside, order[nearest], -1), pixels
+
+    def cells_in_sections(self, coords):
+        """
+        Row positions of the points in each section, as {section: index array} (sections without points are left out)
+
+        :param coords: np.ndarray, (N, 3) array of coordinates in microns
+        """
+        sections, _ = self.to_sections(coords)
+        order = np.argsort(sections, kind = "stable")
+        splits = np.split(order, np.searchsorted(sections[order], np.arange(len(self) + 1)))
+        return {i: rows for i, rows in enumerate(splits[1:-1]) if len(rows)}
+
+    # --------------------------------- regions --------------------------------- #
+    def region_mask(self, region):
+        """
+        Boolean (n sections, rows, cols) mask of a region and all its descendants
+
+        :param region: str or int, acronym or ID of the region
+        """
+        return get_hierarchy_table(self.atlas).is_within(self.labels, region)
+
+    def contours(self, region, sections = None):
+        """
+        Contours of a region on each section, as {section: list of (N, 2) arrays of (col, row) pixel coordinates}.
+        Closed contours repeat their first point at the end.
+
+        :param region: str or int, acronym or ID of the region
+        :param sections: list of int, sections to trace (defaults to all sections)
+        """
+        sections = range(len(self)) if sections is None else list(sections)
+        mask = get_hierarchy_table(self.atlas).is_within(self.labels[list(sections)], region)
+        segments, section_of_segment = _marching_squares(mask)
+
+        order = np.argsort(section_of_segment, kind = "stable")
+        splits = np.split(order, np.searchsorted(section_of_segment[order], np.arange(1, len(sections))))
+        return {s: _chain_segments(segments[rows]) for s, rows in zip(sections, splits)}
+
+    def region_color(self, region):
+        """
+        Color of a region in the atlas (RGB, 0-1)
+        """
+        return tuple(np.asarray(self.atlas.structures[region]["rgb_triplet"]) / 255)
+
+
+def section_stack(atlas, normal = "AP", thickness = SECTION_THICKNESS, n_sections = None, regions = PAG_REGIONS,
+    margin = SECTION_MARGIN, pixel_size = None, with_reference = False, slab_samples = 3, batch_size = BATCH_SIZE):
+    """
+    Sample a stack of parallel sections from an atlas, framing a set of regions. Returns a SectionStack.
+
+    :param atlas: BrainGlobeAtlas or RegionOfInterest (a ROI around the regions avoids reading the whole-brain volumes)
+    :param normal: str ("AP", "DV" or "ML") or 3-tuple (AP, DV, ML), normal of the sections (can be oblique)
+    :param thickness: float, thickness (in microns) of each slab
+    :param n_sections: int, number of sections evenly spread across the regions. Defaults to contiguous slabs covering the regions
+    :param regions: list of str, acronyms of the regions framed by the sections (None for the whole volume)
+    :param margin: float, margin (in microns) added around the regions
+    :param pixel_size: float, size (in microns) of the pixels (defaults to the atlas resolution)
+    :param with_reference: bool, if true the reference volume is sampled too (averaged across each slab)
+    :param slab_samples: int, number of planes across each slab averaged for the reference
+    :param batch_size: int, number of sections sampled at once
+    """
+    normal = _unit_normal(normal)
+    u, v = _section_axes(normal)
+    pixel_size = float(pixel_size or np.min(atlas.resolution))
+    if with_reference and getattr(atlas, "reference", None) is None:
+        raise ValueError(f"The atlas {atlas.atlas_name} was loaded without its reference volume")
+
+    # extent of the regions (corners of their bounding box, in microns) along the normal and the section axes
+    start, stop = _extent_um(atlas, regions)
+    start, stop = start - margin, stop + margin
+    corners = np.array([[a, b, c] for a in (start[0], stop[0]) for b in (start[1], stop[1]) for c in (start[2], stop[2])])
+    depth, cols, rows = corners @ normal, corners @ u, corners @ v
+
+    if n_sections is None:
+        positions = np.arange(depth.min() + thickness / 2, depth.max(), thickness)
+    else:
+        positions = np.linspace(depth.min() + thickness / 2, depth.max() - thickness / 2, n_sections)
+    origin_um = cols.min() * u + rows.min() * v
+    shape = (int(np.ceil((rows.max() - rows.min()) / pixel_size)), int(np.ceil((cols.max() - cols.min()) / pixel_size)))
+
+    # microns coordinates of the pixel centres of a section at position 0, offset along the normal for each section
+    grid = (origin_um + ((np.arange(shape[1]) + 0.5) * pixel_size)[None, :, None] * u
+        + ((np.arange(shape[0]) + 0.5) * pixel_size)[:, None, None] * v)
+    labels = np.zeros((len(positions), *shape), dtype = np.asarray(atlas.annotation[:1, :1, :1]).dtype)
+    reference = np.zeros((len(positions), *shape), dtype = np.float32) if with_reference else None
+    slab_offsets = ((np.arange(slab_samples) + 0.5) / slab_samples - 0.5) * thickness
+
+    for i in range(0, len(positions), batch_size):
+        batch = positions[i:i + batch_size]
+        coords = grid[None] + batch[:, None, None, None] * normal
+        labels[i:i + batch_size] = ids_from_coords(atlas, coords.reshape(-1, 3), microns = True).reshape(len(batch), *shape)
+        if with_reference:
+            for offset in slab_offsets:
+                reference[i:i + batch_size] += _reference_at(atlas, (coords + offset * normal).reshape(-1, 3)).reshape(len(batch), *shape)
+    if with_reference:
+        reference /= slab_samples
+
+    return SectionStack(atlas, labels, positions, origin_um, normal, u, v, pixel_size, thickness, reference = reference)
+
+
+# // PLOTTING //
+def plot_section(sections, section, regions = None, cells = None, cell_color = CELL_COLOR, cell_size = 4, ax = None, colors = None):
+    """
+    Plot a section: reference (or outline of the labels), contours of some regions and the cells within its slab
+
+    :param sections: SectionStack
+    :param section: int, index of the section
+    :param regions: list of str, acronyms of the regions whose contours are drawn
+    :param cells: np.ndarray, (N, 3) array of cell coordinates in microns
+    :param cell_color: str or list, color of the cells (or one color per cell)
+    :param cell_size: float, size of the cells
+    :param ax: matplotlib Axes (defaults to a new figure)
+    :param colors: dict {region: color}, colors of the contours (defaults to the atlas colors)
+    """
+    import matplotlib.pyplot as plt
+
+    if ax is None:
+        _, ax = plt.subplots()
+    if sections.reference is not None:
+        ax.imshow(sections.reference[section], cmap = "gray_r")
+    else:
+        labels = sections.labels[section]
+        edges = np.zeros(labels.shape, dtype = bool)
+        edges[1:] |= labels[1:] != labels[:-1]
+        edges[:, 1:] |= labels[:, 1:] != labels[:, :-1]
+        ax.imshow(edges, cmap = "Greys", vmax = 4)
+
+    for region in regions or []:
+        color = (colors or {}).get(region) or sections.region_color(region)
+        for line in sections.contours(region, sections = [section])[section]:
+            ax.plot(line[:, 0], line[:, 1], color = color, lw = 1)
+
+    if cells is not None:
+        in_section, pixels = sections.to_sections(cells)
+        rows = in_section == section
+        color = np.asarray(cell_color, dtype = object)[rows] if np.ndim(cell_color) and len(cell_color) == len(in_section) else cell_color
+        ax.scatter(pixels[rows, 0], pixels[rows, 1], s = cell_size, c = color, lw = 0)
+
+    ax.set_title(f"{sections.positions[section]:.0f}um", fontsize = 8)
+    ax.set_axis_off()
+    return ax
+
+
+def plot_sections(sections, section_ids = None, regions = None, cells = None, ncols = 10, panel_size = 2, **kwargs):
+    """
+    Plot a series of sections in a grid of panels. Returns the matplotlib Figure.
+
+    :param sections: SectionStack
+    :param section_ids: list of int, sections to plot (defaults to all sections)
+    :param regions: list of str, acronyms of the regions whose contours are drawn
+    :param cells: np.ndarray, (N, 3) array of cell coordinates in microns
+    :param ncols: int, number of panels per row
+    :param panel_size: float, size (in inches) of each panel
+    :param kwargs: keyword arguments passed to `plot_section()` (e.g. cell_color, colors)
+    """
+    import matplotlib.pyplot as plt
+
+    section_ids = list(range(len(sections))) if section_ids is None else list(section_ids)
+    nrows = int(np.ceil(len(section_ids) / ncols))
+    fig, axes = plt.subplots(nrows, ncols, figsize = (ncols * panel_size, nrows * panel_size), squeeze = False)
+    for ax in axes.ravel()[len(section_ids):]:
+        ax.set_axis_off()
+    for ax, section in zip(axes.ravel(), section_ids):
+        plot_section(sections, section, regions = regions, cells = cells, ax = ax, **kwargs)
+    return fig
+
+
+# // UTILS //
+def _unit_normal(normal):
+    if isinstance(normal, str):
+        if normal not in AXES:
+            raise ValueError(f"The normal should be one of {AXES} or a 3-tuple, not {normal}")
+        normal = np.eye(3)[AXES.index(normal)]
+    normal = np.asarray(normal, dtype = np.float64)
+    return normal / np.linalg.norm(normal)
+
+
+def _section_axes(normal):
+    """
+    Directions of the columns and rows of sections perpendicular to `normal`. Rows follow DV (or AP for horizontal sections),
+    so coronal sections have ML columns and DV rows.
+    """
+    up = np.eye(3)[AXES.index("DV")] if abs(normal[AXES.index("DV")]) < 0.9 else np.eye(3)[AXES.index("AP")]
+    v = up - (up @ normal) * normal
+    v /= np.linalg.norm(v)
+    u = np.cross(normal, v)
+    if u[np.argmax(np.abs(u))] < 0:
+        u = -u
+    return u, v
+
+
+def _extent_um(atlas, regions = None):
+    """
+    Start and stop (in microns) of the bounding box of some regions (or of the whole volume)
+    """
+    offset = np.asarray(getattr(atlas, "offset", 0))
+    if regions is None:
+        start, stop = np.zeros(3), np.asarray(atlas.annotation.shape)
+    else:
+        start, stop = _bounding_box(atlas.annotation, _descendant_ids(atlas, regions))
+    resolution = np.asarray(atlas.resolution, dtype = np.float64)
+    return (start + offset) * resolution, (stop + offset) * resolution
+
+
+def _reference_at(atlas, coords):
+    """
+    Reference intensity at each coordinate (in microns), 0 outside the volume
+    """
+    voxels = coords_to_voxels(atlas, coords, microns = True) - np.asarray(getattr(atlas, "offset", 0))
+    inside = np.all((voxels >= 0) & (voxels < np.asarray(atlas.reference.shape)), axis = 1)
+    values = np.zeros(len(voxels), dtype = np.float32)
+    values[inside] = atlas.reference[voxels[inside, 0], voxels[inside, 1], voxels[inside, 2]]
+    return values
+
+
+# edges crossed by the contour in each marching squares case (corners: 1 top-left, 2 top-right, 4 bottom-right, 8 bottom-left)
+# edges: 0 top, 1 right, 2 bottom, 3 left. Saddles (5 and 10) keep the two regions separate.
+_CASE_SEGMENTS = {1: [(3, 0)], 2: [(0, 1)], 3: [(3, 1)], 4: [(1, 2)], 5: [(3, 0), (1, 2)], 6: [(0, 2)], 7: [(3, 2)],
+    8: [(2, 3)], 9: [(0, 2)], 10: [(0, 1), (2, 3)], 11: [(1, 2)], 12: [(3, 1)], 13: [(0, 1)], 14: [(3, 0)]}
+_EDGE_MIDPOINTS = np.array([[0.5, 0], [1, 0.5], [0.5, 1], [0, 0.5]]) # (col, row) offset of each edge's midpoint in a cell
+
+
+def _marching_squares(masks):
+    """
+    Contour segments of a stack of 2D masks (padded so that contours are closed): (N, 2, 2) array of (col, row) end points
+    and the index of the mask of each segment
+    """
+    padded = np.pad(np.asarray(masks, dtype = np.uint8), ((0, 0), (1, 1), (1, 1)))
+    cases = padded[:, :-1, :-1] + 2 * padded[:, :-1, 1:] + 4 * padded[:, 1:, 1:] + 8 * padded[:, 1:, :-1]
+
+    segments, mask_ids = [], []
+    for case, edges in _CASE_SEGMENTS.items():
+        mask_id, row, col = np.nonzero(cases == case)
+        corner = np.column_stack([col, row]) - 1.0 # padding shifts pixels by one
+        for a, b in edges:
+            segments.append(np.stack([corner + _EDGE_MIDPOINTS[a], corner + _EDGE_MIDPOINTS[b]], axis = 1))
+            mask_ids.append(mask_id)
+    if not segments:
+        return np.zeros((0, 2, 2)), np.zeros(0, dtype = np.intp)
+    return np.concatenate(segments), np.concatenate(mask_ids)
+
+
+def _chain_segments(segments):
+    """
+    Join contour segments sharing end points into polylines. Each end point (an edge midpoint) belongs to at most two segments.
+    """
+    keys = np.round(segments * 2).astype(np.int64) # end points are on half pixels
+    keys = keys[..., 0] * (2 ** 32) + keys[..., 1]
+    neighbours = {}
+    for i, (a, b) in enumerate(keys.tolist()):
+        neighbours.setdefault(a, []).append(i)
+        neighbours.setdefault(b, []).append(i)
+
+    used = np.zeros(len(segments), dtype = bool)
+    lines = []
+    for first in range(len(segments)):
+        if used[first]:
+            continue
+        used[first] = True
+        line = deque([keys[first, 0], keys[first, 1]])
+        point_ids = deque([(first, 0), (first, 1)])
+        for direction in (1, 0): # extend from the end, then from the start
+            while True:
+                point = line[-1] if direction else line[0]
+                following = [s for s in neighbours[point] if not used[s]]
+                if not following:
+                    break
+                s = following[0]
+                used[s] = True
+                end = 1 if keys[s, 0] == point else 0
+                if direction:
+                    line.append(keys[s, end])
+                    point_ids.append((s, end))
+                else:
+                    line.appendleft(keys[s, end])
+                    point_ids.appendleft((s, end))
+        lines.append(np.array([segments[s, e] for s, e in point_ids]))
+    return lines